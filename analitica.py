@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+'''
+Reportes de gestión sobre copias columnares
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Exporta validacion e ingresado a archivos columnares comprimidos (Parquet
+con pyarrow o, si no está instalado, .npz de NumPy) y calcula los reportes
+de gestión sobre esas copias, nunca sobre la base de datos de los puestos
+de control. La exportación es incremental: cada vez se agrega una parte
+con los registros que cambiaron desde la anterior (tabla cambios) y, cuando
+hay muchas partes, se juntan en una sola. Al juntarlas se aplican los
+cambios en orden: de validacion queda la última versión de cada permiso y
+los permisos borrados o archivados salen de la copia (cada parte marca sus
+bajas); ingresado es el historial de ingresos, una fila por código y
+fecha_ingreso, así un nuevo ingreso del mismo permiso (después de archivar
+el anterior) no reemplaza al anterior. Los reportes se calculan con
+NumPy sobre las columnas completas, cargadas una vez por proceso y vueltas
+a cargar solo cuando hay una exportación nueva.
+
+Exporta un solo proceso a la vez (los workers de /analitica/exportar y el
+cron): mientras otro tiene el lock del archivo .exportar.lock de la
+carpeta, exportar() lanza ExportacionEnCurso. Los reportes no toman el
+lock: una parte que ya está incluida en otra (por una compactación) no
+se lee, y si una parte se borra mientras se leía se vuelve a listar.
+
+Reportes:
+    ingresos_por_dia        ingresos por empresa y día
+    riesgo_por_actividad    cantidad de permisos por actividad y riesgo
+    edades                  histograma y percentiles de edad de los permisos
+
+resumen() calcula los datos de varios gráficos a la vez (riesgo, edades,
+empresa, actividad y por ventana de tiempo) sobre columnas ya leídas, por
+ejemplo las de empresa_valida.columnas_estadisticas() para /estadisticas.
+
+Los parámetros se leen de la sección [analitica] del config.ini: carpeta,
+formato (auto, parquet o npz) y max_partes.
+
+Uso (por ejemplo desde cron, fuera del horario pico):
+    python analitica.py
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import glob
+import importlib.util
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+# Lock entre procesos de la exportación: fcntl o, en Windows, msvcrt
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+import numpy as np
+
+import empresa_valida
+from config import config
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+config_path_name = os.path.join(script_path, 'config.ini')
+
+# Valores por defecto si no están en la sección [analitica] del config.ini
+CARPETA = 'analitica'
+MAX_PARTES = 20
+
+# parte_<desde>_<hasta>.<extension>: cambios (desde, hasta] de la tabla
+PARTE = re.compile(r'^parte_(\d+)_(\d+)\.(parquet|npz)$')
+
+# Columnas numéricas, el resto se guardan como texto
+NUMERICAS = ('codigo', 'edad', 'dni')
+
+# Columnas que identifican una fila de cada tabla en la copia: de un
+# permiso vale la última versión, de ingresado se guarda cada ingreso
+CLAVES = {'validacion': ('codigo',), 'ingresado': ('codigo', 'fecha_ingreso')}
+
+# Tablas en las que una baja saca las filas de la copia (ingresado solo se
+# borra al archivar los ingresos viejos, que siguen contando en los reportes)
+CON_BAJAS = ('validacion',)
+
+params = {}
+config_path = None
+
+# Columnas cargadas por tabla: {tabla: (partes, columnas)}
+cargadas = {}
+lock = threading.Lock()
+
+
+class ExportacionEnCurso(Exception):
+    # Otro proceso (o thread) está exportando
+    pass
+
+
+def configurar(path=config_path_name):
+    global params, config_path
+    params = config('analitica', path)
+    config_path = path
+    cargadas.clear()
+
+
+def cargar_pyarrow():
+    # Import diferido: pyarrow tarda en cargarse y solo hace falta para
+    # escribir o leer Parquet. Retorna None si no está instalado.
+    if importlib.util.find_spec('pyarrow') is None:
+        return None
+    import pyarrow
+    import pyarrow.parquet
+    return pyarrow
+
+
+def carpeta_tabla(tabla):
+    return os.path.join(params.get('carpeta', CARPETA), tabla)
+
+
+def formato():
+    valor = params.get('formato', 'auto')
+    disponible = importlib.util.find_spec('pyarrow') is not None
+    if valor == 'auto':
+        return 'parquet' if disponible else 'npz'
+    if valor == 'parquet' and not disponible:
+        raise RuntimeError('formato = parquet requiere pyarrow (pip install pyarrow)')
+    return valor
+
+
+def partes(tabla, todas=False):
+    # Partes de la tabla ordenadas por cambio: [(desde, hasta, ruta)]. Las
+    # que ya están incluidas en otra (una compactación que todavía no las
+    # borró) se descartan, salvo con todas=True.
+    encontradas = []
+    for ruta in glob.glob(os.path.join(carpeta_tabla(tabla), 'parte_*')):
+        match = PARTE.match(os.path.basename(ruta))
+        if match:
+            encontradas.append((int(match.group(1)), int(match.group(2)), ruta))
+    if not todas:
+        encontradas = [(desde, hasta, ruta) for desde, hasta, ruta in encontradas
+                       if not any(d <= desde and hasta <= h and (d, h) != (desde, hasta)
+                                  for d, h, _ in encontradas)]
+    return sorted(encontradas)
+
+
+def como_columnas(tabla, filas, bajas=()):
+    # Las bajas se agregan como filas marcadas (columna baja = 1) con solo
+    # el código, para que unir() saque ese registro de las partes anteriores
+    columnas = {}
+    for i, nombre in enumerate(empresa_valida.COLUMNAS_EXPORTACION[tabla]):
+        valores = [fila[i] for fila in filas]
+        if nombre in NUMERICAS:
+            relleno = list(bajas) if nombre == 'codigo' else [0] * len(bajas)
+            columnas[nombre] = np.array(valores + relleno, dtype=np.int64)
+        else:
+            columnas[nombre] = np.array(['' if v is None else str(v) for v in valores] + [''] * len(bajas),
+                                        dtype=str)
+    columnas['baja'] = np.array([0] * len(filas) + [1] * len(bajas), dtype=np.int8)
+    return columnas
+
+
+def escribir_parte(tabla, desde, hasta, columnas):
+    # Se escribe con otro nombre y se renombra: nunca se lee una parte a medias
+    extension = formato()
+    carpeta = carpeta_tabla(tabla)
+    os.makedirs(carpeta, exist_ok=True)
+    ruta = os.path.join(carpeta, 'parte_{}_{}.{}'.format(desde, hasta, extension))
+    temporal = os.path.join(carpeta, '.tmp_{}_{}.{}'.format(desde, hasta, extension))
+
+    if extension == 'parquet':
+        pyarrow = cargar_pyarrow()
+        tabla_arrow = pyarrow.table({nombre: valores for nombre, valores in columnas.items()})
+        pyarrow.parquet.write_table(tabla_arrow, temporal, compression='zstd')
+    else:
+        np.savez_compressed(temporal, **columnas)
+
+    os.replace(temporal, ruta)
+    return ruta
+
+
+def leer_parte(ruta):
+    if ruta.endswith('.parquet'):
+        pyarrow = cargar_pyarrow()
+        if pyarrow is None:
+            raise RuntimeError('{} requiere pyarrow (pip install pyarrow)'.format(ruta))
+        tabla_arrow = pyarrow.parquet.read_table(ruta)
+        return {nombre: tabla_arrow.column(nombre).to_numpy() for nombre in tabla_arrow.column_names}
+
+    with np.load(ruta) as datos:
+        return {nombre: datos[nombre] for nombre in datos.files}
+
+
+def unir(tabla, lista):
+    # Junta las partes en orden y deja la última versión de cada fila
+    # (CLAVES); las bajas sacan el registro. Retorna las columnas sin bajas.
+    nombres = empresa_valida.COLUMNAS_EXPORTACION[tabla]
+    lista = [columnas for columnas in lista if len(columnas['codigo'])]
+    if not lista:
+        columnas = como_columnas(tabla, [])
+        del columnas['baja']
+        return columnas
+
+    columnas = {nombre: np.concatenate([c[nombre] for c in lista]) for nombre in nombres}
+    # Las partes exportadas antes de marcar las bajas no tienen la columna
+    bajas = np.concatenate([c['baja'] if 'baja' in c else np.zeros(len(c['codigo']), dtype=np.int8)
+                            for c in lista])
+
+    # Clave de cada fila: el código, o el código y la fecha del ingreso
+    claves = CLAVES[tabla]
+    clave = columnas[claves[0]]
+    if len(claves) > 1:
+        clave = clave.astype(str)
+        for nombre in claves[1:]:
+            clave = np.char.add(np.char.add(clave, '|'), columnas[nombre].astype(str))
+
+    # np.unique da la primera aparición: se busca sobre el orden invertido.
+    # Si la última aparición es una baja, el registro ya no está.
+    _, indices = np.unique(clave[::-1], return_index=True)
+    indices = len(clave) - 1 - indices
+    indices = indices[bajas[indices] == 0]
+    return {nombre: valores[indices] for nombre, valores in columnas.items()}
+
+
+@contextmanager
+def bloqueo_exportacion():
+
+    # Lock exclusivo sin esperar: si otro proceso exporta se lanza
+    # ExportacionEnCurso. El sistema operativo lo libera si el proceso termina.
+    carpeta = params.get('carpeta', CARPETA)
+    os.makedirs(carpeta, exist_ok=True)
+    with open(os.path.join(carpeta, '.exportar.lock'), 'a+b') as archivo:
+        archivo.seek(0)
+        try:
+            if fcntl is not None:
+                fcntl.flock(archivo.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(archivo.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            raise ExportacionEnCurso('hay otra exportación en curso')
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(archivo.fileno(), fcntl.LOCK_UN)
+            else:
+                archivo.seek(0)
+                msvcrt.locking(archivo.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def exportar():
+
+    # Agrega a cada tabla una parte con lo que cambió desde la última
+    # exportación. Retorna {tabla: filas exportadas}.
+    exportadas = {}
+    with bloqueo_exportacion():
+        for tabla in empresa_valida.COLUMNAS_EXPORTACION:
+            existentes = partes(tabla)
+            desde = existentes[-1][1] if existentes else 0
+
+            hasta, filas, bajas = empresa_valida.exportar_cambios(tabla, desde)
+            if hasta > desde:
+                escribir_parte(tabla, desde, hasta,
+                               como_columnas(tabla, filas, bajas if tabla in CON_BAJAS else ()))
+                existentes = partes(tabla)
+
+            if len(existentes) > int(params.get('max_partes', MAX_PARTES)):
+                compactar(tabla, existentes)
+
+            exportadas[tabla] = len(filas)
+
+    return exportadas
+
+
+def compactar(tabla, existentes):
+    # Reemplaza todas las partes por una sola, sin registros repetidos ni
+    # bajas (no queda nada anterior de qué sacarlas). Se llama con el lock
+    # de exportación; también se borran las que dejó una compactación
+    # interrumpida.
+    columnas = unir(tabla, [leer_parte(ruta) for _, _, ruta in existentes])
+    columnas['baja'] = np.zeros(len(columnas['codigo']), dtype=np.int8)
+    nueva = escribir_parte(tabla, 0, existentes[-1][1], columnas)
+    for _, _, ruta in partes(tabla, todas=True):
+        if ruta != nueva:
+            os.remove(ruta)
+
+
+def columnas(tabla):
+    # Columnas de la última exportación, desde memoria si no hubo otra
+    actuales = tuple(partes(tabla))
+    anteriores = cargadas.get(tabla)
+    if anteriores is not None and anteriores[0] == actuales:
+        return anteriores[1]
+
+    with lock:
+        while True:
+            anteriores = cargadas.get(tabla)
+            if anteriores is not None and anteriores[0] == actuales:
+                return anteriores[1]
+            try:
+                datos = unir(tabla, [leer_parte(ruta) for _, _, ruta in actuales])
+                break
+            except FileNotFoundError:
+                # Una compactación la borró mientras tanto: ya está en la nueva
+                actuales = tuple(partes(tabla))
+        cargadas[tabla] = (actuales, datos)
+    return datos
+
+
+def contar_por(*claves):
+    # Cantidad por combinación de claves (arrays de igual largo).
+    # Retorna los valores únicos de cada clave y la matriz de cantidades.
+    unicos = []
+    indices = []
+    for clave in claves:
+        valores, inversa = np.unique(clave, return_inverse=True)
+        unicos.append(valores)
+        indices.append(inversa)
+
+    forma = tuple(len(valores) for valores in unicos)
+    if not claves[0].size:
+        return unicos, np.zeros(forma, dtype=np.int64)
+
+    plano = np.ravel_multi_index(indices, forma)
+    cantidades = np.bincount(plano, minlength=int(np.prod(forma))).reshape(forma)
+    return unicos, cantidades
+
+
+def ingresos_por_dia(desde=None, hasta=None, empresa=None):
+
+    # Ingresos por empresa y día en el rango [desde, hasta) ('YYYY-MM-DD')
+    datos = columnas('ingresado')
+    dias = datos['fecha_ingreso'].astype('U10')
+    empresas = datos['empresa']
+
+    filtro = np.ones(len(dias), dtype=bool)
+    if desde:
+        filtro &= dias >= desde
+    if hasta:
+        filtro &= dias < hasta
+    if empresa:
+        filtro &= empresas == empresa.upper()
+
+    (lista_empresas, lista_dias), cantidades = contar_por(empresas[filtro], dias[filtro])
+    filas, cols = np.nonzero(cantidades)
+    return [{"empresa": str(lista_empresas[i]), "dia": str(lista_dias[j]), "cantidad": int(cantidades[i, j])}
+            for i, j in zip(filas, cols)]
+
+
+def riesgo_por_actividad():
+
+    # Permisos por actividad y riesgo: {actividad: {riesgo: cantidad}}
+    datos = columnas('validacion')
+    (actividades, riesgos), cantidades = contar_por(datos['actividad'], datos['riesgo'])
+    return {str(actividad): {str(riesgo): int(cantidad)
+                             for riesgo, cantidad in zip(riesgos, fila) if cantidad}
+            for actividad, fila in zip(actividades, cantidades)}
+
+
+def edades(intervalos=10):
+
+    # Histograma de edades de los permisos, en general y por riesgo
+    datos = columnas('validacion')
+    valores = datos['edad']
+    if not valores.size:
+        return {"cantidad": 0, "bordes": [], "cantidades": [], "percentiles": {}, "por_riesgo": {}}
+
+    cantidades, bordes = np.histogram(valores, bins=intervalos)
+    percentiles = np.percentile(valores, [25, 50, 75, 95])
+
+    por_riesgo = {}
+    for riesgo in np.unique(datos['riesgo']):
+        por_riesgo[str(riesgo)] = np.histogram(valores[datos['riesgo'] == riesgo], bins=bordes)[0].tolist()
+
+    return {
+        "cantidad": int(valores.size),
+        "bordes": bordes.round(2).tolist(),
+        "cantidades": cantidades.tolist(),
+        "percentiles": {"p25": float(percentiles[0]), "p50": float(percentiles[1]),
+                        "p75": float(percentiles[2]), "p95": float(percentiles[3])},
+        "por_riesgo": por_riesgo,
+    }
+
+
+# Gráficos que puede calcular resumen()
+GRAFICOS = ('riesgo', 'edades', 'empresa', 'actividad', 'empresa_riesgo', 'actividad_riesgo', 'ventana')
+
+# Ventanas de tiempo por fecha_permiso
+VENTANAS = ('dia', 'semana', 'mes')
+
+
+def conteo(claves):
+    (etiquetas,), cantidades = contar_por(claves)
+    return {"etiquetas": etiquetas.tolist(), "cantidades": cantidades.tolist()}
+
+
+def matriz(filas, columnas):
+    (etiquetas_filas, etiquetas_columnas), cantidades = contar_por(filas, columnas)
+    return {"filas": etiquetas_filas.tolist(), "columnas": etiquetas_columnas.tolist(),
+            "cantidades": cantidades.tolist()}
+
+
+def inicio_ventana(fechas, ventana):
+    # Primer día de la ventana de cada fecha ISO ('YYYY-MM-DD ...')
+    dias = fechas.astype('U10')
+    if ventana == 'mes':
+        return np.char.add(dias.astype('U7'), '-01')
+    if ventana == 'semana':
+        # Lunes de la semana: el 1970-01-01 fue jueves
+        numeros = dias.astype('datetime64[D]')
+        lunes = numeros - ((numeros.astype(np.int64) + 3) % 7).astype('timedelta64[D]')
+        return lunes.astype('U10')
+    return dias
+
+
+def resumen(datos, graficos=GRAFICOS, intervalos=10, ventana='dia'):
+
+    # Datos de varios gráficos en una sola pasada sobre las columnas
+    # (empresa, actividad, edad, riesgo, fecha_permiso), con NumPy.
+    empresas = np.array(datos['empresa'], dtype=str)
+    actividades = np.array(datos['actividad'], dtype=str)
+    riesgos = np.array(datos['riesgo'], dtype=str)
+    edades_permiso = np.array(datos['edad'], dtype=np.int64)
+    fechas = np.array(datos['fecha_permiso'], dtype=str)
+
+    resultado = {"total": int(riesgos.size)}
+
+    if 'riesgo' in graficos:
+        resultado['riesgo'] = conteo(riesgos)
+
+    if 'empresa' in graficos:
+        resultado['empresa'] = conteo(empresas)
+
+    if 'actividad' in graficos:
+        resultado['actividad'] = conteo(actividades)
+
+    if 'empresa_riesgo' in graficos:
+        resultado['empresa_riesgo'] = matriz(empresas, riesgos)
+
+    if 'actividad_riesgo' in graficos:
+        resultado['actividad_riesgo'] = matriz(actividades, riesgos)
+
+    if 'edades' in graficos:
+        if edades_permiso.size:
+            cantidades, bordes = np.histogram(edades_permiso, bins=intervalos)
+        else:
+            cantidades, bordes = np.zeros(0, dtype=np.int64), np.zeros(0)
+        resultado['edades'] = {"bordes": bordes.round(2).tolist(), "cantidades": cantidades.tolist()}
+
+    if 'ventana' in graficos:
+        por_ventana = matriz(inicio_ventana(fechas, ventana), riesgos)
+        resultado['ventana'] = {"tipo": ventana,
+                                "etiquetas": por_ventana['filas'],
+                                "cantidades": [sum(fila) for fila in por_ventana['cantidades']],
+                                "riesgos": por_ventana['columnas'],
+                                "por_riesgo": por_ventana['cantidades']}
+
+    return resultado
+
+
+def estado():
+    # Partes y último cambio exportado de cada tabla
+    resultado = {}
+    for tabla in empresa_valida.COLUMNAS_EXPORTACION:
+        existentes = partes(tabla)
+        resultado[tabla] = {"partes": len(existentes),
+                            "ultimo_cambio": existentes[-1][1] if existentes else 0}
+    return resultado
+
+
+# Cargar la configuración al importar el módulo
+configurar()
+
+
+if __name__ == '__main__':
+    empresa_valida.migrar()
+    try:
+        print(exportar())
+    except ExportacionEnCurso as e:
+        # Otro proceso ya está exportando: esta vez no se hace nada
+        print(e)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+'''
+API asíncrona de permisos
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+API JSON con asyncio (aiohttp) para los equipos de los puestos de control,
+que mantienen muchas conexiones abiertas sobre redes móviles lentas. Cada
+conexión esperando no ocupa un thread: un solo proceso atiende miles. Las
+funciones de empresa_valida (que son bloqueantes) se ejecutan en un pool de
+threads acotado, así SQLite nunca recibe más consultas a la vez que las
+que puede atender el pool de conexiones.
+
+Endpoints:
+    GET  /api/permisos/{codigo}        busca un permiso (sin registrar ingreso)
+    POST /api/consulta                 {"codigo": ...} busca y registra el ingreso, como /consulta
+    POST /api/consulta_lote            {"codigos": [...]} lo mismo para muchos códigos, como /consulta_lote
+    POST /api/permisos                 registra uno o una lista de empleados, como /procesar_lote
+    GET  /api/permisos?limit=&cursor=  lista los permisos paginados por cursor
+    GET  /api/eventos?tabla=           permisos nuevos e ingresos en vivo (Server-Sent
+                                       Events), como /eventos
+
+Los parámetros se leen de la sección [async] del config.ini: host, port e hilos,
+y los del canal de eventos de la sección [eventos].
+
+Uso:
+    python api_async.py
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import conexion
+import empresa_valida
+import eventos
+from config import config
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+config_path_name = os.path.join(script_path, 'config.ini')
+
+COLUMNAS = ['codigo', 'empresa', 'actividad', 'nombre', 'edad', 'dni', 'fecha_permiso', 'riesgo', 'vence']
+
+# Máximo de registros por página en el listado
+LIMITE_MAXIMO = 1000
+
+
+async def en_hilo(request, funcion, *args, **kwargs):
+    # Ejecuta una función bloqueante de empresa_valida en el pool de threads
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app['executor'], functools.partial(funcion, *args, **kwargs))
+
+
+def como_dict(fila):
+    return dict(zip(COLUMNAS, fila))
+
+
+async def obtener_permiso(request):
+    codigo = request.match_info['codigo']
+    if empresa_valida.leer_entero(codigo) is None:
+        return web.json_response({'error': 'código inválido'}, status=400)
+
+    datos = await en_hilo(request, empresa_valida.consulta, codigo)
+    if not datos:
+        return web.json_response({'codigo': int(codigo), 'encontrado': False}, status=404)
+    return web.json_response({'codigo': int(codigo), 'encontrado': True, 'permiso': como_dict(datos[0])})
+
+
+async def consultar(request):
+    try:
+        cuerpo = await request.json()
+    except ValueError:
+        return web.json_response({'error': 'se esperaba un JSON'}, status=400)
+
+    codigo = str(cuerpo.get('codigo')) if isinstance(cuerpo, dict) else ''
+    if empresa_valida.leer_entero(codigo) is None:
+        return web.json_response({'error': 'código inválido'}, status=400)
+
+    # Igual que /consulta: se busca el permiso y se registra el ingreso
+    datos = await en_hilo(request, empresa_valida.registrar_ingreso, codigo)
+    if not datos:
+        return web.json_response({'codigo': int(codigo), 'encontrado': False}, status=404)
+    if empresa_valida.vencido(datos[0]):
+        # No se registró el ingreso
+        return web.json_response({'codigo': int(codigo), 'encontrado': True, 'vencido': True,
+                                  'permiso': como_dict(datos[0])}, status=403)
+
+    return web.json_response({'codigo': int(codigo), 'encontrado': True, 'permiso': como_dict(datos[0])})
+
+
+async def consultar_lote(request):
+    try:
+        cuerpo = await request.json()
+    except ValueError:
+        return web.json_response({'error': 'se esperaba un JSON'}, status=400)
+
+    codigos = cuerpo.get('codigos') if isinstance(cuerpo, dict) else cuerpo
+    if not isinstance(codigos, list):
+        return web.json_response({'error': 'se esperaba una lista de códigos'}, status=400)
+    if len(codigos) > empresa_valida.MAX_CODIGOS_LOTE:
+        return web.json_response({'error': 'se admiten hasta {} códigos por pedido'.format(
+            empresa_valida.MAX_CODIGOS_LOTE)}, status=400)
+
+    reporte = await en_hilo(request, empresa_valida.verificar_lote, codigos)
+    return web.json_response(reporte)
+
+
+async def registrar(request):
+    try:
+        cuerpo = await request.json()
+    except ValueError:
+        return web.json_response({'error': 'se esperaba un JSON'}, status=400)
+
+    filas = cuerpo if isinstance(cuerpo, list) else [cuerpo]
+
+    # Se validan e insertan todos los registros en una sola transacción
+    reporte = await en_hilo(request, empresa_valida.registrar_lote, filas)
+    return web.json_response(reporte)
+
+
+def pagina(despues_de, limit):
+    # Se lee la página completa en el thread, no en el event loop
+    datos = list(empresa_valida.report_stream(despues_de=despues_de, limit=limit, dict_format=True))
+    siguiente = empresa_valida.ultimo_codigo(despues_de=despues_de, limit=limit)
+    return datos, siguiente
+
+
+async def listar(request):
+    limit = empresa_valida.leer_entero(request.query.get('limit', '100'))
+    limit = min(limit, LIMITE_MAXIMO) if limit else 100
+
+    despues_de = None
+    cursor = request.query.get('cursor')
+    if cursor:
+        despues_de = empresa_valida.leer_cursor(cursor)
+        if despues_de is None:
+            return web.json_response({'error': 'cursor inválido'}, status=400)
+
+    datos, siguiente = await en_hilo(request, pagina, despues_de, limit)
+    return web.json_response({
+        'datos': datos,
+        'siguiente_cursor': empresa_valida.crear_cursor(siguiente) if siguiente is not None else None,
+    })
+
+
+class SuscripcionAsync(eventos.Suscripcion):
+
+    # Suscripción leída desde el event loop: el hilo del difusor le pasa los
+    # eventos al loop, así una conexión esperando no ocupa un thread
+
+    def __init__(self, difusor, desde, tablas, maximo, loop=None):
+        super().__init__(difusor, desde, tablas, maximo)
+        self.loop = loop
+        self.cola = asyncio.Queue()
+
+    def poner(self, elemento):
+        try:
+            self.loop.call_soon_threadsafe(self.cola.put_nowait, elemento)
+        except RuntimeError:
+            # El loop ya se cerró
+            self.terminada = True
+
+    async def siguiente(self, timeout):
+        try:
+            evento = await asyncio.wait_for(self.cola.get(), timeout)
+        except asyncio.TimeoutError:
+            return ''
+        if evento is not eventos.FIN:
+            self.tomados += 1
+        return evento
+
+
+async def eventos_en_vivo(request):
+    params = request.app['eventos_params']
+    desde = eventos.leer_desde(request.headers.get('Last-Event-ID') or request.query.get('desde'))
+    try:
+        tablas = eventos.leer_tablas(request.query.get('tabla'), empresa_valida.COLUMNAS_EVENTO)
+    except ValueError as e:
+        return web.json_response({'error': str(e)}, status=400)
+
+    # suscribir() puede leer de la base los eventos que se perdió el cliente
+    try:
+        suscripcion = await en_hilo(request, request.app['eventos'].suscribir, desde, tablas,
+                                    clase=SuscripcionAsync, loop=asyncio.get_running_loop())
+    except eventos.SinLugar as e:
+        return web.json_response({'error': str(e)}, status=503, headers={'Retry-After': '30'})
+
+    latido = float(params.get('latido', eventos.LATIDO))
+    respuesta = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache',
+                                            'X-Accel-Buffering': 'no'})
+    try:
+        await respuesta.prepare(request)
+        await respuesta.write('retry: {}\n\n'.format(eventos.REINTENTO_MS).encode('utf-8'))
+        # Aquí la conexión no ocupa un thread: dura hasta que el cliente la corta
+        while True:
+            evento = await suscripcion.siguiente(latido)
+            if evento is eventos.FIN:
+                break
+            texto = eventos.formato_sse(evento) if evento else ': latido\n\n'
+            await respuesta.write(texto.encode('utf-8'))
+    except ConnectionResetError:
+        pass
+    finally:
+        suscripcion.cancelar()
+    return respuesta
+
+
+async def cerrar(app):
+    # Al terminar: cerrar los canales de eventos, escribir lo pendiente,
+    # esperar los threads y cerrar conexiones
+    app['eventos'].detener()
+    app['executor'].shutdown(wait=True)
+    empresa_valida.escritor_ingreso.detener()
+    conexion.cerrar_todo()
+
+
+def create_app(config_path=config_path_name):
+
+    params = config('async', config_path)
+
+    app = web.Application()
+    # Tantos threads como conexiones tenga el pool, para no esperar conexión
+    app['executor'] = ThreadPoolExecutor(max_workers=int(params.get('hilos', empresa_valida.db.get('pool_size', 5))),
+                                         thread_name_prefix='api-async')
+    app['params'] = params
+    app['eventos_params'] = config('eventos', config_path)
+    app['eventos'] = eventos.crear(empresa_valida.eventos_desde, empresa_valida.version_datos,
+                                   app['eventos_params'])
+
+    app.router.add_get('/api/permisos/{codigo}', obtener_permiso)
+    app.router.add_post('/api/consulta', consultar)
+    app.router.add_post('/api/consulta_lote', consultar_lote)
+    app.router.add_post('/api/permisos', registrar)
+    app.router.add_get('/api/permisos', listar)
+    app.router.add_get('/api/eventos', eventos_en_vivo)
+    app.on_cleanup.append(cerrar)
+
+    empresa_valida.migrar()
+    return app
+
+
+if __name__ == '__main__':
+    app = create_app()
+    web.run_app(app, host=app['params']['host'], port=int(app['params']['port']))
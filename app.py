@@ -15,61 +15,204 @@ __version__ = "1.0"
 
 import traceback
 import io
-import sys
+import csv
 import os
-import base64
+import hashlib
+import threading
+import time
+import logging
 import json
-import sqlite3
-from datetime import datetime, timedelta
-import requests
-
-import numpy as np
-from flask import Flask, request, jsonify, render_template, Response, redirect, url_for, session
-import matplotlib
-matplotlib.use('Agg')   # Para multi-thread, non-interactive backend (avoid run in main loop)
-import matplotlib.pyplot as plt
-# Para convertir matplotlib a imagen y luego a datos binarios
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
-import matplotlib.image as mpimg
-from matplotlib.ticker import MaxNLocator
+import math
+from datetime import datetime
 
+from flask import Flask, Blueprint, request, jsonify, render_template, Response, redirect, url_for, session, g, current_app, make_response
+from flask import before_render_template, template_rendered
+
+import cache
+import conexion
 import empresa_valida
+import estaticos
+import eventos
+import graficos
+import instantanea
+import metricas
 from config import config
 
 
-# Crear el server Flask
-app = Flask(__name__)
-
-# Clave que utilizaremos para encriptar los datos
-app.secret_key = "flask_session_key_inventada"
-
 # Obtener la path de ejecución actual del script
 script_path = os.path.dirname(os.path.realpath(__file__))
 
 # Obtener los parámetros del archivo de configuración
 config_path_name = os.path.join(script_path, 'config.ini')
-db = config('db', config_path_name)
 server = config('server', config_path_name)
 
-# Enviar los datos de config de la DB
-empresa_valida.db = db
+# Los endpoints se registran en un blueprint, create_app() arma la app
+bp = Blueprint('permisos', __name__)
+
+# Último gráfico de riesgos generado por formato, se vuelve a generar solo si cambian los conteos
+grafico_cache = {}
+grafico_lock = threading.Lock()
+
+# Resultados de /estadisticas por parámetros y versión de los datos
+resumen_cache = cache.CacheLRU(maximo=100, ttl=3600)
+
+# Instantánea de permisos para los puestos de control por versión de los permisos
+instantanea_cache = cache.CacheLRU(maximo=2, ttl=3600)
+
+
+def create_app(config_path=None):
+
+    # App factory: crea y configura la app Flask. Con un servidor de varios
+    # procesos se llama una vez en el proceso principal (preload) y los
+    # workers la heredan ya lista.
+    if config_path is not None:
+        # Otro archivo de configuración (la BD la configura empresa_valida)
+        empresa_valida.configurar(config_path)
+    else:
+        config_path = config_path_name
+
+    # Crear el server Flask. Los archivos de static/ los sirve el módulo
+    # estaticos desde memoria, con hash en la URL y comprimidos
+    app = Flask(__name__, static_folder=None)
 
-@app.route("/")
+    # Clave que utilizaremos para encriptar los datos
+    app.secret_key = "flask_session_key_inventada"
+
+    app.config['SERVER'] = config('server', config_path)
+    app.config['CONFIG_PATH'] = config_path
+    app.config['SINCRONIZACION'] = config('sincronizacion', config_path)
+    app.config['EVENTOS'] = config('eventos', config_path)
+    metricas_params = config('metricas', config_path)
+
+    # Log de tiempos por pedido (una línea JSON por pedido)
+    if str(metricas_params.get('log_tiempos', 'no')).lower() in ('si', 'sí', '1', 'true'):
+        logging.basicConfig(level=logging.INFO)
+        metricas.logger.setLevel(logging.INFO)
+
+    app.extensions['estaticos'] = estaticos.crear(os.path.join(script_path, 'static'),
+                                                  config('estaticos', config_path))
+    app.add_url_rule('/static/<path:filename>', endpoint='static',
+                     view_func=app.extensions['estaticos'].servir)
+
+    # Un solo lector de cambios por worker para todos los tableros en vivo;
+    # su hilo se crea con la primera suscripción, ya en el worker. Cada
+    # conexión a /eventos o /eventos/nuevos ocupa un thread del worker: se
+    # admiten menos que threads para que siempre quede uno para /consulta
+    # y los demás pedidos (los tableros van a /api/eventos de api_async.py).
+    params = dict(app.config['EVENTOS'])
+    threads = int(app.config['SERVER'].get('threads', 4))
+    maximo = int(params.get('max_suscripciones_flask', max(threads - 1, 0)))
+    params['max_suscripciones'] = min(maximo, int(params.get('max_suscripciones', eventos.MAX_SUSCRIPCIONES)))
+    app.extensions['eventos'] = eventos.crear(empresa_valida.eventos_desde, empresa_valida.version_datos, params)
+
+    app.register_blueprint(bp)
+    before_render_template.connect(inicio_template, app)
+    template_rendered.connect(fin_template, app)
+
+    # Llevar las bases de datos a la última versión del esquema. Se cierran las
+    # conexiones usadas, así ningún worker hereda conexiones abiertas.
+    empresa_valida.migrar()
+    conexion.cerrar_todo()
+
+    return app
+
+
+@bp.before_app_request
+def iniciar_medicion():
+    # Se toma el tiempo de inicio y se ponen en cero los acumulados del pedido
+    g.inicio_pedido = time.perf_counter()
+    metricas.iniciar_pedido()
+
+
+@bp.after_app_request
+def registrar_medicion(response):
+    inicio = g.pop('inicio_pedido', None)
+    if inicio is not None:
+        segundos = time.perf_counter() - inicio
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'desconocido'
+        metricas.observar('http_pedido_segundos', segundos, endpoint=endpoint, metodo=request.method)
+        metricas.contar('http_pedidos_total', endpoint=endpoint, metodo=request.method, estado=response.status_code)
+        datos = {"endpoint": endpoint, "metodo": request.method, "estado": response.status_code,
+                 "ms": round(segundos * 1000, 3)}
+        datos.update(metricas.resumen_pedido())
+        metricas.log_pedido(datos)
+    return response
+
+
+@bp.app_url_defaults
+def version_estatico(endpoint, values):
+    # url_for('static', filename=...) agrega el hash del contenido (?v=hash)
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        version = current_app.extensions['estaticos'].version(values['filename'])
+        if version is not None:
+            values['v'] = version
+
+
+def modulo_analitica():
+    # Import diferido: numpy (y pyarrow) se cargan con el primer pedido que
+    # los necesita, no al arrancar cada worker
+    import analitica
+    if analitica.config_path != current_app.config['CONFIG_PATH']:
+        analitica.configurar(current_app.config['CONFIG_PATH'])
+    return analitica
+
+
+def pagina_estatica(template):
+    # Páginas sin datos del pedido: se arman una vez y se sirven desde memoria
+    return current_app.extensions['estaticos'].pagina(template)
+
+
+def inicio_template(sender, template, context, **extra):
+    g.inicio_template = time.perf_counter()
+
+
+def fin_template(sender, template, context, **extra):
+    inicio = g.pop('inicio_template', None)
+    if inicio is not None:
+        segundos = time.perf_counter() - inicio
+        metricas.observar('template_render_segundos', segundos, template=template.name)
+        metricas.acumular('render_segundos', segundos)
+
+
+def error_trace():
+    # Todos los endpoints devuelven la traza en JSON cuando algo falla,
+    # además se cuenta el error y queda en el log
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'desconocido'
+    metricas.contar('http_errores_total', endpoint=endpoint)
+    logging.getLogger('permisos').exception('Error en %s', endpoint)
+    return jsonify({'trace': traceback.format_exc()})
+
+@bp.route("/")
 def index():
     try:
         #Endopoints disponibles
         result = "<h1>Bienvenido!!</h1>"
         result += "<h2>Endpoints disponibles:</h2>"
-        result += "<h3>[GET] /reset --> borrar y crear la base de datos</h3>"
+        result += "<h3>[GET] /reset --> aplicar las migraciones pendientes de la base de datos</h3>"
         result += "<h3>[GET] /menu.html --> HTML de bienvenida con las acciones a realizar</h3>"
         result += "<h3>[GET] /empresa.html --> muestra el HTML con el formulario de registro</h3>"
-        result += "<h3>[POST] /procesar --> ingreso del registro en la base de datos</h3>"
+        result += "<h3>[POST] /procesar --> ingreso del registro en la base de datos (modo=[rechazar|actualizar|conservar], encabezado Idempotency-Key)</h3>"
+        result += "<h3>[POST] /procesar_lote --> ingreso de un lote de registros (lista JSON o archivo CSV)</h3>"
         result += "<h3>[GET] /validar_datos.html --> muestra el HTML de consulta de código en la base de datos</h3>"
         result += "<h3>[POST] /consulta --> se muestran en una tabla los datos por código consultado</h3>"
+        result += "<h3>[POST] /consulta_lote --> {\"codigos\": [...]} verifica los códigos de todo un vehículo y registra los ingresos en una transacción</h3>"
+        result += "<h3>[GET] /buscar?q=&campo=[nombre|empresa|actividad]&limit=&offset= --> busca permisos por nombre, empresa o actividad (por prefijo y tolerando errores de tipeo)</h3>"
         result += "<h3>[GET] /salida --> salida del programa</h3>"
         result += "<h3>[GET] /validaciones_empresa?limit=[]&offset=[] --> muestra los registros de la empresa en formato json</h3>"
+        result += "<h3>[GET] /validaciones_empresa?formato=[json|ndjson|csv]&limit=[]&cursor=[] --> exporta los registros por streaming, paginados por cursor</h3>"
         result += "<h3>[GET] /grafico_riesgo --> muestra gráfico respecto a cantidad de personas por riesgo</h3>"
+        result += "<h3>[GET] /grafico_riesgo?formato=[png|svg|json] --> mismo gráfico como SVG o como serie JSON</h3>"
+        result += "<h3>[GET] /estadisticas?desde=&hasta=&ventana=[dia|semana|mes]&intervalos=&graficos= --> datos de varios gráficos (riesgo, edades, empresa, actividad y por ventana de tiempo) en una respuesta</h3>"
+        result += "<h3>[GET] /sincronizacion/instantanea --> copia binaria de los permisos para verificar sin conexión en los puestos de control</h3>"
+        result += "<h3>[GET] /sincronizacion/delta?desde= --> permisos modificados y dados de baja después de una versión de la copia</h3>"
+        result += "<h3>[GET] /eventos?tabla=[validacion|ingresado] --> permisos nuevos e ingresos en vivo (Server-Sent Events, se retoma con Last-Event-ID)</h3>"
+        result += "<h3>[GET] /eventos/nuevos?desde=&espera=&tabla= --> los mismos eventos por long polling, en JSON</h3>"
+        result += "<h3>[GET] /estadisticas_cache --> aciertos y fallos de la cache de consultas por código y estado de la escritura diferida</h3>"
+        result += "<h3>[GET] /metrics --> métricas de latencia, consultas, conexiones y caches (formato Prometheus)</h3>"
+        result += "<h3>[POST] /analitica/exportar --> exporta a archivos columnares lo que cambió en validacion e ingresado</h3>"
+        result += "<h3>[GET] /analitica/ingresos_por_dia?desde=&hasta=&empresa= --> ingresos por empresa y día (sobre la exportación)</h3>"
+        result += "<h3>[GET] /analitica/riesgo_por_actividad --> permisos por actividad y riesgo (sobre la exportación)</h3>"
+        result += "<h3>[GET] /analitica/edades?intervalos= --> histograma y percentiles de edad (sobre la exportación)</h3>"
         result += "<h3>[GET] /registrar --> enlace para registro de usuario</h3>"
         result += "<h3>[POST] /registrar --> se obtienen los datos del formulario y se guardan en una BD</h3>"
         result += "<h3>[POST] /ingresar --> se verifica nombre de usuario y clave para ingreso a validación de la empresa</h3>"
@@ -78,90 +221,127 @@ def index():
         
         return(result)
     except:
-        return jsonify({'trace': traceback.format_exc()})
+        return error_trace()
 
-@app.route("/reset")
+@bp.route("/reset")
 def reset():
     try:
-        # Borrar y crear la base de datos
-        empresa_valida.create_schema()
-        empresa_valida.esquema()
-        empresa_valida.esquema_usuario()
+        # Aplicar las migraciones pendientes (ya no se borran los datos)
+        empresa_valida.migrar()
         return render_template('reset.html')
     except:
-        return jsonify({'trace': traceback.format_exc()})
+        return error_trace()
 
-@app.route("/menu.html")
+@bp.route("/menu.html")
 def menu():
     try:
         #Entrada principal con las acciones a realizar.
-        return render_template('menu.html')
+        return pagina_estatica('menu.html')
     except:
-        return jsonify({'trace': traceback.format_exc()})
+        return error_trace()
 
 
-@app.route("/empresa.html", methods= ['GET'])  #Colocar el nombre del archivo html para que funcionen los botones.
+@bp.route("/empresa.html", methods= ['GET'])  #Colocar el nombre del archivo html para que funcionen los botones.
 def registro_empresa():
     if request.method == 'GET':
         try:
             # Entrada a formulario de empresa por sesión.
-            return render_template('empresa.html')
+            return pagina_estatica('empresa.html')
         
         except:
-            return jsonify({'trace': traceback.format_exc()})
+            return error_trace()
 
 
-@app.route('/procesar', methods=['POST'])
+@bp.route('/procesar', methods=['POST'])
 def procesar():
     
     if request.method == 'POST':
         try:
             # Obtener del HTTP POST JSON de los datos registrados por la empresa
-            codigo = str(request.form.get('codigo'))
-            empresa= str(request.form.get('empresa')).upper()
-            actividad = str(request.form.get('actividad')).upper()
-            nombre = str(request.form.get('nombre')).upper()
-            dni = str(request.form.get('dni'))
-            edad = str(request.form.get('edad')) 
+            registro = empresa_valida.validar_registro(request.form)
             fecha_permiso = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-            riesgo = str(request.form.get('riesgo')).upper() 
- 
-
-            if(codigo is None or codigo.isdigit() is False or
-                empresa is None or empresa.isdigit() is True or
-                actividad is None or actividad.isdigit() is True or 
-                nombre is None or nombre.isdigit() is True or
-                riesgo is None or riesgo.isdigit() is True or
-                edad is None or edad.isdigit() is False or
-                dni is None or dni.isdigit() is False):
+
+            if registro is None:
                 # Datos ingresados incorrectos
                 return render_template('error_ingreso.html')
 
             else:
+                codigo, empresa, actividad, nombre, edad, dni, riesgo = registro
+
+                # Qué hacer si el código ya existe (rechazar, actualizar o conservar;
+                # por defecto el del config.ini) y clave de idempotencia del cliente
+                # para que un reintento no vuelva a escribir
+                modo = request.form.get('modo') or None
+                if modo is not None and modo not in empresa_valida.MODOS_REGISTRO:
+                    return render_template('error_ingreso.html'), 400
+                clave = request.headers.get('Idempotency-Key') or request.form.get('clave_idempotencia') or None
+
                 #Completando la BD con los datos del HTTP.
-                empresa_valida.insert(int(codigo), empresa, actividad, nombre, int(edad), int(dni), fecha_permiso, riesgo)
-                
+                resultado, repetido = empresa_valida.insert(codigo, empresa, actividad, nombre, edad, dni,
+                                                            fecha_permiso, riesgo, modo=modo, clave=clave)
+                if resultado == 'clave_en_uso':
+                    # La misma clave de idempotencia ya se usó con otro código
+                    return render_template('error_ingreso.html'), 422
+
                 #Se arma diccionario para pasar al archivo html.
                 datos = {"codigo":codigo, "empresa":empresa, "actividad":actividad, "nombre":nombre,
                         "edad":edad, "dni":dni, "fecha_permiso":fecha_permiso, "riesgo":riesgo}
 
-                #Se informa a través de un archivo html en formato tabla los datos ingresados.        
-                return render_template('procesado.html', datos=datos)
+                # Si no se guardó lo enviado (o es un reintento) se muestra lo que quedó en la BD
+                if repetido is True or resultado not in ('insertado', 'actualizado'):
+                    filas = empresa_valida.consulta(codigo)
+                    if filas:
+                        datos = dict(zip(("codigo", "empresa", "actividad", "nombre", "edad", "dni",
+                                          "fecha_permiso", "riesgo"), filas[0]))
+
+                #Se informa a través de un archivo html en formato tabla los datos ingresados.
+                # Un código repetido en modo rechazar responde 409.
+                estado = 409 if resultado == 'duplicado' else 200
+                response = make_response(render_template('procesado.html', datos=datos, resultado=resultado), estado)
+                response.headers['X-Resultado-Registro'] = resultado
+                if repetido is True:
+                    response.headers['Idempotent-Replayed'] = 'true'
+                return response
+
+        except:
+            return error_trace()
+
+@bp.route('/procesar_lote', methods=['POST'])
+def procesar_lote():
+
+    if request.method == 'POST':
+        try:
+            # Obtener los registros del lote, como lista JSON o como archivo CSV
+            # (con las mismas columnas que el formulario de empresa.html)
+            if request.is_json:
+                filas = request.get_json()
+                if not isinstance(filas, list):
+                    return jsonify({'error': 'Se esperaba una lista de registros'}), 400
+            else:
+                archivo = request.files.get('archivo')
+                if archivo is not None:
+                    texto = io.TextIOWrapper(archivo.stream, encoding='utf-8-sig')
+                else:
+                    texto = io.StringIO(request.get_data(as_text=True))
+                filas = csv.DictReader(texto)
+
+            #Se validan e insertan todos los registros en una sola transacción.
+            return jsonify(empresa_valida.registrar_lote(filas))
 
         except:
-            return jsonify({'trace': traceback.format_exc()})
+            return error_trace()
 
-@app.route("/validar_datos.html", methods= ['GET'])
+@bp.route("/validar_datos.html", methods= ['GET'])
 def validar_datos():
     try:
         #Llamado del archivo html para ingresar código de circulación para
         #verificación de los registros realizados por la empresa.
-        return render_template('validar_datos.html')
+        return pagina_estatica('validar_datos.html')
     except:
-        return jsonify({'trace': traceback.format_exc()})
+        return error_trace()
 
 
-@app.route("/consulta", methods= ['POST'])
+@bp.route("/consulta", methods= ['POST'])
 def consulta():
 
     if request.method == 'POST':
@@ -169,83 +349,377 @@ def consulta():
             #Se obtiene los datos del formulario (el código de permiso)
             code = str(request.form.get('codigo'))
             
-            #Del módulo empresa_valida se usa la función consulta, que busca los datos
-            #que corresponden al código.
-            datos = empresa_valida.consulta(code)
+            #Del módulo empresa_valida se usa la función registrar_ingreso, que busca los datos
+            #que corresponden al código y registra el ingreso en la tabla ingresado.
+            datos = empresa_valida.registrar_ingreso(code)
             
             #Acá se verifica si no hay datos con el código ingresado, devuelve un archivo
             #html con la información no encontrada.
             if datos == []:
-                return render_template('sin_registros.html')
+                return pagina_estatica('sin_registros.html')
+
+            elif empresa_valida.vencido(datos[0]):
+                # El permiso existe pero ya venció: no se registró el ingreso
+                return render_template('permiso_vencido.html', datos=datos), 403
 
             else:
-                #Se separa los datos para insertarlos en la BD de ingresado.   
-                codigo = datos[0][0]
-                empresa= datos[0][1]
-                actividad = datos[0][2]
-                nombre = datos[0][3]
-                edad = datos[0][4]
-                dni = datos[0][5]
-                fecha_permiso = datos[0][6]
-                riesgo = datos[0][7]                 
-
-                #Se usa el módulo empresa_valida con la función fill y completar la tabla de la BD ingresado
-                empresa_valida.fill(codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo)  
-                
                 #Retorna un archivo consulta.html con los resultados obtenidos.
                 return render_template('consulta.html', datos=datos)
             
         except:
-            return jsonify({'trace': traceback.format_exc()})
+            return error_trace()
+
+@bp.route("/consulta_lote", methods= ['POST'])
+def consulta_lote():
+
+    try:
+        # JSON con la lista de códigos de los pasajeros de un vehículo:
+        # {"codigos": [111, 222, ...]} o directamente [111, 222, ...]
+        cuerpo = request.get_json(silent=True)
+        codigos = cuerpo.get('codigos') if isinstance(cuerpo, dict) else cuerpo
+        if not isinstance(codigos, list):
+            return jsonify({'error': 'se esperaba una lista de códigos'}), 400
+        if len(codigos) > empresa_valida.MAX_CODIGOS_LOTE:
+            return jsonify({'error': 'se admiten hasta {} códigos por pedido'.format(
+                empresa_valida.MAX_CODIGOS_LOTE)}), 400
+
+        # Una consulta para todos los códigos y un solo commit para todos los ingresos
+        return jsonify(empresa_valida.verificar_lote(codigos))
 
-@app.route("/salida.html", methods= ['GET'])
+    except:
+        return error_trace()
+
+@bp.route("/buscar", methods= ['GET'])
+def buscar():
+
+    try:
+        # Búsqueda por nombre, empresa o actividad cuando no se tiene el código:
+        # /buscar?q=maria gonzalez&campo=nombre&limit=20&offset=0
+        texto = request.args.get('q', '')
+        campo = request.args.get('campo') or None
+        if campo is not None and campo not in empresa_valida.CAMPOS_BUSQUEDA:
+            return jsonify({'error': 'campo debe ser uno de {}'.format(', '.join(empresa_valida.CAMPOS_BUSQUEDA))}), 400
+
+        limit = request.args.get('limit', default=20, type=int)
+        offset = request.args.get('offset', default=0, type=int)
+        return jsonify(empresa_valida.buscar(texto, campo=campo, limit=limit, offset=offset))
+
+    except:
+        return error_trace()
+
+@bp.route("/salida.html", methods= ['GET'])
 def salir():
     try:
         # Retorna un archivo html informando la salida del programa.
-        return render_template('salida.html')
+        return pagina_estatica('salida.html')
     except:
-        return jsonify({'trace': traceback.format_exc()})
+        return error_trace()
 
-@app.route("/validaciones_empresa")
+@bp.route("/validaciones_empresa")
 def pulsaciones_tabla():
     try:
-        # Mostrar todos los registros en formato Json
-        result = show()
+        # Mostrar todos los registros en formato Json (o ndjson/csv por streaming)
+        result = show(str(request.args.get('formato', 'json')).lower())
         return (result)
     except:
-        return jsonify({'trace': traceback.format_exc()})
+        return error_trace()
 
-@app.route("/grafico_riesgo", methods= ['GET'])
+@bp.route("/grafico_riesgo", methods= ['GET'])
 def grafico_registrados():
-    
+
     try:
-        #Del módulo empresa_valida se usa la función grafico que trae los 
+        # Formato del gráfico: png (por defecto), svg o json para dibujar en el cliente
+        formato = str(request.args.get('formato', 'png')).lower()
+        if formato not in graficos.MIMETYPES:
+            return jsonify({'error': 'formato desconocido: {}'.format(formato)}), 400
+
+        #Del módulo empresa_valida se usa la función grafico que trae los
         #datos riesgos y cantidad_personas para el gráfico.
         riesgos, cantidad_personas = empresa_valida.grafico()
-        
-        fig = plt.figure(figsize=(16, 9))
-        fig.suptitle('"Cantidad de personas por riesgo"', fontsize=18)
-        ax = fig.add_subplot()
-    
-        ax.bar(riesgos, cantidad_personas,  label='N° de riesgos', color='darkgreen')
-        ax.set_facecolor('mintcream')
-        ax.set_xlabel('Riesgos', fontsize=15)
-        ax.set_ylabel('N° personas', fontsize=15)
-        ax.yaxis.set_major_locator(MaxNLocator(integer=True)) #para redondear los valores en el eje y
-        ax.legend()
-        ax.get_xaxis().set_visible(True)
-
-        # Convertir ese grafico en una imagen para enviar por HTTP
-        # y mostrar en el HTML
-        output = io.BytesIO()
-        FigureCanvas(fig).print_png(output)
-        plt.close(fig)  # Cerramos la imagen para que no consuma memoria del sistema
-        return Response(output.getvalue(), mimetype='image/png')
-       
+
+        # El ETag identifica los conteos, si no cambiaron se reutiliza el gráfico
+        # ya generado (o se responde 304 si el cliente ya lo tiene).
+        etag = hashlib.sha1(repr((formato, riesgos, cantidad_personas)).encode()).hexdigest()
+
+        with grafico_lock:
+            guardado = grafico_cache.get(formato)
+            if guardado is None or guardado[0] != etag:
+                guardado = (etag, graficos.generar(formato, riesgos, cantidad_personas))
+                grafico_cache[formato] = guardado
+            contenido = guardado[1]
+
+        response = Response(contenido, mimetype=graficos.MIMETYPES[formato])
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
     except:
-        return jsonify({'trace': traceback.format_exc()})
+        return error_trace()
+
+@bp.route("/estadisticas", methods= ['GET'])
+def estadisticas():
 
-@app.route("/registrar", methods=['GET', 'POST'])
+    try:
+        analitica = modulo_analitica()
+        # Rango de fecha_permiso (ISO) y gráficos pedidos, por defecto todos
+        desde = request.args.get('desde')
+        hasta = request.args.get('hasta')
+        ventana = str(request.args.get('ventana', 'dia')).lower()
+        if ventana not in analitica.VENTANAS:
+            return jsonify({'error': 'ventana desconocida: {}'.format(ventana)}), 400
+
+        intervalos = empresa_valida.leer_entero(request.args.get('intervalos'))
+        intervalos = min(intervalos, 100) if intervalos else 10
+
+        pedidos = request.args.get('graficos')
+        graficos_pedidos = tuple(pedidos.split(',')) if pedidos else analitica.GRAFICOS
+        desconocidos = [nombre for nombre in graficos_pedidos if nombre not in analitica.GRAFICOS]
+        if desconocidos:
+            return jsonify({'error': 'gráficos desconocidos: {}'.format(', '.join(desconocidos))}), 400
+
+        # Si los permisos no cambiaron se reutiliza el resultado anterior (los
+        # ingresos de los puestos de control no cambian la versión)
+        parametros = (desde, hasta, ventana, intervalos, graficos_pedidos)
+        version = empresa_valida.version_permisos()
+        encontrado, resultado = resumen_cache.get((parametros, version))
+        if encontrado is False:
+            # Una sola consulta trae las columnas, NumPy hace todos los conteos.
+            # Los datos son al menos de la versión buscada (de la réplica si
+            # ya la tiene), así el resultado se guarda con la misma clave.
+            _, columnas = empresa_valida.columnas_estadisticas(desde=desde, hasta=hasta, version_minima=version)
+            resultado = analitica.resumen(columnas, graficos=graficos_pedidos,
+                                          intervalos=intervalos, ventana=ventana)
+            resultado['version'] = version
+            resumen_cache.put((parametros, version), resultado)
+
+        response = jsonify(resultado)
+        response.set_etag(hashlib.sha1(repr((parametros, resultado['version'])).encode()).hexdigest())
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+    except:
+        return error_trace()
+
+@bp.route("/sincronizacion/instantanea", methods= ['GET'])
+def sincronizacion_instantanea():
+
+    try:
+        # Copia de todos los permisos para verificar sin conexión (ver
+        # instantanea.py). Se arma una vez por versión de los permisos; un
+        # puesto que ya la tiene recibe un 304 por el ETag.
+        version = empresa_valida.version_permisos()
+        encontrado, recurso = instantanea_cache.get(version)
+        if encontrado is False:
+            version, filas = empresa_valida.instantanea_permisos()
+            # Solo gzip y con nivel medio: brotli tarda demasiado con archivos grandes
+            recurso = estaticos.Recurso(instantanea.armar(version, filas), 'application/octet-stream',
+                                        0, instantanea.NIVEL_GZIP, comprimir=('gzip',))
+            instantanea_cache.put(version, recurso)
+
+        response = recurso.respuesta()
+        response.headers['X-Version-Datos'] = str(version)
+        return response
+
+    except:
+        return error_trace()
+
+@bp.route("/sincronizacion/delta", methods= ['GET'])
+def sincronizacion_delta():
+
+    try:
+        # Permisos que cambiaron después de la versión que tiene el puesto
+        desde = empresa_valida.leer_entero(request.args.get('desde'))
+        if desde is None:
+            return jsonify({'error': 'se esperaba desde=<versión de la copia local>'}), 400
+
+        maximo = int(current_app.config['SINCRONIZACION'].get('maximo_delta', 5000))
+        cambios = empresa_valida.cambios_permisos(desde, maximo=maximo)
+        if cambios is None:
+            # Hay que descargar la instantánea completa
+            return jsonify({'error': 'la versión {} no se puede actualizar, descargar '
+                                     '/sincronizacion/instantanea'.format(desde)}), 410
+
+        version, filas, bajas = cambios
+        return jsonify({"desde": desde, "version": version,
+                        "permisos": [dict(zip(instantanea.COLUMNAS, fila)) for fila in filas],
+                        "bajas": bajas})
+
+    except:
+        return error_trace()
+
+@bp.route("/eventos", methods= ['GET'])
+def eventos_en_vivo():
+
+    try:
+        # Canal de eventos para los tableros (EventSource del navegador). Al
+        # reconectarse el navegador manda Last-Event-ID y recibe lo que se perdió.
+        params = current_app.config['EVENTOS']
+        desde = eventos.leer_desde(request.headers.get('Last-Event-ID') or request.args.get('desde'))
+        try:
+            tablas = eventos.leer_tablas(request.args.get('tabla'), empresa_valida.COLUMNAS_EVENTO)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        try:
+            suscripcion = current_app.extensions['eventos'].suscribir(desde, tablas)
+        except eventos.SinLugar as e:
+            return jsonify({'error': str(e), 'usar': '/api/eventos'}), 503, {'Retry-After': '30'}
+
+        latido = float(params.get('latido', eventos.LATIDO))
+        duracion = float(params.get('duracion', eventos.DURACION))
+
+        def generar():
+            # Cada conexión ocupa un thread del worker: se cierra a los
+            # duracion segundos y el navegador se reconecta solo, desde el
+            # último evento
+            fin = time.monotonic() + duracion
+            yield 'retry: {}\n\n'.format(eventos.REINTENTO_MS)
+            while True:
+                restante = fin - time.monotonic()
+                if restante <= 0:
+                    break
+                evento = suscripcion.siguiente(min(latido, restante))
+                if evento is eventos.FIN:
+                    break
+                # Sin eventos: un comentario para que los proxies no corten la conexión
+                yield eventos.formato_sse(evento) if evento else ': latido\n\n'
+
+        response = Response(generar(), mimetype='text/event-stream')
+        # La suscripción se cancela al cerrar la respuesta, aunque el cliente
+        # se haya desconectado antes de empezar a leerla
+        response.call_on_close(suscripcion.cancelar)
+        response.headers['Cache-Control'] = 'no-cache'
+        # Que nginx no acumule la respuesta
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    except:
+        return error_trace()
+
+@bp.route("/eventos/nuevos", methods= ['GET'])
+def eventos_nuevos():
+
+    try:
+        # Long polling, para los clientes que no pueden usar /eventos: espera
+        # hasta espera segundos el primer evento posterior a desde y retorna
+        # los que haya en ese momento. El cliente vuelve a pedir con desde=ultimo.
+        desde = eventos.leer_desde(request.args.get('desde'))
+        espera = request.args.get('espera', 25, type=float)
+        if not math.isfinite(espera):
+            return jsonify({'error': 'espera debe ser una cantidad de segundos'}), 400
+        espera = min(max(espera, 0), eventos.LATIDO * 2)
+        try:
+            tablas = eventos.leer_tablas(request.args.get('tabla'), empresa_valida.COLUMNAS_EVENTO)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        try:
+            suscripcion = current_app.extensions['eventos'].suscribir(desde, tablas)
+        except eventos.SinLugar as e:
+            return jsonify({'error': str(e), 'usar': '/api/eventos'}), 503, {'Retry-After': '30'}
+
+        nuevos = []
+        try:
+            evento = suscripcion.siguiente(espera)
+            while evento:
+                nuevos.append(evento)
+                evento = suscripcion.siguiente(0)
+        finally:
+            suscripcion.cancelar()
+
+        return jsonify({"desde": desde, "ultimo": suscripcion.ultimo, "eventos": nuevos})
+
+    except:
+        return error_trace()
+
+@bp.route("/estadisticas_cache", methods= ['GET'])
+def estadisticas_cache():
+    try:
+        # Aciertos y fallos de las caches de consulta(), para dimensionarlas
+        return jsonify({"validacion": empresa_valida.cache_validacion.estadisticas(),
+                        "ingreso": empresa_valida.cache_ingreso.estadisticas(),
+                        "sesiones": empresa_valida.cache_sesiones.estadisticas(),
+                        "estaticos": current_app.extensions['estaticos'].estadisticas(),
+                        "estadisticas": resumen_cache.estadisticas(),
+                        "vocabulario": empresa_valida.cache_vocabulario.estadisticas(),
+                        "replica": (empresa_valida.lector_replica.estado()
+                                    if empresa_valida.lector_replica is not None else None),
+                        "instantanea": instantanea_cache.estadisticas(),
+                        "eventos": current_app.extensions['eventos'].estadisticas(),
+                        "escritura_ingreso": empresa_valida.escritor_ingreso.estadisticas()})
+    except:
+        return error_trace()
+
+@bp.route("/metrics", methods= ['GET'])
+def metrics():
+    try:
+        # Valores del momento: conexiones de los pools (sumadas por rol, la
+        # base principal o las réplicas), caches y escritura diferida
+        medidas = {}
+        for pool in list(conexion.pools.values()):
+            etiquetas = (('rol', pool.rol),)
+            libres = pool.libres.qsize()
+            for nombre, valor in (('sqlite_conexiones', pool.creadas), ('sqlite_conexiones_libres', libres),
+                                  ('sqlite_conexiones_en_uso', pool.creadas - libres)):
+                medidas[(nombre, etiquetas)] = medidas.get((nombre, etiquetas), 0) + valor
+
+        caches = {'validacion': empresa_valida.cache_validacion, 'ingreso': empresa_valida.cache_ingreso,
+                  'sesiones': empresa_valida.cache_sesiones}
+        for nombre, cache in caches.items():
+            etiquetas = (('cache', nombre),)
+            for clave, valor in cache.estadisticas().items():
+                medidas[('cache_' + clave, etiquetas)] = valor
+
+        for clave, valor in empresa_valida.escritor_ingreso.estadisticas().items():
+            medidas[('escritura_ingreso_' + clave, ())] = valor
+
+        for clave, valor in current_app.extensions['eventos'].estadisticas().items():
+            medidas[('eventos_' + clave, ())] = valor
+
+        return Response(metricas.prometheus(medidas), mimetype='text/plain; version=0.0.4')
+    except:
+        return error_trace()
+
+@bp.route("/analitica/exportar", methods= ['POST'])
+def analitica_exportar():
+    try:
+        analitica = modulo_analitica()
+        # Exportación incremental para los reportes (también: python analitica.py)
+        try:
+            exportadas = analitica.exportar()
+        except analitica.ExportacionEnCurso as e:
+            return jsonify({'error': str(e)}), 409
+        return jsonify({"exportadas": exportadas, "estado": analitica.estado()})
+    except:
+        return error_trace()
+
+@bp.route("/analitica/ingresos_por_dia", methods= ['GET'])
+def analitica_ingresos_por_dia():
+    try:
+        analitica = modulo_analitica()
+        # Los reportes se calculan sobre la última exportación, no sobre la BD
+        return jsonify(analitica.ingresos_por_dia(desde=request.args.get('desde'),
+                                                  hasta=request.args.get('hasta'),
+                                                  empresa=request.args.get('empresa')))
+    except:
+        return error_trace()
+
+@bp.route("/analitica/riesgo_por_actividad", methods= ['GET'])
+def analitica_riesgo_por_actividad():
+    try:
+        analitica = modulo_analitica()
+        return jsonify(analitica.riesgo_por_actividad())
+    except:
+        return error_trace()
+
+@bp.route("/analitica/edades", methods= ['GET'])
+def analitica_edades():
+    try:
+        analitica = modulo_analitica()
+        intervalos = empresa_valida.leer_entero(request.args.get('intervalos')) or 10
+        return jsonify(analitica.edades(intervalos=min(intervalos, 100)))
+    except:
+        return error_trace()
+
+@bp.route("/registrar", methods=['GET', 'POST'])
 def registrar_usuario():
     if request.method == 'GET':
         
@@ -255,7 +729,7 @@ def registrar_usuario():
             return render_template('login_prueba.html')                  
     
         except:
-            return jsonify({'trace': traceback.format_exc()})
+            return error_trace()
         
     if request.method == 'POST':  
           
@@ -269,59 +743,73 @@ def registrar_usuario():
                 # Datos ingresados incorrectos
                 return render_template('error_enter.html')
             
-            empresa_valida.fill_usuario(correo, clave, nombre) #completa tabla de BD con usuarios
+            #completa tabla de BD con usuarios, con el hash de la clave
+            if empresa_valida.fill_usuario(correo, clave, nombre) is False:
+                # El nombre de usuario ya está registrado
+                return render_template('error_enter.html')
 
-            #Registra la sesión
-            session['name'] = nombre
-            session['password'] = clave
-            print(session)
             #Devuelve el html de login_prueba para ingresar el usuario y clave registrado.
             return render_template('login_prueba.html')
 
         except:
-            return jsonify({'trace': traceback.format_exc()})         
+            return error_trace()         
 
-@app.route("/ingresar", methods=['POST'])
+@bp.route("/ingresar", methods=['POST'])
 def ingresar():
     #Acá se recibe el ingreso del usuario una vez tenido su usuario y clave.
     if request.method == 'POST':  
         try:           
-            #Procedimiento para verificar si usuario y clave están guardados en session
+            #Procedimiento para verificar el usuario y clave guardados en la BD de usuarios
             nombre_login = str(request.form.get('name_login'))
             clave_login= str(request.form.get('password_login'))
 
-            #Si la clave y nombre de usuario ingresados por formulario son iguales a los guardados
-            # en la sesión retorna el formulario a completar por la empresa. 
-            if session['password'] == clave_login and session['name'] == nombre_login and 'name' in session and 'password' in session:
+            usuario_id = empresa_valida.login_usuario(nombre_login, clave_login)
+
+            #Si la clave y nombre de usuario son correctos se inicia la sesión (en la
+            # cookie queda solo el token) y se retorna el formulario a completar por la empresa.
+            if usuario_id is not None:
+                session.clear()
+                session['token'] = empresa_valida.crear_sesion(usuario_id)
                 return render_template('empresa.html', nombre_login=nombre_login)
             else:
                 #Informa en caso no esté registrado.
                 return render_template('error_ingreso.html')
                 
         except:
-            return jsonify({'trace': traceback.format_exc()})
+            return error_trace()
+
+
+def usuario_actual():
+    # Usuario de la sesión iniciada en /ingresar, o None si no hay sesión vigente
+    return empresa_valida.sesion_usuario(session.get('token'))
 
 
-@app.route("/new_registro", methods=['GET'])
+@bp.route("/new_registro", methods=['GET'])
 def new_registro():
 
     #Función para validar por parte de la empresa otro empleado.
     if request.method == 'GET':
         
         try:  
-            return render_template('empresa.html')
+            usuario = usuario_actual()
+            if usuario is None:
+                # Sin sesión vigente se vuelve al login
+                return redirect(url_for('permisos.registrar_usuario'))
+
+            return render_template('empresa.html', nombre_login=usuario['nombre'])
             
         except:
-            return jsonify({'trace': traceback.format_exc()})
+            return error_trace()
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     try:
         # Borrar y cerrar la sesion
+        empresa_valida.cerrar_sesion(session.get('token'))
         session.clear()
-        return render_template('salida.html')
+        return pagina_estatica('salida.html')
     except:
-        return jsonify({'trace': traceback.format_exc()})
+        return error_trace()
 
 
 def show(show_type='json'):
@@ -329,24 +817,74 @@ def show(show_type='json'):
     # Obtener de la query string los valores de limit y offset
     limit_str = str(request.args.get('limit'))
     offset_str = str(request.args.get('offset'))
+    cursor_str = request.args.get('cursor')
 
-    limit = 0
-    offset = 0
-
-    if(limit_str is not None) and (limit_str.isdigit()):
-        limit = int(limit_str)
+    # Sin limit u offset válidos se usa 0 (todos, desde el principio)
+    limit = empresa_valida.leer_entero(limit_str) or 0
+    offset = empresa_valida.leer_entero(offset_str) or 0
 
-    if(offset_str is not None) and (offset_str.isdigit()):
-        offset = int(offset_str)
+    # El formato se valida antes de consultar la BD
+    if show_type not in ('json', 'ndjson', 'csv'):
+        return jsonify({'error': 'formato desconocido: {}'.format(show_type)}), 400
 
-    if show_type == 'json':
+    if show_type == 'json' and cursor_str is None:
         data = empresa_valida.report(limit=limit, offset=offset, dict_format=True)
         return jsonify(data)
 
+    # Paginación por cursor: se continúa desde el último codigo de la página anterior
+    despues_de = None
+    if cursor_str:
+        despues_de = empresa_valida.leer_cursor(cursor_str)
+        if despues_de is None:
+            return jsonify({'error': 'cursor inválido'}), 400
+
+    headers = {}
+    siguiente = empresa_valida.ultimo_codigo(despues_de=despues_de, limit=limit)
+    if siguiente is not None:
+        headers['X-Siguiente-Cursor'] = empresa_valida.crear_cursor(siguiente)
+
+    if show_type == 'json':
+        data = list(empresa_valida.report_stream(despues_de=despues_de, limit=limit, dict_format=True))
+        return jsonify(data), 200, headers
+
+    filas = empresa_valida.report_stream(despues_de=despues_de, limit=limit, dict_format=True)
+
+    if show_type == 'ndjson':
+        return Response(ndjson_stream(filas), mimetype='application/x-ndjson', headers=headers)
+
+    headers['Content-Disposition'] = 'attachment; filename=validaciones_empresa.csv'
+    return Response(csv_stream(filas), mimetype='text/csv', headers=headers)
+
+
+def ndjson_stream(filas):
+    # Un objeto JSON por línea, se envía a medida que se leen de la BD
+    for fila in filas:
+        yield json.dumps(fila, ensure_ascii=False) + '\n'
+
+
+def csv_stream(filas, bloque=500):
+    # Se arma el CSV de a bloques para no enviar una línea por vez
+    columnas = ['codigo', 'empresa', 'actividad', 'nombre', 'edad', 'dni', 'fecha_permiso', 'riesgo']
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columnas)
+    writer.writeheader()
+    for numero, fila in enumerate(filas, start=1):
+        writer.writerow(fila)
+        if numero % bloque == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# App por defecto, para "python app.py" o "flask --app app run".
+# En producción usar servidor.py (varios procesos y threads).
+app = create_app()
+
 
 if __name__ == '__main__':
     print('Proyecto desarrollador python!')
-    #Lanzar server
+    #Lanzar server de desarrollo
     app.run(host=server['host'],
             port=server['port'],
             debug=True)
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+'''
+Benchmark de la app
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Mide la velocidad de las funciones de empresa_valida y de los endpoints
+/procesar, /consulta, /validaciones_empresa y /grafico_riesgo, primero con
+el cliente de prueba de Flask y después con pedidos HTTP concurrentes.
+Trabaja sobre una copia temporal de las bases cargada con empresas y
+empleados sintéticos, y reporta latencias p50/p95/p99 y pedidos por
+segundo en formato JSON para comparar entre versiones.
+
+Con --arranque mide en cambio cuánto tarda un proceso nuevo en importar
+app.py (lo que paga cada worker y cada corrida de pruebas), con el
+detalle de python -X importtime: los módulos que más tardan en cargarse.
+
+Uso:
+    python benchmark.py --filas 10000 --salida bench.json
+    python benchmark.py --filas 1000000 --concurrencia 32 --duracion 20
+    python benchmark.py --arranque
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+
+ACTIVIDADES = ['SALUD', 'TRANSPORTE', 'COMERCIO', 'CONSTRUCCION', 'PESCA', 'SEGURIDAD', 'EDUCACION']
+RIESGOS = ['SIN RIESGOS', 'DIABETES', 'HIPERTENSION', 'ASMA', 'MAYOR DE 60']
+NOMBRES = ['SILVA', 'GOMEZ', 'RODRIGUEZ', 'FERNANDEZ', 'LOPEZ', 'DIAZ', 'MARTINEZ', 'PEREZ', 'GARCIA', 'SOSA']
+PILA = ['JUAN', 'ANA', 'LUIS', 'MARIA', 'JOSE', 'LAURA', 'CARLOS', 'SOFIA', 'PABLO', 'LUCIA']
+
+
+def percentiles(tiempos, total_segundos=None):
+
+    # Resumen de una lista de latencias en segundos (en milisegundos)
+    if not tiempos:
+        return {"n": 0}
+    ordenados = sorted(tiempos)
+    n = len(ordenados)
+
+    def p(q):
+        return round(ordenados[min(n - 1, int(q * n))] * 1000, 3)
+
+    total = total_segundos if total_segundos is not None else sum(ordenados)
+    return {
+        "n": n,
+        "p50_ms": p(0.50),
+        "p95_ms": p(0.95),
+        "p99_ms": p(0.99),
+        "max_ms": round(ordenados[-1] * 1000, 3),
+        "media_ms": round(sum(ordenados) / n * 1000, 3),
+        "rps": round(n / total, 1) if total > 0 else None,
+    }
+
+
+def medir(funcion, repeticiones):
+
+    # Ejecuta funcion(i) repeticiones veces y retorna el resumen de latencias
+    tiempos = []
+    inicio = time.perf_counter()
+    for i in range(repeticiones):
+        t = time.perf_counter()
+        funcion(i)
+        tiempos.append(time.perf_counter() - t)
+    return percentiles(tiempos, time.perf_counter() - inicio)
+
+
+def fila_sintetica(azar, codigo, empresas, fecha_base):
+    empresa = 'EMPRESA {}'.format(azar.randrange(empresas))
+    nombre = '{} {}'.format(azar.choice(NOMBRES), azar.choice(PILA))
+    fecha = fecha_base + timedelta(seconds=azar.randrange(365 * 24 * 3600))
+    return (codigo, empresa, azar.choice(ACTIVIDADES), nombre, azar.randrange(18, 80),
+            azar.randrange(10000000, 50000000), fecha.strftime("%Y-%m-%d %H:%M:%S.%f"), azar.choice(RIESGOS))
+
+
+def cargar(empresa_valida, filas, empresas, semilla, bloque=50000):
+
+    # Carga validacion con filas sintéticas, en transacciones de a bloques.
+    # Los códigos van de 1 a filas.
+    azar = random.Random(semilla)
+    fecha_base = datetime(2020, 1, 1)
+    with empresa_valida.conectar(empresa_valida.db['database']) as conn:
+        for desde in range(1, filas + 1, bloque):
+            hasta = min(desde + bloque, filas + 1)
+            conn.executemany("""
+                INSERT INTO validacion (codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo)
+                VALUES (?,?,?,?,?,?,?,?);""",
+                (fila_sintetica(azar, codigo, empresas, fecha_base) for codigo in range(desde, hasta)))
+            conn.commit()
+
+
+def bench_funciones(empresa_valida, filas, repeticiones, semilla):
+
+    azar = random.Random(semilla)
+    codigos = [azar.randrange(1, filas + 1) for _ in range(repeticiones)]
+    resultados = {}
+
+    # Sin cache: se limpia antes de cada consulta para medir SQLite
+    def consulta_sin_cache(i):
+        empresa_valida.cache_validacion.limpiar()
+        empresa_valida.consulta(codigos[i])
+    resultados["consulta_sin_cache"] = medir(consulta_sin_cache, repeticiones)
+
+    # Con cache: los mismos códigos que ya se consultaron una vez
+    resultados["consulta_con_cache"] = medir(lambda i: empresa_valida.consulta(codigos[i]), repeticiones)
+
+    resultados["verifica"] = medir(lambda i: empresa_valida.verifica(codigos[i]), repeticiones)
+
+    fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+    resultados["insert"] = medir(
+        lambda i: empresa_valida.insert(filas + 1 + i, 'EMPRESA BENCH', 'SALUD', 'BENCH', 30, 1, fecha, 'SIN RIESGOS'),
+        repeticiones)
+
+    lote = [fila_sintetica(azar, filas + repeticiones + 1 + i, 10, datetime(2020, 1, 1)) for i in range(1000)]
+    resultados["insert_lote_1000"] = medir(lambda i: empresa_valida.insert_lote(lote), 1)
+
+    resultados["report_100"] = medir(lambda i: empresa_valida.report(limit=100, dict_format=True), repeticiones)
+    resultados["grafico"] = medir(lambda i: empresa_valida.grafico(), repeticiones)
+
+    return resultados
+
+
+def bench_test_client(app, filas, repeticiones, semilla):
+
+    azar = random.Random(semilla + 1)
+    cliente = app.test_client()
+    resultados = {}
+
+    # Códigos nuevos, después de los que usó bench_funciones
+    codigo_inicial = filas + repeticiones + 1001
+
+    def procesar(i):
+        cliente.post('/procesar', data={
+            'codigo': str(codigo_inicial + i), 'empresa': 'empresa bench', 'actividad': 'salud',
+            'nombre': 'bench', 'dni': '30111222', 'edad': '40', 'riesgo': 'sin riesgos'})
+    resultados["POST /procesar"] = medir(procesar, repeticiones)
+
+    resultados["POST /consulta"] = medir(
+        lambda i: cliente.post('/consulta', data={'codigo': str(azar.randrange(1, filas + 1))}), repeticiones)
+
+    resultados["GET /validaciones_empresa?limit=100"] = medir(
+        lambda i: cliente.get('/validaciones_empresa?limit=100'), repeticiones)
+
+    resultados["GET /validaciones_empresa?formato=ndjson&limit=1000"] = medir(
+        lambda i: cliente.get('/validaciones_empresa?formato=ndjson&limit=1000').get_data(), repeticiones)
+
+    for formato in ('png', 'svg', 'json'):
+        resultados["GET /grafico_riesgo?formato={}".format(formato)] = medir(
+            lambda i: cliente.get('/grafico_riesgo?formato={}'.format(formato)), repeticiones)
+
+    return resultados
+
+
+def levantar_servidor(app):
+
+    # Servidor WSGI multi-hilo en un puerto libre, en segundo plano.
+    # Se silencia el log por pedido para que no pese en la medición.
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    class Handler(WSGIRequestHandler):
+        # HTTP/1.1 para que los clientes reutilicen la conexión (keep-alive)
+        protocol_version = 'HTTP/1.1'
+
+    servidor = make_server('127.0.0.1', 0, app, threaded=True, request_handler=Handler)
+    hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo.start()
+    return servidor
+
+
+def bench_http(app, filas, concurrencia, duracion, semilla):
+
+    servidor = levantar_servidor(app)
+    host, port = servidor.server_address[:2]
+
+    pedidos = {
+        "POST /consulta": lambda azar: ('POST', '/consulta',
+                                        urlencode({'codigo': azar.randrange(1, filas + 1)})),
+        "GET /validaciones_empresa?limit=100": lambda azar: ('GET', '/validaciones_empresa?limit=100', None),
+        "GET /grafico_riesgo?formato=svg": lambda azar: ('GET', '/grafico_riesgo?formato=svg', None),
+    }
+
+    resultados = {}
+    try:
+        for nombre, armar in pedidos.items():
+            fin = time.monotonic() + duracion
+
+            def cliente(numero):
+                # Cada hilo usa su propia conexión HTTP keep-alive
+                azar = random.Random(semilla + numero)
+                conn = http.client.HTTPConnection(host, port, timeout=30)
+                tiempos, errores = [], 0
+                while time.monotonic() < fin:
+                    metodo, url, cuerpo = armar(azar)
+                    headers = {'Content-Type': 'application/x-www-form-urlencoded'} if cuerpo else {}
+                    t = time.perf_counter()
+                    try:
+                        conn.request(metodo, url, body=cuerpo, headers=headers)
+                        respuesta = conn.getresponse()
+                        respuesta.read()
+                        if respuesta.status >= 400:
+                            errores += 1
+                    except (OSError, http.client.HTTPException):
+                        errores += 1
+                        conn.close()
+                        conn = http.client.HTTPConnection(host, port, timeout=30)
+                        continue
+                    tiempos.append(time.perf_counter() - t)
+                conn.close()
+                return tiempos, errores
+
+            inicio = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrencia) as executor:
+                partes = list(executor.map(cliente, range(concurrencia)))
+            total = time.perf_counter() - inicio
+
+            tiempos = [t for parte in partes for t in parte[0]]
+            resultados[nombre] = percentiles(tiempos, total)
+            resultados[nombre]["errores"] = sum(parte[1] for parte in partes)
+            resultados[nombre]["concurrencia"] = concurrencia
+    finally:
+        servidor.shutdown()
+
+    return resultados
+
+
+# Línea de python -X importtime: "import time: self [us] | cumulative | módulo"
+IMPORTTIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+
+# Código que corre en un proceso nuevo: importa app y mide el tiempo total
+ARRANQUE = (
+    "import time\n"
+    "t = time.perf_counter()\n"
+    "import app\n"
+    "print(time.perf_counter() - t)\n"
+)
+
+
+def bench_arranque(repeticiones, modulos=15):
+
+    # Importa app.py en procesos nuevos (con las bases en un directorio
+    # temporal) y reporta la mediana del tiempo total y, de la corrida más
+    # rápida, los módulos con mayor tiempo acumulado de import.
+    entorno = dict(os.environ, PYTHONPATH=script_path + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    totales = []
+    mejor = None
+
+    with tempfile.TemporaryDirectory(prefix='bench_arranque_') as directorio:
+        for _ in range(repeticiones):
+            proceso = subprocess.run([sys.executable, '-X', 'importtime', '-c', ARRANQUE],
+                                     cwd=directorio, env=entorno, capture_output=True, text=True, check=True)
+            total = float(proceso.stdout.strip().splitlines()[-1])
+            totales.append(total)
+            if mejor is None or total < mejor[0]:
+                mejor = (total, proceso.stderr)
+
+    importados = []
+    for linea in mejor[1].splitlines():
+        match = IMPORTTIME.match(linea)
+        if match:
+            propio, acumulado, sangria, modulo = match.groups()
+            importados.append({"modulo": modulo, "nivel": len(sangria) // 2,
+                               "propio_ms": round(int(propio) / 1000, 3),
+                               "acumulado_ms": round(int(acumulado) / 1000, 3)})
+
+    # Los de primer nivel bajo app son los que importa directamente el código de la app
+    app_ms = next((m["acumulado_ms"] for m in importados if m["modulo"] == 'app'), None)
+    directos = [m for m in importados if m["nivel"] == 1]
+    return {
+        "repeticiones": repeticiones,
+        "import_app_ms": percentiles(totales),
+        "import_app_mediana_ms": round(statistics.median(totales) * 1000, 3),
+        "importtime_app_ms": app_ms,
+        "modulos_directos": sorted(directos, key=lambda m: m["acumulado_ms"], reverse=True)[:modulos],
+        "modulos_mas_lentos": sorted(importados, key=lambda m: m["propio_ms"], reverse=True)[:modulos],
+        "modulos_importados": len(importados),
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark de la app de permisos de circulación')
+    parser.add_argument('--filas', type=int, default=10000, help='empleados sintéticos en validacion (10k a 10M)')
+    parser.add_argument('--empresas', type=int, default=500, help='cantidad de empresas distintas')
+    parser.add_argument('--repeticiones', type=int, default=500, help='llamadas por función y por endpoint')
+    parser.add_argument('--concurrencia', type=int, default=8, help='clientes HTTP concurrentes')
+    parser.add_argument('--duracion', type=float, default=5.0, help='segundos de carga HTTP por endpoint')
+    parser.add_argument('--semilla', type=int, default=1234, help='semilla de los datos sintéticos')
+    parser.add_argument('--sin-http', action='store_true', help='no hacer la prueba de carga HTTP')
+    parser.add_argument('--salida', help='archivo JSON de resultados (por defecto se imprime)')
+    parser.add_argument('--arranque', action='store_true',
+                        help='medir solo el tiempo de import de app.py (--repeticiones procesos)')
+    args = parser.parse_args()
+
+    salida = os.path.abspath(args.salida) if args.salida else None
+
+    if args.arranque:
+        resultados = {
+            "version": __version__,
+            "fecha": datetime.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "arranque": bench_arranque(min(args.repeticiones, 50)),
+        }
+        texto = json.dumps(resultados, indent=2, ensure_ascii=False)
+        if salida:
+            with open(salida, 'w', encoding='utf-8') as f:
+                f.write(texto)
+        else:
+            print(texto)
+        return
+
+    # La base de datos (validacion.db, con todas las tablas) se crea en un
+    # directorio temporal, así el benchmark nunca toca los datos reales.
+    with tempfile.TemporaryDirectory(prefix='bench_permisos_') as directorio:
+        os.chdir(directorio)
+        sys.path.insert(0, script_path)
+
+        import app
+        import conexion
+        import empresa_valida
+
+        t = time.perf_counter()
+        cargar(empresa_valida, args.filas, args.empresas, args.semilla)
+        carga_segundos = time.perf_counter() - t
+
+        resultados = {
+            "version": __version__,
+            "fecha": datetime.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "parametros": vars(args),
+            "carga": {"filas": args.filas, "segundos": round(carga_segundos, 3),
+                      "filas_por_segundo": round(args.filas / carga_segundos, 1) if carga_segundos else None},
+            "funciones": bench_funciones(empresa_valida, args.filas, args.repeticiones, args.semilla),
+            "test_client": bench_test_client(app.app, args.filas, args.repeticiones, args.semilla),
+        }
+
+        if not args.sin_http:
+            resultados["http"] = bench_http(app.app, args.filas, args.concurrencia, args.duracion, args.semilla)
+
+        # Escribir lo pendiente antes de borrar el directorio temporal
+        empresa_valida.escritor_ingreso.detener()
+        conexion.cerrar_todo()
+        os.chdir(script_path)
+
+    texto = json.dumps(resultados, indent=2, ensure_ascii=False)
+    if salida:
+        with open(salida, 'w', encoding='utf-8') as f:
+            f.write(texto)
+    else:
+        print(texto)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+'''
+Cache en memoria
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Cache LRU con vencimiento (TTL) para guardar resultados de consultas
+frecuentes, como la búsqueda de un permiso por código en /consulta.
+Lleva la cuenta de aciertos y fallos para poder dimensionarla.
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import threading
+import time
+from collections import OrderedDict
+
+# Valores por defecto si no están en la sección [cache] del config.ini
+MAXIMO = 10000
+TTL = 30.0
+
+
+class CacheLRU:
+
+    def __init__(self, maximo=MAXIMO, ttl=TTL):
+        self.maximo = maximo
+        self.ttl = ttl
+        self.datos = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirados = 0
+        self.invalidaciones = 0
+
+    def get(self, clave):
+        # Retorna (True, valor) si la clave está y no venció, (False, None) si no
+        ahora = time.monotonic()
+        with self.lock:
+            item = self.datos.get(clave)
+            if item is not None:
+                vence, valor = item
+                if vence > ahora:
+                    self.datos.move_to_end(clave)
+                    self.hits += 1
+                    return True, valor
+                del self.datos[clave]
+                self.expirados += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, clave, valor):
+        vence = time.monotonic() + self.ttl
+        with self.lock:
+            self.datos[clave] = (vence, valor)
+            self.datos.move_to_end(clave)
+            # Se descarta lo usado hace más tiempo
+            while len(self.datos) > self.maximo:
+                self.datos.popitem(last=False)
+
+    def invalidar(self, clave):
+        with self.lock:
+            if self.datos.pop(clave, None) is not None:
+                self.invalidaciones += 1
+
+    def limpiar(self):
+        with self.lock:
+            self.datos.clear()
+
+    def estadisticas(self):
+        with self.lock:
+            consultas = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / consultas, 4) if consultas else 0.0,
+                "expirados": self.expirados,
+                "invalidaciones": self.invalidaciones,
+                "tamanio": len(self.datos),
+                "maximo": self.maximo,
+                "ttl": self.ttl,
+            }
+
+
+def crear(params=None):
+    # Crea una cache con los parámetros de la sección [cache] del config.ini
+    params = params or {}
+    return CacheLRU(maximo=int(params.get('maximo', MAXIMO)),
+                    ttl=float(params.get('ttl', TTL)))
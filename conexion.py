@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+'''
+Pool de conexiones SQLite
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Mantiene abiertas las conexiones a las bases de datos (validacion.db,
+sus réplicas de lectura y las bases anteriores mientras se copian) para
+reutilizarlas entre pedidos, en lugar de conectar y cerrar en cada consulta.
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+
+import metricas
+
+# Valores por defecto si no están en la sección [db] del config.ini
+POOL_SIZE = 5
+BUSY_TIMEOUT = 5000
+JOURNAL_MODE = 'WAL'
+MMAP_SIZE = 0
+
+pools = {}
+pools_lock = threading.Lock()
+
+# Pools heredados del proceso padre después de un fork (ver reiniciar_en_hijo)
+heredados = []
+
+
+class Pool:
+
+    def __init__(self, database, size=POOL_SIZE, busy_timeout=BUSY_TIMEOUT, journal_mode=JOURNAL_MODE,
+                 mmap_size=MMAP_SIZE, solo_lectura=False):
+        self.database = database
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self.journal_mode = journal_mode
+        self.mmap_size = mmap_size
+        # Un archivo que nunca cambia (réplica): se abre de solo lectura y
+        # sin locks (immutable=1)
+        self.solo_lectura = solo_lectura
+        # Etiqueta de las métricas: fija, no la ruta del archivo (cada
+        # réplica es un archivo nuevo y crearía series nuevas sin fin)
+        self.rol = 'replica' if solo_lectura else 'principal'
+        self.cerrado = False
+        # LIFO para reutilizar primero la conexión más "caliente"
+        self.libres = queue.LifoQueue(maxsize=size)
+        self.creadas = 0
+        self.lock = threading.Lock()
+
+    def crear(self):
+        # check_same_thread=False porque la conexión pasa de un hilo a otro,
+        # pero nunca es usada por dos hilos al mismo tiempo.
+        if self.solo_lectura:
+            ruta = os.path.abspath(self.database).replace(os.sep, '/')
+            if not ruta.startswith('/'):
+                ruta = '/' + ruta
+            uri = 'file:{}?mode=ro&immutable=1'.format(quote(ruta, safe='/:'))
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            conn.execute("PRAGMA query_only = 1")
+        else:
+            conn = sqlite3.connect(self.database, timeout=self.busy_timeout / 1000,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA foreign_keys = 1")
+            conn.execute("PRAGMA busy_timeout = {}".format(int(self.busy_timeout)))
+            conn.execute("PRAGMA journal_mode = {}".format(self.journal_mode))
+        if self.mmap_size > 0:
+            conn.execute("PRAGMA mmap_size = {}".format(int(self.mmap_size)))
+        metricas.contar('sqlite_conexiones_abiertas_total', rol=self.rol)
+        return conn
+
+    def tomar(self):
+        try:
+            return self.libres.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            if self.creadas < self.size:
+                self.creadas += 1
+                nueva = True
+            else:
+                nueva = False
+
+        if nueva:
+            try:
+                return self.crear()
+            except Exception:
+                with self.lock:
+                    self.creadas -= 1
+                raise
+
+        # Pool agotado: esperar a que otro pedido devuelva su conexión
+        return self.libres.get(timeout=self.busy_timeout / 1000)
+
+    def devolver(self, conn):
+        # Las conexiones de un pool cerrado (réplica reemplazada) se cierran
+        # al terminar de usarlas
+        if self.cerrado:
+            self.descartar(conn)
+            return
+        # Nunca devolver al pool una conexión con una transacción abierta
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # La conexión quedó en mal estado, se descarta
+            self.descartar(conn)
+            return
+        self.libres.put_nowait(conn)
+
+    def descartar(self, conn):
+        try:
+            conn.close()
+        finally:
+            with self.lock:
+                self.creadas -= 1
+
+    def cerrar(self):
+        self.cerrado = True
+        while True:
+            try:
+                conn = self.libres.get_nowait()
+            except queue.Empty:
+                break
+            self.descartar(conn)
+
+
+def get_pool(database, params=None):
+    # Un pool por archivo de base de datos, creado la primera vez que se usa
+    pool = pools.get(database)
+    if pool is not None:
+        return pool
+
+    params = params or {}
+    with pools_lock:
+        pool = pools.get(database)
+        if pool is None:
+            pool = Pool(database,
+                        size=int(params.get('pool_size', POOL_SIZE)),
+                        busy_timeout=int(params.get('busy_timeout', BUSY_TIMEOUT)),
+                        journal_mode=params.get('journal_mode', JOURNAL_MODE),
+                        mmap_size=int(params.get('mmap_size', MMAP_SIZE)),
+                        solo_lectura=bool(params.get('solo_lectura', False)))
+            pools[database] = pool
+    return pool
+
+
+@contextmanager
+def conectar(database, params=None):
+    pool = get_pool(database, params)
+
+    # Se mide cuánto se espera por una conexión (crearla o que se libere una)
+    inicio = time.perf_counter()
+    conn = pool.tomar()
+    segundos = time.perf_counter() - inicio
+    metricas.observar('sqlite_espera_conexion_segundos', segundos, rol=pool.rol)
+    metricas.acumular('conexion_segundos', segundos)
+
+    try:
+        yield conn
+    finally:
+        pool.devolver(conn)
+
+
+def cerrar(database):
+    # Cierra el pool de una base que ya no se va a usar
+    with pools_lock:
+        pool = pools.pop(database, None)
+    if pool is not None:
+        pool.cerrar()
+
+
+def cerrar_todo():
+    with pools_lock:
+        for pool in pools.values():
+            pool.cerrar()
+        pools.clear()
+
+
+def reiniciar_en_hijo():
+    # Un proceso creado con fork (worker) no puede usar las conexiones del
+    # padre: el worker abre las suyas. Las heredadas no se usan ni se cierran
+    # (cerrarlas desde el hijo podría afectar los locks del archivo).
+    global pools_lock
+    pools_lock = threading.Lock()
+    heredados.extend(pools.values())
+    pools.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reiniciar_en_hijo)
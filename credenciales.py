@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+'''
+Credenciales de usuarios
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Hash de claves con PBKDF2-HMAC-SHA256 y sal aleatoria por usuario, y
+tokens de sesión. La cantidad de iteraciones se configura en la sección
+[usuarios] del config.ini: más iteraciones hacen más caro adivinar una
+clave, pero también cada login. Cada usuario guarda las iteraciones con
+las que se calculó su hash, así se pueden cambiar sin invalidar las
+claves existentes (se recalcula el hash en el siguiente login).
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import hashlib
+import hmac
+import os
+import secrets
+
+# Valores por defecto si no están en la sección [usuarios] del config.ini
+ITERACIONES = 100000
+LARGO_SAL = 16
+
+# Hash para comparar cuando el usuario no existe: así un usuario inexistente
+# tarda lo mismo que una clave incorrecta y no se puede saber cuáles existen
+SAL_FALSA = b'\x00' * LARGO_SAL
+
+
+def hash_clave(clave, sal=None, iteraciones=ITERACIONES):
+    # Retorna (sal, hash). Si no se indica la sal se genera una nueva
+    if sal is None:
+        sal = os.urandom(LARGO_SAL)
+    return sal, hashlib.pbkdf2_hmac('sha256', clave.encode('utf-8'), sal, iteraciones)
+
+
+def verificar_clave(clave, sal, hash_guardado, iteraciones):
+    # Compara en tiempo constante el hash de la clave con el guardado
+    _, calculado = hash_clave(clave, sal, iteraciones)
+    return hmac.compare_digest(calculado, hash_guardado)
+
+
+def simular_verificacion(clave, iteraciones=ITERACIONES):
+    # Mismo costo que verificar_clave(), para usuarios que no existen
+    hash_clave(clave, SAL_FALSA, iteraciones)
+    return False
+
+
+def nuevo_token():
+    # Token de sesión aleatorio para la cookie
+    return secrets.token_urlsafe(32)
+
+
+def hash_token(token):
+    # En la BD se guarda el hash del token, no el token
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
@@ -16,92 +16,653 @@ __email__ = "johanarang@hotmail.com"
 __version__ = "1.0"
 
 import os
+import glob
+import base64
+import difflib
+import re
 import sqlite3
-import requests
+import time
+import hmac
 import json
-
+import logging
+import unicodedata
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import cache
+import conexion
+import credenciales
+import escritura
+import metricas
+import replica
+from config import config
+from metricas import medir_funcion
+
+# Obtener la path de ejecución actual del script
+script_path = os.path.dirname(os.path.realpath(__file__))
+config_path_name = os.path.join(script_path, 'config.ini')
+
+logger = logging.getLogger('permisos.base')
+
+# Parámetros de la sección [db] del config.ini, se cargan con configurar()
 db = {}
 
+# Cache de codigo -> filas de validacion e ingresado, para no ir a SQLite
+# en cada lectura del mismo permiso.
+cache_validacion = None
+cache_ingreso = None
+
+# Escritor en segundo plano de las filas de ingresado (ver fill_diferido)
+# y forma de registrar los ingresos de /consulta (ver registrar_ingreso)
+escritor_ingreso = None
+modo_ingreso = 'diferido'
+
+# Qué hacer con un código ya registrado en insert() y cuánto se recuerdan
+# las claves de idempotencia (sección [escritura] del config.ini)
+MODOS_REGISTRO = ('rechazar', 'actualizar', 'conservar')
+modo_registro = 'rechazar'
+idempotencia_ttl = 86400
+
+# Parámetros de la sección [usuarios] del config.ini (hash de claves y sesiones)
+# y cache de token -> usuario de las sesiones ya verificadas
+usuarios = {}
+cache_sesiones = None
+
+# Cantidad máxima de parámetros por query en los WHERE ... IN (...)
+MAX_VARIABLES = 500
+
+# Cantidad máxima de códigos por pedido de verificar_lote()
+MAX_CODIGOS_LOTE = 1000
+
+# Mayor entero que se puede guardar en SQLite (64 bits con signo)
+MAX_ENTERO = 2 ** 63 - 1
+
+# Columnas de un permiso como las retornan consulta() y las búsquedas
+COLUMNAS_PERMISO = ('codigo', 'empresa', 'actividad', 'nombre', 'edad', 'dni', 'fecha_permiso', 'riesgo', 'vence')
+
+# Parámetros de la sección [permisos] del config.ini (vigencia de los permisos)
+permisos = {}
+
+# Réplicas de lectura (sección [replica] del config.ini, ver replica.py):
+# lector de la réplica actual (None si el modo réplica no está activo),
+# parámetros de sus pools y última réplica usada
+lector_replica = None
+params_replica = {}
+replica_actual = None
+
+# Hora (time.time()) de la última escritura de validacion de este proceso:
+# consulta() no lee de una réplica copiada antes
+ultima_escritura = 0.0
+
+# Búsqueda de texto (ver buscar): columnas del índice con su peso en el
+# orden de los resultados, máximos por pedido y cache de los términos del
+# vocabulario por letra inicial, para corregir errores de tipeo
+CAMPOS_BUSQUEDA = {'nombre': 10.0, 'empresa': 5.0, 'actividad': 1.0}
+MAX_TERMINOS_BUSQUEDA = 8
+MAX_RESULTADOS_BUSQUEDA = 100
+MAX_OFFSET_BUSQUEDA = 1000
+cache_vocabulario = cache.CacheLRU(maximo=64, ttl=300)
+
+
+def configurar(config_path=config_path_name):
+
+    # Lee del config.ini los parámetros de la BD ([db]), de la cache de
+    # consultas ([cache]), de la escritura diferida ([escritura]) y de los
+    # usuarios ([usuarios]). Se llama una vez al importar el módulo; solo hace
+    # falta llamarla de nuevo para usar otro archivo de configuración.
+    global db, cache_validacion, cache_ingreso, escritor_ingreso, modo_ingreso, modo_registro, idempotencia_ttl
+    global usuarios, cache_sesiones, permisos, lector_replica, params_replica
+
+    db = config('db', config_path)
+    cache_params = config('cache', config_path)
+    escritura_params = config('escritura', config_path)
+    usuarios = config('usuarios', config_path)
+    permisos = config('permisos', config_path)
+    replica_params = config('replica', config_path)
+    lector_replica = replica.crear(replica_params, db['database'])
+    params_replica = {'pool_size': db.get('pool_size', conexion.POOL_SIZE), 'solo_lectura': True,
+                      'mmap_size': replica_params.get('mmap_size', replica.MMAP_SIZE)}
+
+    cache_validacion = cache.crear(cache_params)
+    cache_ingreso = cache.crear(cache_params)
+
+    # Una sesión cerrada en otro worker se sigue aceptando en este como mucho
+    # sesion_cache_ttl segundos; el vencimiento de la sesión se controla siempre
+    cache_sesiones = cache.CacheLRU(maximo=int(usuarios.get('sesiones_maximo', cache.MAXIMO)),
+                                    ttl=float(usuarios.get('sesion_cache_ttl', cache.TTL)))
+
+    # Si ya había un escritor, se escribe antes lo pendiente
+    if escritor_ingreso is not None:
+        escritor_ingreso.detener()
+    escritor_ingreso = escritura.crear(fill_lote, escritura_params)
+    modo_ingreso = escritura_params.get('ingreso', 'diferido')
+    modo_registro = escritura_params.get('registro', 'rechazar')
+    idempotencia_ttl = float(escritura_params.get('idempotencia_ttl', 86400))
+
+def leer_entero(valor):
+
+    # Entero no negativo escrito con dígitos ASCII que entra en un INTEGER
+    # de SQLite, o None. str.isdigit() solo no alcanza: acepta '²', que
+    # int() rechaza, y un número más grande no se puede pasar a una query.
+    valor_str = str(valor)
+    if not (valor_str.isascii() and valor_str.isdigit()):
+        return None
+    numero = int(valor_str)
+    return numero if numero <= MAX_ENTERO else None
+
+def clave_cache(codigo):
+
+    # '12' y 12 son el mismo permiso para SQLite, también para la cache
+    numero = leer_entero(codigo)
+    return numero if numero is not None else str(codigo)
+
+def vencimiento(fecha_permiso):
+
+    # Fecha de vencimiento de un permiso nuevo: vigencia_dias después de su
+    # fecha ([permisos] del config.ini). Sin vigencia_dias no vence (None).
+    dias = float(permisos.get('vigencia_dias', 0))
+    if dias <= 0:
+        return None
+    fecha = datetime.strptime(str(fecha_permiso), "%Y-%m-%d %H:%M:%S.%f")
+    return (fecha + timedelta(days=dias)).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+def vencido(fila):
+
+    # True si el permiso (una fila de consulta()) ya venció
+    vence = fila[8]
+    return vence is not None and vence <= datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+def validar_registro(datos):
+
+    # Valida los datos de un empleado con las mismas reglas del formulario
+    # de /procesar. Retorna la tupla (codigo, empresa, actividad, nombre, edad, dni, riesgo)
+    # lista para insertar, o None si algún dato es incorrecto.
+    codigo = str(datos.get('codigo'))
+    empresa= str(datos.get('empresa')).upper()
+    actividad = str(datos.get('actividad')).upper()
+    nombre = str(datos.get('nombre')).upper()
+    dni = str(datos.get('dni'))
+    edad = str(datos.get('edad'))
+    riesgo = str(datos.get('riesgo')).upper()
+
+    if(leer_entero(codigo) is None or
+        empresa is None or empresa.isdigit() is True or
+        actividad is None or actividad.isdigit() is True or
+        nombre is None or nombre.isdigit() is True or
+        riesgo is None or riesgo.isdigit() is True or
+        leer_entero(edad) is None or
+        leer_entero(dni) is None):
+        return None
+
+    return int(codigo), empresa, actividad, nombre, int(edad), int(dni), riesgo
+
+def crear_cursor(codigo):
+    # El cursor es opaco para el cliente: el último codigo entregado en base64
+    return base64.urlsafe_b64encode(str(codigo).encode()).decode()
+
+def leer_cursor(cursor):
+    try:
+        codigo = base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return leer_entero(codigo)
+
+def conectar(database):
+    # Toma una conexión del pool de la base de datos indicada,
+    # con los parámetros de la sección [db] del config.ini
+    return conexion.conectar(database, db)
+
+
+# Bases separadas de versiones anteriores (ingreso.db y usuarios.db):
+# carpeta de sus migraciones y query que copia cada tabla a la base principal.
+# Los ingresos de permisos que ya no están en validacion no se copian (como
+# fecha_ingreso se usa la fecha del permiso, igual que en la migración 005), y los
+# usuarios reciben un id nuevo (las sesiones anteriores no se copian).
+BASES_ANTERIORES = {
+    'ingreso.db': ('ingreso', {
+        'ingresado': """
+            INSERT OR IGNORE INTO main.ingresado (codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo,
+                                                  fecha_ingreso)
+            SELECT i.codigo, i.empresa, i.actividad, i.nombre, i.edad, i.dni, i.fecha_permiso, i.riesgo,
+                   i.fecha_permiso
+            FROM anterior.ingresado i JOIN main.validacion v ON v.codigo = i.codigo;""",
+    }),
+    'usuarios.db': ('usuarios', {
+        'usuario': """
+            INSERT OR IGNORE INTO main.usuario (nombre, correo, sal, hash, iteraciones)
+            SELECT nombre, correo, sal, hash, iteraciones
+            FROM anterior.usuario ORDER BY id;""",
+    }),
+}
+
+def replica_vigente(despues_de=0.0):
+
+    # Réplica actual si el modo réplica está activo y hay una reciente
+    # (copiada después de despues_de), si no None: la base principal
+    return lector_replica.archivo(despues_de) if lector_replica is not None else None
+
+@contextmanager
+def conectar_lectura(despues_de=0.0):
+
+    # Conexión para consultas que pueden leer datos con hasta max_atraso
+    # segundos de atraso: de la réplica vigente o de la base principal.
+    with conectar_replica(replica_vigente(despues_de)) as conn:
+        yield conn
+
+@contextmanager
+def conectar_replica(archivo):
+
+    # Conexión a la réplica archivo, o a la base principal si es None
+    global replica_actual
+    if archivo is None:
+        metricas.contar('sqlite_lecturas_total', origen='principal')
+        with conectar(db['database']) as conn:
+            yield conn
+        return
+
+    # Los pools de las réplicas anteriores se cierran al cambiar de réplica
+    anterior = replica_actual
+    if archivo != anterior:
+        replica_actual = archivo
+        if anterior is not None:
+            conexion.cerrar(anterior)
+
+    metricas.contar('sqlite_lecturas_total', origen='replica')
+    try:
+        with conexion.conectar(archivo, params_replica) as conn:
+            yield conn
+    finally:
+        # Otro pedido pasó a una réplica más nueva mientras se usaba esta
+        if archivo != replica_actual:
+            conexion.cerrar(archivo)
+
+def bases():
+
+    # Archivo de cada base de datos, por nombre de carpeta de migraciones.
+    # Todas las tablas están en la base del config.ini.
+    return {
+        'validacion': db['database'],
+    }
+
+def sentencias(script):
+
+    # Separa un script SQL en sentencias completas (respetando los BEGIN ... END
+    # de los triggers), para ejecutarlas dentro de una misma transacción.
+    sentencia = ''
+    for linea in script.splitlines(keepends=True):
+        sentencia += linea
+        if sqlite3.complete_statement(sentencia):
+            yield sentencia
+            sentencia = ''
+
+def migrar_base(conn, archivos):
+
+    # Aplica en orden los archivos NNN_descripcion.sql cuyo número sea mayor
+    # a la versión de la base (PRAGMA user_version). Todas las migraciones
+    # pendientes se aplican en una sola transacción: o se aplican todas o ninguna.
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
 
-def create_schema():
-
-    # Conectarnos a la base de datos
-    # En caso de que no exista el archivo se genera
-    # como una base de datos vacia
-    conn = sqlite3.connect(db['database'])
+    c.execute("PRAGMA user_version;")
+    version = c.fetchone()[0]
 
-    # Crear el cursor para poder ejecutar las querys
-    c = conn.cursor()
+    for archivo in archivos:
+        numero = int(os.path.basename(archivo).split('_')[0])
+        if numero <= version:
+            continue
 
-    # Obtener el path real del archivo de schema
-    script_path = os.path.dirname(os.path.realpath(__file__))
-    schema_path_name = os.path.join(script_path, db['schema'])
+        with open(archivo, "r", encoding="utf-8") as f:
+            for sentencia in sentencias(f.read()):
+                c.execute(sentencia)
 
-    # Crar esquema desde archivo
-    c.executescript(open(schema_path_name, "r").read())
+        c.execute("PRAGMA user_version = {};".format(numero))
+        version = numero
 
     # Para salvar los cambios realizados en la DB debemos
     # ejecutar el commit, NO olvidarse de este paso!
     conn.commit()
+    return version
+
+def importar_anteriores(carpeta):
+
+    # Copia a la base principal los datos de ingreso.db y usuarios.db, si
+    # existen y no se copiaron antes (tabla base_importada). Cada archivo se
+    # lleva primero a la última versión de su esquema. Los archivos no se
+    # borran. Retorna {archivo: filas copiadas}.
+    importadas = {}
+    for archivo, (nombre, queries) in BASES_ANTERIORES.items():
+        if not os.path.exists(archivo):
+            continue
+
+        with conectar(db['database']) as conn:
+            c = conn.cursor()
+            c.execute("SELECT 1 FROM base_importada WHERE archivo = ?;", (archivo,))
+            if c.fetchone() is not None:
+                continue
+
+        archivos = sorted(glob.glob(os.path.join(carpeta, nombre, '*.sql')))
+        with conectar(archivo) as conn:
+            migrar_base(conn, archivos)
+        conexion.cerrar(archivo)
+
+        with conectar(db['database']) as conn:
+            c = conn.cursor()
+            # ATTACH va fuera de la transacción; la copia es una sola transacción
+            c.execute("ATTACH DATABASE ? AS anterior;", (archivo,))
+            try:
+                c.execute("BEGIN IMMEDIATE")
+                antes = conn.total_changes
+                for tabla, query in queries.items():
+                    c.execute(query)
+                filas = conn.total_changes - antes
+
+                c.execute("INSERT INTO base_importada (archivo, fecha, filas) VALUES (?,?,?);",
+                          (archivo, datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"), filas))
+                conn.commit()
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                c.execute("DETACH DATABASE anterior;")
+
+        logger.info('Se copiaron %d filas de %s a %s', filas, archivo, db['database'])
+        importadas[archivo] = filas
+
+    return importadas
+
+@medir_funcion
+def migrar():
+
+    # Lleva todas las bases de datos a la última versión del esquema.
+    # No borra datos: reemplaza al DROP/CREATE que hacía /reset.
+    carpeta = os.path.join(script_path, db.get('migraciones', 'migraciones'))
+
+    versiones = {}
+    for nombre, database in bases().items():
+        archivos = sorted(glob.glob(os.path.join(carpeta, nombre, '*.sql')))
+        with conectar(database) as conn:
+            versiones[nombre] = migrar_base(conn, archivos)
+
+    importar_anteriores(carpeta)
+
+    # El esquema pudo cambiar, se descarta todo lo guardado
+    cache_validacion.limpiar()
+    cache_ingreso.limpiar()
+    cache_sesiones.limpiar()
+
+    return versiones
+
+def marcar_escritura():
+    global ultima_escritura
+    ultima_escritura = time.time()
+
+@medir_funcion
+def insert(codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, modo=None, clave=None):
+
+    # Registra un permiso. Si el código ya existe, depende del modo
+    # (por defecto el de registro en la sección [escritura] del config.ini):
+    #   rechazar:   no se escribe y el resultado es 'duplicado'
+    #   conservar:  no se escribe y el resultado es 'conservado' (gana el primero)
+    #   actualizar: se reemplazan los datos ('actualizado'), solo si cambió algo
+    #               además de la fecha ('sin_cambios' si no)
+    # Con una clave de idempotencia, un reintento con la misma clave devuelve
+    # el resultado del primer intento sin escribir nada.
+    # Retorna la tupla (resultado, repetido).
+    modo = modo or modo_registro
+    if modo not in MODOS_REGISTRO:
+        raise ValueError('modo de registro desconocido: {}'.format(modo))
+
+    if clave is not None:
+        anterior = resultado_idempotente(clave, codigo)
+        if anterior is not None:
+            return anterior, True
+
+    values = [codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, vencimiento(fecha_permiso)]
+
+    #Toma una conexión del pool de la BD
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
+
+        if clave is not None:
+            # Con el lock de escritura tomado nadie más puede guardar la misma
+            # clave: si otro pedido la guardó recién, vale su resultado
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT codigo, resultado FROM idempotencia WHERE clave = ? AND fecha >= ?;",
+                      (clave, time.time() - idempotencia_ttl))
+            fila = c.fetchone()
+            if fila is not None:
+                conn.rollback()
+                return (fila[1] if fila[0] == codigo else 'clave_en_uso'), True
 
-    # Cerrar la conexión con la base de datos
-    conn.close()
-
-def insert(codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo):
-    
-    #Conecta con la BD
-    conn = sqlite3.connect(db['database'])
-    conn.execute("PRAGMA foreign_keys = 1")
-    c = conn.cursor()
-
-    values = [codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo]
-    
-    try: 
         c.execute("""
-            INSERT INTO validacion (codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo)
-            VALUES (?,?,?,?,?,?,?,?);""", values)
+            INSERT INTO validacion (codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, vence)
+            VALUES (?,?,?,?,?,?,?,?,?)
+            ON CONFLICT (codigo) DO NOTHING;""", values)
+
+        if c.rowcount == 1:
+            resultado = 'insertado'
+        elif modo == 'actualizar':
+            # Solo se escribe (y queda en cambios) si cambió algún dato o si el
+            # permiso estaba vencido (se renueva con la nueva fecha)
+            c.execute("""
+                UPDATE validacion
+                SET empresa = ?2, actividad = ?3, nombre = ?4, edad = ?5, dni = ?6, fecha_permiso = ?7, riesgo = ?8,
+                    vence = ?9
+                WHERE codigo = ?1 AND ((empresa, actividad, nombre, edad, dni, riesgo) IS NOT (?2, ?3, ?4, ?5, ?6, ?8)
+                                       OR vence <= ?7);""",
+                values)
+            resultado = 'actualizado' if c.rowcount == 1 else 'sin_cambios'
+        else:
+            resultado = 'duplicado' if modo == 'rechazar' else 'conservado'
+
+        if clave is not None:
+            ahora = time.time()
+            c.execute("INSERT OR REPLACE INTO idempotencia (clave, codigo, resultado, fecha) VALUES (?,?,?,?);",
+                      (clave, codigo, resultado, ahora))
+            # Las claves vencidas se borran de a poco (usa el índice por fecha)
+            c.execute("""DELETE FROM idempotencia WHERE clave IN
+                         (SELECT clave FROM idempotencia WHERE fecha < ? ORDER BY fecha LIMIT 100);""",
+                      (ahora - idempotencia_ttl,))
+
+        conn.commit()
+
+    # El permiso cambió, la próxima consulta debe ir a la BD principal
+    if resultado in ('insertado', 'actualizado'):
+        marcar_escritura()
+        cache_validacion.invalidar(clave_cache(codigo))
+
+    return resultado, False
+
+def resultado_idempotente(clave, codigo):
+
+    # Resultado guardado para la clave de idempotencia, o None si es la
+    # primera vez que se usa. Es una sola lectura por clave primaria, sin
+    # tomar el lock de escritura.
+    with conectar(db['database']) as conn:
+        fila = conn.execute("SELECT codigo, resultado FROM idempotencia WHERE clave = ? AND fecha >= ?;",
+                            (clave, time.time() - idempotencia_ttl)).fetchone()
+    if fila is None:
+        return None
+    # La misma clave con otro código es un error del cliente
+    return fila[1] if fila[0] == codigo else 'clave_en_uso'
+
+@medir_funcion
+def insert_lote(registros):
+
+    # Inserta muchos registros en una sola transacción con executemany.
+    # registros es una lista de tuplas en el mismo orden que insert():
+    # (codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo)
+    # Retorna una lista de booleanos, uno por registro, indicando si se insertó
+    # (False cuando el código ya existía o estaba repetido en el mismo lote).
+
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
+
+        # Se toma el lock de escritura antes de verificar los códigos,
+        # así nadie puede insertar el mismo código entre la verificación y el insert
+        c.execute("BEGIN IMMEDIATE")
+
+        codigos = [registro[0] for registro in registros]
+        existentes = set()
+        for i in range(0, len(codigos), MAX_VARIABLES):
+            parte = codigos[i:i + MAX_VARIABLES]
+            c.execute("SELECT codigo FROM validacion WHERE codigo IN ({});".format(
+                ','.join('?' * len(parte))), parte)
+            existentes.update(x[0] for x in c.fetchall())
+
+        aceptados = []
+        nuevos = []
+        for registro in registros:
+            if registro[0] in existentes:
+                aceptados.append(False)
+            else:
+                existentes.add(registro[0])
+                nuevos.append(registro)
+                aceptados.append(True)
+
+        c.executemany("""
+            INSERT INTO validacion (codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, vence)
+            VALUES (?,?,?,?,?,?,?,?,?);""", [registro + (vencimiento(registro[6]),) for registro in nuevos])
+
+        conn.commit()
+
+    if nuevos:
+        marcar_escritura()
+    for registro in nuevos:
+        cache_validacion.invalidar(clave_cache(registro[0]))
+
+    return aceptados
+
+def registrar_lote(filas):
+
+    # Valida cada fila (un dict con los campos del formulario) con las mismas
+    # reglas de /procesar e inserta las válidas con insert_lote().
+    # Retorna el reporte de aceptados y rechazados, fila por fila.
+
+    # Todos los registros del lote comparten la misma fecha de permiso
+    fecha_permiso = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+    reporte = []
+    registros = []
+    for numero, fila in enumerate(filas, start=1):
+        registro = validar_registro(fila) if isinstance(fila, dict) else None
+        if registro is None:
+            reporte.append({"fila": numero, "codigo": fila.get('codigo') if isinstance(fila, dict) else None,
+                            "estado": "rechazado", "motivo": "datos incorrectos"})
+        else:
+            codigo, empresa, actividad, nombre, edad, dni, riesgo = registro
+            registros.append((codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo))
+            reporte.append({"fila": numero, "codigo": codigo, "estado": "aceptado"})
+
+    insertados = iter(insert_lote(registros))
+    for fila in reporte:
+        if fila["estado"] == "aceptado" and next(insertados) is False:
+            fila["estado"] = "rechazado"
+            fila["motivo"] = "código ya registrado"
+
+    aceptados = sum(1 for fila in reporte if fila["estado"] == "aceptado")
+    return {"aceptados": aceptados,
+            "rechazados": len(reporte) - aceptados,
+            "filas": reporte}
+
+@medir_funcion
+def consulta(codigo):
 
-    except sqlite3.IntegrityError:
-        return print('...')
+    # Primero se busca en la cache, solo si no está se va a la BD
+    clave = clave_cache(codigo)
+    encontrado, query_results = cache_validacion.get(clave)
+    if encontrado is True:
+        return query_results
+
+    # Se busca en la réplica (si el modo réplica está activo); un permiso
+    # recién registrado puede no estar todavía, entonces se busca en la
+    # principal. Si este proceso escribió validacion después de la última
+    # copia se lee de la principal: la réplica tendría los datos de antes
+    # de una actualización o renovación.
+    query = """SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, vence
+               FROM validacion
+               WHERE codigo = ?;"""
+    archivo = replica_vigente(ultima_escritura)
+    with conectar_replica(archivo) as conn:
+        query_results = conn.execute(query, (codigo,)).fetchall()
+
+    if not query_results and lector_replica is not None:
+        archivo = None
+        with conectar(db['database']) as conn:
+            query_results = conn.execute(query, (codigo,)).fetchall()
+
+    # Un código inexistente no se guarda: si lo registra otro worker, este
+    # no lo vería hasta que venza la cache. Lo leído de una réplica tampoco:
+    # ya puede tener hasta max_atraso segundos de atraso y la cache le
+    # sumaría su ttl, porque lo que se escribe en otro worker no la invalida.
+    if query_results and archivo is None:
+        cache_validacion.put(clave, query_results)
 
-    conn.commit()
-    # Cerrar la conexión con la base de datos
-    conn.close()
+    #Retorna los resultados obtenidos.
+    return query_results
 
-def consulta(codigo):
-    
-    #Conecta con la BD
-    conn = sqlite3.connect(db['database'])
-    conn.execute("PRAGMA foreign_keys = 1")
-    c = conn.cursor()
+@medir_funcion
+def consulta_dni(dni):
 
-    c.execute("""SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo
-                FROM validacion 
-                WHERE codigo = ?;""", (codigo,))
-    
-    query_results = c.fetchall()
+    #Busca los permisos de una persona por DNI (usa el índice validacion_dni)
+    with conectar_lectura() as conn:
+        c = conn.cursor()
 
-    conn.commit()
-    # Cerrar la conexión con la base de datos
-    conn.close()
+        c.execute("""SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo
+                    FROM validacion
+                    WHERE dni = ?
+                    ORDER BY fecha_permiso;""", (dni,))
+
+        query_results = c.fetchall()
 
     #Retorna los resultados obtenidos.
     return query_results
 
+@medir_funcion
+def consulta_fechas(desde=None, hasta=None, limit=0):
+
+    # Permisos con fecha_permiso en el rango [desde, hasta), en formato ISO
+    # ('2020-11-17' o '2020-11-17 08:00:00'). Usa el índice validacion_fecha_permiso.
+    query = 'SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo FROM validacion'
+    condiciones = []
+    values = []
+
+    if desde is not None:
+        condiciones.append('fecha_permiso >= ?')
+        values.append(desde)
+
+    if hasta is not None:
+        condiciones.append('fecha_permiso < ?')
+        values.append(hasta)
+
+    if condiciones:
+        query += ' WHERE ' + ' AND '.join(condiciones)
+
+    query += ' ORDER BY fecha_permiso'
+
+    if limit > 0:
+        query += ' LIMIT ?'
+        values.append(limit)
+
+    query += ';'
+
+    with conectar_lectura() as conn:
+        c = conn.cursor()
+        c.execute(query, values)
+        query_results = c.fetchall()
+
+    return query_results
+
+@medir_funcion
 def grafico():
 
-    #Conecta con la BD
-    conn = sqlite3.connect(db['database'])
-    conn.execute("PRAGMA foreign_keys = 1")
-    c = conn.cursor()
+    #Toma una conexión del pool de la BD
+    with conectar_lectura() as conn:
+        c = conn.cursor()
 
-    c.execute("""SELECT riesgo, COUNT(dni) as cantidad_personas FROM validacion GROUP BY riesgo;""")
-    
-    query_results = c.fetchall()
+        # riesgo_conteo se mantiene con triggers (migración 003)
+        c.execute("""SELECT riesgo, cantidad as cantidad_personas FROM riesgo_conteo ORDER BY riesgo;""")
 
-    conn.commit()
-    # Cerrar la conexión con la base de datos
-    conn.close()
+        query_results = c.fetchall()
 
     riesgos= [x[0] for x in query_results]
     cantidad_personas = [x[1] for x in query_results]
@@ -109,165 +670,715 @@ def grafico():
     #Retorna los resultados obtenidos
     return riesgos, cantidad_personas
 
-def esquema():
+@medir_funcion
+def version_datos():
 
-    # Conectarnos a la base de datos
-    # En caso de que no exista el archivo se genera
-    # como una base de datos vacia
-    conn = sqlite3.connect('ingreso.db')
-    conn.execute("PRAGMA foreign_keys = 1")
+    # Número del último cambio en validacion o ingresado (tabla cambios).
+    # Si no cambió, todo lo calculado con esos datos sigue valiendo.
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
+        c.execute("SELECT COALESCE(MAX(id), 0) FROM cambios;")
+        query_results = c.fetchone()
 
-    # Crear el cursor para poder ejecutar las querys
-    c = conn.cursor()
+    return query_results[0]
 
-    # Ejecutar una query
-    c.execute("""
-                DROP TABLE IF EXISTS ingresado;
-            """)
-
-    # Ejecutar una query
-    c.execute("""
-        CREATE TABLE ingresado (
-            [codigo] INTEGER PRIMARY KEY,
-            [empresa] STRING  NOT NULL,
-            [actividad] STRING NOT NULL,
-            [nombre] STRING NOT NULL,
-            [edad] INTEGER NOT NULL,
-            [dni] INTEGER  NOT NULL,
-            [fecha_permiso] INTEGER NOT NULL, 
-            [riesgo] STRING NOT NULL
-        );
-        """)
+@medir_funcion
+def columnas_estadisticas(desde=None, hasta=None, version_minima=0):
 
-    # Para salvar los cambios realizados en la DB debemos
-    # ejecutar el commit, NO olvidarse de este paso!
-    conn.commit()
+    # Trae en una sola consulta las columnas que usan las estadísticas, para
+    # los permisos con fecha_permiso en [desde, hasta). Retorna (version,
+    # {columna: lista de valores}); version es la de version_permisos(): los
+    # ingresos no cambian las estadísticas. Si la réplica todavía no tiene
+    # version_minima, se lee de la base principal.
+    query = 'SELECT empresa, actividad, edad, riesgo, fecha_permiso FROM validacion'
+    condiciones = []
+    values = []
+
+    if desde is not None:
+        condiciones.append('fecha_permiso >= ?')
+        values.append(desde)
+
+    if hasta is not None:
+        condiciones.append('fecha_permiso < ?')
+        values.append(hasta)
 
-    # Cerrar la conexión con la base de datos
-    conn.close()
+    if condiciones:
+        query += ' WHERE ' + ' AND '.join(condiciones)
 
+    query += ';'
+
+    def leer(conn):
+        c = conn.cursor()
+        # La versión y las filas se leen en la misma transacción
+        c.execute("BEGIN")
+        version = leer_version_permisos(c)
+        query_results = None
+        if version >= version_minima:
+            c.execute(query, values)
+            query_results = c.fetchall()
+        conn.commit()
+        return version, query_results
+
+    with conectar_lectura() as conn:
+        version, query_results = leer(conn)
+
+    if query_results is None:
+        with conectar(db['database']) as conn:
+            version, query_results = leer(conn)
+
+    nombres = ('empresa', 'actividad', 'edad', 'riesgo', 'fecha_permiso')
+    valores = list(zip(*query_results)) if query_results else [()] * len(nombres)
+    return version, dict(zip(nombres, (list(v) for v in valores)))
+
+@medir_funcion
 def fill(codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo):
-    
-    #Conecta con la BD
-    conn = sqlite3.connect('ingreso.db')
-    conn.execute("PRAGMA foreign_keys = 1")
-    c = conn.cursor()
 
-    values = [codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo]
+    # Registra un ingreso. Retorna False si ya estaba registrado o si el
+    # permiso no existe (en ese caso no se escribe nada).
+    #Toma una conexión del pool de la BD
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
+
+        values = [codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo]
 
-    try: 
         c.execute("""
-            INSERT INTO ingresado (codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo)
-            VALUES (?,?,?,?,?,?,?,?);""", values)
+            INSERT INTO ingresado (codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, fecha_ingreso)
+            SELECT ?,?,?,?,?,?,?,?,strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')
+            WHERE EXISTS (SELECT 1 FROM validacion WHERE codigo = ?1)
+            ON CONFLICT (codigo) DO NOTHING;""", values)
+        insertado = c.rowcount == 1
 
-    except sqlite3.IntegrityError:
-        return print('Ya se encuentra registrado')
+        conn.commit()
 
-    conn.commit()
-    # Cerrar la conexión con la base de datos
-    conn.close()
+    if insertado:
+        cache_ingreso.invalidar(clave_cache(codigo))
+    return insertado
 
-def verifica(codigo):
-    
-    #Conecta con la BD
-    conn = sqlite3.connect('ingreso.db')
-    conn.execute("PRAGMA foreign_keys = 1")
-    c = conn.cursor()
+@medir_funcion
+def fill_lote(filas):
 
-    c.execute("""SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo
-                FROM ingresado 
-                WHERE codigo = ?;""", (codigo,))
-    
-    query_results = c.fetchall()
+    # Inserta muchas filas en ingresado en una sola transacción.
+    # Las que ya estaban registradas se ignoran, igual que en fill().
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
 
-    conn.commit()
-    # Cerrar la conexión con la base de datos
-    conn.close()
+        # Si el permiso se borró mientras la fila esperaba en la cola, la fila
+        # se descarta (la clave foránea haría fallar todo el lote)
+        c.executemany("""
+            INSERT OR IGNORE INTO ingresado (codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, fecha_ingreso)
+            SELECT ?,?,?,?,?,?,?,?,strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')
+            WHERE EXISTS (SELECT 1 FROM validacion WHERE codigo = ?1);""", filas)
 
-    #Retorna los resultados obtenidos
-    return query_results
+        conn.commit()
 
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+    for fila in filas:
+        cache_ingreso.invalidar(clave_cache(fila[0]))
 
-def report(limit=0, offset=0, dict_format=False):
-    
-    # Conectarse a la base de datos
-    conn = sqlite3.connect(db['database'])
-    if dict_format is True:
-        conn.row_factory = dict_factory
-    c = conn.cursor()
+def fill_diferido(codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo):
 
-    query = 'SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo FROM validacion'
+    # Igual que fill(), pero sin esperar la escritura: la fila se encola y el
+    # escritor en segundo plano la guarda junto con otras en un mismo lote.
+    escritor_ingreso.agregar((codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo))
 
-    if limit > 0:
-        query += ' LIMIT {}'.format(limit)
-        if offset > 0:
-            query += ' OFFSET {}'.format(offset)
+@medir_funcion
+def consulta_ingreso(codigo):
 
-    query += ';'
+    # Busca el permiso y registra el ingreso en una sola transacción, con una
+    # sola conexión y un solo commit: el ingreso queda guardado antes de
+    # responder y solo si el permiso existe (clave foránea a validacion).
+    clave = clave_cache(codigo)
+
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
+
+        c.execute("""
+            INSERT OR IGNORE INTO ingresado (codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, fecha_ingreso)
+            SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo,
+                   strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')
+            FROM validacion
+            WHERE codigo = ? AND (vence IS NULL OR vence > strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'));""", (codigo,))
+
+        c.execute("""SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, vence
+                    FROM validacion
+                    WHERE codigo = ?;""", (codigo,))
+
+        query_results = c.fetchall()
+        conn.commit()
 
-    c.execute(query)
-    query_results = c.fetchall()
+    if query_results:
+        cache_validacion.put(clave, query_results)
+    cache_ingreso.invalidar(clave)
 
-    # Cerrar la conexión con la base de datos
-    conn.close()
     return query_results
 
+@medir_funcion
+def consulta_ingreso_lote(codigos):
 
-def esquema_usuario():
+    # Igual que consulta_ingreso() para muchos códigos a la vez (por ejemplo
+    # los pasajeros de un vehículo): una sola transacción con dos queries,
+    # sin importar cuántos códigos sean. Los códigos se pasan como un único
+    # parámetro JSON (json_each), así no hay límite de variables por query.
+    # Retorna {codigo: fila} de los permisos encontrados.
+    codigos_json = json.dumps([int(codigo) for codigo in codigos])
 
-    # Conectarnos a la base de datos
-    # En caso de que no exista el archivo se genera
-    # como una base de datos vacia
-    conn = sqlite3.connect('usuarios.db')
-    conn.execute("PRAGMA foreign_keys = 1")
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
 
-    # Crear el cursor para poder ejecutar las querys
-    c = conn.cursor()
+        c.execute("""
+            INSERT OR IGNORE INTO ingresado (codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, fecha_ingreso)
+            SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo,
+                   strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')
+            FROM validacion
+            WHERE codigo IN (SELECT value FROM json_each(?))
+              AND (vence IS NULL OR vence > strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'));""", (codigos_json,))
+
+        c.execute("""SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, vence
+                    FROM validacion
+                    WHERE codigo IN (SELECT value FROM json_each(?));""", (codigos_json,))
+
+        query_results = c.fetchall()
+        conn.commit()
+
+    encontrados = {fila[0]: fila for fila in query_results}
+    for codigo in codigos:
+        clave = clave_cache(codigo)
+        fila = encontrados.get(int(codigo))
+        # Los no encontrados no se guardan en la cache (ver consulta)
+        if fila is not None:
+            cache_validacion.put(clave, [fila])
+            cache_ingreso.invalidar(clave)
+
+    return encontrados
+
+def verificar_lote(codigos):
+
+    # Verifica una lista de códigos de permiso y registra el ingreso de los
+    # que existen y no vencieron. Retorna el resultado código por código
+    # (encontrado, vencido, no_encontrado o invalido), en el mismo orden.
+    if len(codigos) > MAX_CODIGOS_LOTE:
+        raise ValueError('se admiten hasta {} códigos por pedido'.format(MAX_CODIGOS_LOTE))
+
+    numeros = [leer_entero(codigo) for codigo in codigos]
+    validos = list(dict.fromkeys(numero for numero in numeros if numero is not None))
+
+    encontrados = consulta_ingreso_lote(validos) if validos else {}
+
+    resultados = []
+    for codigo, numero in zip(codigos, numeros):
+        if numero is None:
+            resultados.append({"codigo": codigo, "estado": "invalido"})
+        elif numero in encontrados:
+            fila = encontrados[numero]
+            resultados.append({"codigo": fila[0], "estado": "vencido" if vencido(fila) else "encontrado",
+                               "permiso": dict(zip(COLUMNAS_PERMISO, fila))})
+        else:
+            resultados.append({"codigo": numero, "estado": "no_encontrado"})
+
+    estados = [r["estado"] for r in resultados]
+    return {"encontrados": estados.count("encontrado"),
+            "vencidos": estados.count("vencido"),
+            "no_encontrados": estados.count("no_encontrado"),
+            "invalidos": estados.count("invalido"),
+            "resultados": resultados}
+
+def registrar_ingreso(codigo):
+
+    # Busca el permiso de /consulta y registra el ingreso. Según el parámetro
+    # ingreso de la sección [escritura]: "atomico" lo hace en una transacción
+    # (consulta_ingreso) y "diferido" encola el ingreso para el escritor en
+    # segundo plano, que lo guarda junto con otros en un mismo lote.
+    # De un permiso vencido no se registra el ingreso (ver vencido())
+    if modo_ingreso == 'atomico':
+        return consulta_ingreso(codigo)
+
+    datos = consulta(codigo)
+    if datos and not vencido(datos[0]):
+        fill_diferido(*datos[0][:8])
+    return datos
+
+@medir_funcion
+def verifica(codigo):
 
-    # Ejecutar una query
-    c.execute("""
-                DROP TABLE IF EXISTS usuario;
-            """)
+    # Primero se busca en la cache, solo si no está se va a la BD
+    clave = clave_cache(codigo)
+    encontrado, query_results = cache_ingreso.get(clave)
+    if encontrado is True:
+        return query_results
 
-    # Ejecutar una query
-    c.execute("""
-        CREATE TABLE usuario (
-            [Clave] INTEGER PRIMARY KEY,
-            [Correo] STRING  NOT NULL,
-            [Nombre] STRING  NOT NULL
-        );
-        """)
+    #Toma una conexión del pool de la BD
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
 
-    # Para salvar los cambios realizados en la DB debemos
-    # ejecutar el commit, NO olvidarse de este paso!
-    conn.commit()
+        c.execute("""SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo
+                    FROM ingresado
+                    WHERE codigo = ?;""", (codigo,))
 
-    # Cerrar la conexión con la base de datos
-    conn.close()
+        query_results = c.fetchall()
 
-def fill_usuario(correo, clave, nombre):
-    
-    conn = sqlite3.connect('usuarios.db')
-    conn.execute("PRAGMA foreign_keys = 1")
-    c = conn.cursor()
+    # Sin ingreso todavía: no se guarda, el ingreso puede registrarlo otro worker
+    if query_results:
+        cache_ingreso.put(clave, query_results)
 
-    values = [correo, clave, nombre]
+    #Retorna los resultados obtenidos
+    return query_results
 
-    try: 
-        c.execute("""
-            INSERT INTO usuario (correo, clave, nombre)
-            VALUES (?,?,?);""", values)
+# Columnas de cada tabla que se exportan para los reportes (ver analitica.py)
+COLUMNAS_EXPORTACION = {
+    'validacion': ('codigo', 'empresa', 'actividad', 'nombre', 'edad', 'dni', 'fecha_permiso', 'riesgo'),
+    'ingresado': ('codigo', 'empresa', 'actividad', 'nombre', 'edad', 'dni', 'fecha_permiso', 'riesgo',
+                  'fecha_ingreso'),
+}
+
+@medir_funcion
+def exportar_cambios(tabla, desde=0):
+
+    # Filas actuales de los registros de la tabla que cambiaron después del
+    # cambio número desde (tabla cambios, migración 005). Retorna
+    # (hasta, filas, bajas): hasta es el último cambio incluido, para la
+    # próxima exportación, y bajas los códigos que cambiaron y ya no están
+    # en la tabla (borrados o archivados por mantenimiento.py).
+    columnas = COLUMNAS_EXPORTACION[tabla]
+
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
+        # Una sola transacción de lectura: hasta y las filas ven el mismo estado
+        c.execute("BEGIN")
+        c.execute("SELECT COALESCE(MAX(id), 0) FROM cambios;")
+        hasta = c.fetchone()[0]
+
+        c.execute("""SELECT {} FROM {}
+                    WHERE codigo IN (SELECT codigo FROM cambios
+                                     WHERE tabla = ? AND id > ? AND id <= ?)
+                    ORDER BY codigo;""".format(', '.join(columnas), tabla), (tabla, desde, hasta))
+        query_results = c.fetchall()
+
+        c.execute("""SELECT DISTINCT codigo FROM cambios
+                    WHERE tabla = ? AND id > ? AND id <= ?
+                      AND codigo NOT IN (SELECT codigo FROM {})
+                    ORDER BY codigo;""".format(tabla), (tabla, desde, hasta))
+        bajas = [fila[0] for fila in c.fetchall()]
+        conn.commit()
+
+    return hasta, query_results, bajas
+
+def terminos_busqueda(texto):
+
+    # Separa el texto en palabras sin mayúsculas ni acentos, igual que el
+    # tokenizador del índice (unicode61 remove_diacritics)
+    texto = unicodedata.normalize('NFKD', str(texto))
+    texto = ''.join(x for x in texto if not unicodedata.combining(x)).lower()
+    terminos = []
+    for termino in re.findall(r'\w+', texto):
+        if termino not in terminos:
+            terminos.append(termino)
+    return terminos[:MAX_TERMINOS_BUSQUEDA]
+
+def vocabulario(c, letra):
+
+    # Términos del índice que empiezan con la letra (el vocabulario cambia
+    # poco, se guarda unos minutos)
+    encontrado, terminos = cache_vocabulario.get(letra)
+    if encontrado is False:
+        c.execute("SELECT term FROM busqueda_vocabulario WHERE term >= ? AND term < ?;",
+                  (letra, chr(ord(letra) + 1)))
+        terminos = [fila[0] for fila in c.fetchall()]
+        cache_vocabulario.put(letra, terminos)
+    return terminos
+
+def corregir_termino(c, termino):
+
+    # Términos del índice parecidos a uno que no aparece (ni como prefijo),
+    # por ejemplo 'rodrigez' -> 'rodriguez'. Se comparan solo los que
+    # empiezan con la misma letra y tienen un largo parecido.
+    c.execute("SELECT 1 FROM busqueda_vocabulario WHERE term >= ? AND term < ? LIMIT 1;",
+              (termino, termino + '\U0010ffff'))
+    if c.fetchone() is not None or len(termino) < 3:
+        return []
+
+    candidatos = [x for x in vocabulario(c, termino[0]) if abs(len(x) - len(termino)) <= 2]
+    return difflib.get_close_matches(termino, candidatos, n=3, cutoff=0.75)
+
+@medir_funcion
+def buscar(texto, campo=None, limit=20, offset=0):
+
+    # Busca permisos por nombre, empresa o actividad (o solo en campo) con el
+    # índice FTS5 de la migración 008. Cada palabra se busca como prefijo
+    # ('mar' encuentra 'MARIA' y 'MARTINEZ') y las que no aparecen en el
+    # índice se reemplazan por las más parecidas. Los resultados se ordenan
+    # por relevancia (bm25, el nombre pesa más que la empresa y la actividad).
+    if campo is not None and campo not in CAMPOS_BUSQUEDA:
+        raise ValueError('campo desconocido: {}'.format(campo))
+    limit = max(1, min(int(limit), MAX_RESULTADOS_BUSQUEDA))
+    offset = max(0, min(int(offset), MAX_OFFSET_BUSQUEDA))
+
+    terminos = terminos_busqueda(texto)
+    resultado = {"consulta": "", "correcciones": {}, "permisos": [],
+                 "limit": limit, "offset": offset, "siguiente": None}
+    if not terminos:
+        return resultado
+
+    with conectar_lectura() as conn:
+        c = conn.cursor()
+
+        grupos = []
+        for termino in terminos:
+            correcciones = corregir_termino(c, termino)
+            if correcciones:
+                resultado["correcciones"][termino] = correcciones
+                grupos.append('(' + ' OR '.join('"{}"'.format(x) for x in correcciones) + ')')
+            else:
+                grupos.append('"{}"*'.format(termino))
+
+        consulta_fts = ' AND '.join(grupos)
+        if campo is not None:
+            consulta_fts = '{} : ({})'.format(campo, consulta_fts)
+        resultado["consulta"] = consulta_fts
+
+        # Se pide uno más para saber si hay otra página
+        c.execute("""SELECT v.codigo, v.empresa, v.actividad, v.nombre, v.edad, v.dni, v.fecha_permiso, v.riesgo, v.vence
+                    FROM busqueda
+                    JOIN validacion AS v ON v.codigo = busqueda.rowid
+                    WHERE busqueda MATCH ? AND rank MATCH ?
+                    ORDER BY rank
+                    LIMIT ? OFFSET ?;""",
+                  (consulta_fts, 'bm25({})'.format(', '.join(str(x) for x in CAMPOS_BUSQUEDA.values())),
+                   limit + 1, offset))
+        query_results = c.fetchall()
+
+    if len(query_results) > limit:
+        query_results = query_results[:limit]
+        resultado["siguiente"] = offset + limit
+    resultado["permisos"] = [dict(zip(COLUMNAS_PERMISO, fila)) for fila in query_results]
+    return resultado
+
+def leer_version_permisos(c):
+
+    # Número del último cambio de validacion (usa el índice cambios_tabla_id).
+    # Los ingresos no cambian la versión de los permisos.
+    c.execute("SELECT COALESCE(MAX(id), 0) FROM cambios WHERE tabla = 'validacion';")
+    return c.fetchone()[0]
+
+def version_permisos():
+
+    with conectar(db['database']) as conn:
+        return leer_version_permisos(conn.cursor())
+
+@medir_funcion
+def instantanea_permisos():
+
+    # Todos los permisos ordenados por código y la versión que representan,
+    # leídos en una misma transacción (ver instantanea.py)
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
+        c.execute("BEGIN")
+        version = leer_version_permisos(c)
+        c.execute("""SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, vence
+                    FROM validacion
+                    ORDER BY codigo;""")
+        query_results = c.fetchall()
+        conn.commit()
+
+    return version, query_results
+
+@medir_funcion
+def cambios_permisos(desde, maximo=None):
+
+    # Permisos que cambiaron después de la versión desde, para que un puesto
+    # de control actualice su copia local. Retorna (version, filas, bajas):
+    # las filas actuales de los códigos dados de alta o modificados y los
+    # códigos dados de baja. Retorna None si la copia del puesto ya no se
+    # puede actualizar con cambios (los cambios anteriores se borraron, la
+    # versión es de otra base, o son más de maximo códigos): el puesto
+    # tiene que descargar la instantánea completa.
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
+        c.execute("BEGIN")
+        version = leer_version_permisos(c)
+        # Hasta dónde se depuró el registro de cambios (mantenimiento.py)
+        c.execute("SELECT COALESCE((SELECT valor FROM mantenimiento WHERE clave = 'cambios_depurados_hasta'), 0);")
+        depurados = c.fetchone()[0]
+        if desde > version or desde < depurados:
+            conn.commit()
+            return None
+
+        c.execute("""SELECT DISTINCT codigo FROM cambios
+                    WHERE tabla = 'validacion' AND id > ? AND id <= ?;""", (desde, version))
+        codigos = [fila[0] for fila in c.fetchall()]
+        if maximo is not None and len(codigos) > maximo:
+            conn.commit()
+            return None
+
+        c.execute("""SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, vence
+                    FROM validacion
+                    WHERE codigo IN (SELECT value FROM json_each(?))
+                    ORDER BY codigo;""", (json.dumps(codigos),))
+        query_results = c.fetchall()
+        conn.commit()
+
+    presentes = {fila[0] for fila in query_results}
+    bajas = sorted(codigo for codigo in codigos if codigo not in presentes)
+    return version, query_results, bajas
+
+# Columnas de cada tabla que lleva un evento del canal /eventos
+COLUMNAS_EVENTO = {'validacion': COLUMNAS_PERMISO, 'ingresado': COLUMNAS_EXPORTACION['ingresado']}
+
+def eventos_desde(desde, limite=500):
+
+    # Altas de validacion e ingresado después del cambio número desde, para
+    # el canal de eventos (eventos.py). Recorre hasta limite cambios en orden
+    # y retorna (hasta, eventos, hay_mas): hasta es el último cambio recorrido
+    # (desde si no hay nada nuevo), cada evento lleva el número del cambio, la
+    # tabla y la fila como está ahora (None si ya se borró), y hay_mas indica
+    # que quedaron cambios sin recorrer.
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
+        # Una sola transacción de lectura: los cambios y las filas ven el mismo estado
+        c.execute("BEGIN")
+        c.execute("""SELECT id, tabla, codigo, operacion, fecha FROM cambios
+                    WHERE id > ? ORDER BY id LIMIT ?;""", (desde, limite))
+        cambios = c.fetchall()
+        altas = [fila for fila in cambios if fila[3] == 'alta' and fila[1] in COLUMNAS_EVENTO]
+
+        filas = {}
+        for tabla, columnas in COLUMNAS_EVENTO.items():
+            codigos = [fila[2] for fila in altas if fila[1] == tabla]
+            if codigos:
+                c.execute("""SELECT {} FROM {}
+                            WHERE codigo IN (SELECT value FROM json_each(?));""".format(', '.join(columnas), tabla),
+                          (json.dumps(codigos),))
+                filas[tabla] = {fila[0]: dict(zip(columnas, fila)) for fila in c.fetchall()}
+        conn.commit()
+
+    hasta = cambios[-1][0] if cambios else desde
+    eventos = [{"id": id, "tabla": tabla, "codigo": codigo, "fecha": fecha,
+                "datos": filas.get(tabla, {}).get(codigo)}
+               for id, tabla, codigo, operacion, fecha in altas]
+    return hasta, eventos, len(cambios) == limite
+
+def dict_factory(cursor, row):
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
 
-    except sqlite3.IntegrityError:
-        return print('Ya se encuentra registrado')
+@medir_funcion
+def report(limit=0, offset=0, dict_format=False):
 
-    conn.commit()
-    # Cerrar la conexión con la base de datos
-    conn.close()
+    # Tomar una conexión del pool de la base de datos
+    with conectar_lectura() as conn:
+        c = conn.cursor()
+        # El row_factory se aplica al cursor y no a la conexión,
+        # para no alterar la conexión que vuelve al pool
+        if dict_format is True:
+            c.row_factory = dict_factory
+
+        query = 'SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo FROM validacion'
+
+        if limit > 0:
+            query += ' LIMIT {}'.format(limit)
+            if offset > 0:
+                query += ' OFFSET {}'.format(offset)
+
+        query += ';'
 
+        c.execute(query)
+        query_results = c.fetchall()
+
+    return query_results
+
+
+def report_stream(despues_de=None, limit=0, dict_format=False, bloque=500):
+
+    # Generador que recorre la tabla validacion ordenada por codigo sin cargarla
+    # entera en memoria. La paginación es por clave (keyset): se retoma desde el
+    # último codigo entregado (despues_de) en lugar de usar OFFSET, así cualquier
+    # página cuesta lo mismo que la primera.
+    #
+    # Cada bloque se lee con su propia conexión del pool, que se devuelve antes
+    # de entregar las filas: un cliente lento no deja al pool sin conexiones
+    # (los bloques no son una sola lectura consistente de toda la tabla).
+    query = ('SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo FROM validacion'
+             ' WHERE codigo > ? ORDER BY codigo LIMIT ?;')
+    restantes = limit if limit > 0 else None
+
+    while restantes is None or restantes > 0:
+        cantidad = bloque if restantes is None else min(bloque, restantes)
+        with conectar_lectura() as conn:
+            c = conn.cursor()
+            if dict_format is True:
+                c.row_factory = dict_factory
+            c.execute(query, (despues_de if despues_de is not None else -1, cantidad))
+            filas = c.fetchall()
+
+        if not filas:
+            break
+        yield from filas
+        if len(filas) < cantidad:
+            break
+        if restantes is not None:
+            restantes -= len(filas)
+        despues_de = filas[-1]['codigo'] if dict_format is True else filas[-1][0]
+
+@medir_funcion
+def ultimo_codigo(despues_de=None, limit=0):
+
+    # Retorna el codigo de la última fila de la página que empieza después de
+    # despues_de, o None si la página no está completa (no hay más páginas).
+    # Usa solo el índice de la clave primaria.
+    if limit <= 0:
+        return None
+
+    with conectar_lectura() as conn:
+        c = conn.cursor()
+        c.execute("""SELECT codigo FROM validacion
+                    WHERE codigo > ?
+                    ORDER BY codigo
+                    LIMIT 1 OFFSET ?;""", (despues_de if despues_de is not None else -1, limit - 1))
+        query_results = c.fetchone()
+
+    return query_results[0] if query_results else None
+
+def iteraciones_clave():
+    return int(usuarios.get('iteraciones', credenciales.ITERACIONES))
+
+@medir_funcion
+def fill_usuario(correo, clave, nombre):
 
+    # Registra un usuario con el hash de su clave. Retorna False si el nombre
+    # ya estaba registrado. El hash se calcula antes de tomar la conexión,
+    # así el pool no queda ocupado mientras tanto.
+    iteraciones = iteraciones_clave()
+    sal, hash_clave = credenciales.hash_clave(clave, iteraciones=iteraciones)
+
+    #Toma una conexión del pool de la BD
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
+
+        values = [nombre, correo, sal, hash_clave, iteraciones]
+
+        try:
+            c.execute("""
+                INSERT INTO usuario (nombre, correo, sal, hash, iteraciones)
+                VALUES (?,?,?,?,?);""", values)
+
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            return False
+
+        conn.commit()
+
+    return True
+
+def clave_anterior(clave):
+
+    # La clave de antes de la migración 002 era la columna Clave INTEGER
+    # PRIMARY KEY: SQLite guardaba '0123' como 123. Una clave numérica se
+    # compara como la guardaba, sin los ceros a la izquierda.
+    numero = clave[1:] if clave.startswith(('+', '-')) else clave
+    if numero.isascii() and numero.isdigit():
+        return str(int(clave))
+    return clave
+
+@medir_funcion
+def login_usuario(nombre, clave):
+
+    # Verifica nombre y clave. Retorna el id del usuario, o None si no existe
+    # o la clave es incorrecta (las dos cosas tardan lo mismo).
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
+        c.execute("""SELECT id, sal, hash, iteraciones
+                    FROM usuario
+                    WHERE nombre = ?;""", (nombre,))
+        query_results = c.fetchone()
+
+    iteraciones = iteraciones_clave()
+    if query_results is None:
+        credenciales.simular_verificacion(clave, iteraciones)
+        return None
+
+    usuario_id, sal, hash_guardado, iteraciones_guardadas = query_results
+
+    if iteraciones_guardadas == 0:
+        # Usuario de antes de la migración 002: la clave estaba en texto plano
+        valida = hmac.compare_digest(clave_anterior(clave).encode('utf-8'), bytes(hash_guardado))
+    else:
+        valida = credenciales.verificar_clave(clave, sal, hash_guardado, iteraciones_guardadas)
+
+    if valida is False:
+        return None
+
+    # Si cambió la cantidad de iteraciones en el config.ini se recalcula el
+    # hash, y el de un usuario anterior se calcula con la clave tal como la tipeó
+    if iteraciones_guardadas != iteraciones:
+        sal, hash_clave = credenciales.hash_clave(clave, iteraciones=iteraciones)
+        with conectar(db['database']) as conn:
+            conn.execute("UPDATE usuario SET sal = ?, hash = ?, iteraciones = ? WHERE id = ?;",
+                         (sal, hash_clave, iteraciones, usuario_id))
+            conn.commit()
+
+    return usuario_id
+
+@medir_funcion
+def crear_sesion(usuario_id):
+
+    # Inicia una sesión y retorna su token, que se guarda en la cookie.
+    # De paso se borran las sesiones vencidas (usa el índice sesion_vence).
+    token = credenciales.nuevo_token()
+    ahora = time.time()
+    vence = ahora + float(usuarios.get('sesion_ttl', 28800))
+
+    with conectar(db['database']) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM sesion WHERE vence < ?;", (ahora,))
+        c.execute("INSERT INTO sesion (token, usuario_id, vence) VALUES (?,?,?);",
+                  (credenciales.hash_token(token), usuario_id, vence))
+        c.execute("SELECT nombre FROM usuario WHERE id = ?;", (usuario_id,))
+        nombre = c.fetchone()[0]
+        conn.commit()
+
+    cache_sesiones.put(token, {"id": usuario_id, "nombre": nombre, "vence": vence})
+    return token
+
+@medir_funcion
+def sesion_usuario(token):
+
+    # Retorna el usuario ({"id", "nombre", "vence"}) de una sesión vigente,
+    # o None. Las sesiones ya verificadas se buscan primero en la cache.
+    if not token:
+        return None
+
+    encontrado, usuario = cache_sesiones.get(token)
+    if encontrado is False:
+        with conectar(db['database']) as conn:
+            c = conn.cursor()
+            c.execute("""SELECT u.id, u.nombre, s.vence
+                        FROM sesion s JOIN usuario u ON u.id = s.usuario_id
+                        WHERE s.token = ?;""", (credenciales.hash_token(token),))
+            query_results = c.fetchone()
+
+        if query_results is None:
+            return None
+
+        usuario = {"id": query_results[0], "nombre": query_results[1], "vence": query_results[2]}
+        cache_sesiones.put(token, usuario)
+
+    if usuario["vence"] < time.time():
+        cache_sesiones.invalidar(token)
+        return None
+
+    return usuario
+
+@medir_funcion
+def cerrar_sesion(token):
+
+    if not token:
+        return
+
+    cache_sesiones.invalidar(token)
+    with conectar(db['database']) as conn:
+        conn.execute("DELETE FROM sesion WHERE token = ?;", (credenciales.hash_token(token),))
+        conn.commit()
+
+
+# Cargar la configuración al importar el módulo
+configurar()
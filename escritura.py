@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+'''
+Escritura diferida
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Cola de escritura en segundo plano (write-behind). Los pedidos agregan
+filas a la cola y siguen, un hilo las junta y las escribe en lotes, en
+una sola transacción por lote. Se vacía la cola al terminar el programa.
+Un lote que no se pudo escribir después de los reintentos se descarta:
+queda en el log (logger permisos.escritura, con el código de cada fila) y
+en la métrica escritura_filas_descartadas_total de /metrics.
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+import metricas
+
+# Valores por defecto si no están en la sección [escritura] del config.ini
+INTERVALO = 0.5
+TAMANIO = 200
+MAXIMO_COLA = 10000
+REINTENTOS = 3
+
+logger = logging.getLogger('permisos.escritura')
+
+
+class EscritorDiferido:
+
+    def __init__(self, escribir_lote, intervalo=INTERVALO, tamanio=TAMANIO,
+                 maximo_cola=MAXIMO_COLA, reintentos=REINTENTOS):
+        # escribir_lote recibe una lista de filas y las guarda en una transacción
+        self.escribir_lote = escribir_lote
+        self.intervalo = intervalo
+        self.tamanio = tamanio
+        self.reintentos = reintentos
+        # Si la cola se llena, agregar() espera: así la memoria queda acotada
+        self.cola = queue.Queue(maxsize=maximo_cola)
+        self.lock = threading.Lock()
+        self.detenido = threading.Event()
+        self.hilo = None
+        self.pid = None
+        self.escritas = 0
+        self.lotes = 0
+        self.errores = 0
+
+    def iniciar(self):
+        # El hilo se crea con el primer uso, y de nuevo si el proceso
+        # es un worker creado con fork (los hilos no pasan al hijo)
+        with self.lock:
+            if self.hilo is not None and self.pid == os.getpid() and self.hilo.is_alive():
+                return
+            self.pid = os.getpid()
+            self.detenido.clear()
+            self.hilo = threading.Thread(target=self.ejecutar, name='escritor-diferido', daemon=True)
+            self.hilo.start()
+
+    def agregar(self, fila):
+        if self.hilo is None or self.pid != os.getpid():
+            self.iniciar()
+        self.cola.put(fila)
+
+    def tomar_lote(self):
+        # Espera la primera fila y junta las siguientes hasta completar el lote
+        # o hasta que pase el intervalo desde la primera
+        try:
+            lote = [self.cola.get(timeout=self.intervalo)]
+        except queue.Empty:
+            return []
+
+        limite = time.monotonic() + self.intervalo
+        while len(lote) < self.tamanio:
+            restante = limite - time.monotonic()
+            try:
+                if restante > 0:
+                    lote.append(self.cola.get(timeout=restante))
+                else:
+                    lote.append(self.cola.get_nowait())
+            except queue.Empty:
+                break
+        return lote
+
+    def escribir(self, lote):
+        for intento in range(1, self.reintentos + 1):
+            try:
+                self.escribir_lote(lote)
+                self.escritas += len(lote)
+                self.lotes += 1
+                return
+            except Exception:
+                logger.exception('No se pudo escribir un lote de %d filas (intento %d de %d)',
+                                 len(lote), intento, self.reintentos)
+                if intento < self.reintentos:
+                    time.sleep(self.intervalo * intento)
+        # No se pudo escribir: se descarta para no trabar la cola, dejando
+        # registro de qué filas se perdieron (la primera columna es el código)
+        self.errores += len(lote)
+        metricas.contar('escritura_filas_descartadas_total', len(lote))
+        logger.error('Se descartaron %d filas de la escritura diferida, códigos: %s',
+                     len(lote), ', '.join(str(fila[0]) for fila in lote))
+
+    def ejecutar(self):
+        while True:
+            lote = self.tomar_lote()
+            if lote:
+                try:
+                    self.escribir(lote)
+                finally:
+                    for _ in lote:
+                        self.cola.task_done()
+            elif self.detenido.is_set():
+                break
+
+    def vaciar(self):
+        # Espera a que todo lo encolado hasta ahora esté escrito
+        if self.hilo is not None and self.pid == os.getpid() and self.hilo.is_alive():
+            self.cola.join()
+
+    def detener(self, timeout=10):
+        # Se escribe lo pendiente y se termina el hilo
+        self.detenido.set()
+        if self.hilo is not None and self.pid == os.getpid():
+            self.hilo.join(timeout)
+        self.hilo = None
+
+    def estadisticas(self):
+        return {
+            "pendientes": self.cola.qsize(),
+            "escritas": self.escritas,
+            "lotes": self.lotes,
+            "errores": self.errores,
+            "intervalo": self.intervalo,
+            "tamanio": self.tamanio,
+        }
+
+
+def crear(escribir_lote, params=None):
+    # Crea un escritor con los parámetros de la sección [escritura] del config.ini.
+    # Al terminar el programa se escribe lo que haya quedado en la cola.
+    params = params or {}
+    escritor = EscritorDiferido(escribir_lote,
+                                intervalo=float(params.get('intervalo', INTERVALO)),
+                                tamanio=int(params.get('tamanio', TAMANIO)),
+                                maximo_cola=int(params.get('maximo_cola', MAXIMO_COLA)),
+                                reintentos=int(params.get('reintentos', REINTENTOS)))
+    atexit.register(escritor.detener)
+    return escritor
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+'''
+Archivos estáticos y páginas en memoria
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Al iniciar se leen todos los archivos de static/, se calcula un hash de
+su contenido y se guardan en memoria junto con su versión comprimida con
+gzip (y brotli, si está instalado). url_for('static', ...) agrega el hash
+a la URL (?v=hash), así el navegador puede guardar el archivo un año: si
+cambia el contenido, cambia la URL. Las url() de los CSS se reescriben
+igual, para que las imágenes y fuentes también tengan su hash.
+
+Las páginas que no dependen del pedido (menu.html, salida.html, etc.) se
+arman una sola vez y se sirven desde memoria con ETag: cuando la tableta
+ya las tiene, la respuesta es un 304 sin cuerpo.
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import threading
+
+from flask import Response, abort, render_template, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Valores por defecto si no están en la sección [estaticos] del config.ini
+MAX_AGE = 31536000
+NIVEL_GZIP = 9
+
+# Tipos que vale la pena comprimir (las imágenes jpg/png y las fuentes woff ya lo están)
+COMPRIMIBLES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml',
+                'image/x-icon', 'image/vnd.microsoft.icon', 'font/ttf', 'application/x-font-ttf')
+
+# url('...') dentro de los CSS
+URL_CSS = re.compile(r"""url\((['"]?)([^'")?#]+)(\?[^'")#]*)?(#[^'")]*)?\1\)""")
+
+
+class Recurso:
+
+    def __init__(self, contenido, mimetype, max_age, nivel_gzip, comprimir=None):
+        self.mimetype = mimetype
+        self.hash = hashlib.sha256(contenido).hexdigest()[:16]
+        self.max_age = max_age
+        # Contenido por codificación: identity, gzip y br
+        self.variantes = {'identity': contenido}
+
+        # Codificaciones a generar; si no se indican, se deciden por el tipo
+        if comprimir is None:
+            comprimir = ('gzip', 'br') if mimetype.startswith(COMPRIMIBLES) else ()
+
+        if 'gzip' in comprimir:
+            comprimido = gzip.compress(contenido, compresslevel=nivel_gzip, mtime=0)
+            # Solo se guarda si ahorra algo
+            if len(comprimido) < len(contenido) * 0.9:
+                self.variantes['gzip'] = comprimido
+        if 'br' in comprimir and brotli is not None:
+            comprimido = brotli.compress(contenido)
+            if len(comprimido) < len(contenido) * 0.9:
+                self.variantes['br'] = comprimido
+
+    def codificacion(self):
+        # La mejor codificación que acepta el cliente
+        for codificacion in ('br', 'gzip'):
+            if codificacion in self.variantes and request.accept_encodings[codificacion] > 0:
+                return codificacion
+        return 'identity'
+
+    def respuesta(self, inmutable=False):
+        # Con el hash en la URL el archivo no cambia nunca: se guarda un año.
+        # Sin el hash (o en las páginas) se revalida con el ETag en cada uso.
+        if request.if_none_match.contains(self.hash):
+            response = Response(status=304)
+        else:
+            codificacion = self.codificacion()
+            response = Response(self.variantes[codificacion], mimetype=self.mimetype)
+            if codificacion != 'identity':
+                response.headers['Content-Encoding'] = codificacion
+
+        response.set_etag(self.hash)
+        response.headers['Vary'] = 'Accept-Encoding'
+        if inmutable is True:
+            response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(self.max_age)
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+
+class Estaticos:
+
+    def __init__(self, carpeta, max_age=MAX_AGE, nivel_gzip=NIVEL_GZIP):
+        self.carpeta = carpeta
+        self.max_age = max_age
+        self.nivel_gzip = nivel_gzip
+        self.recursos = {}
+        self.paginas = {}
+        self.lock = threading.Lock()
+        self.cargar()
+
+    def cargar(self):
+        archivos = []
+        for raiz, _, nombres in os.walk(self.carpeta):
+            for nombre in nombres:
+                ruta = os.path.join(raiz, nombre)
+                archivos.append(os.path.relpath(ruta, self.carpeta).replace(os.sep, '/'))
+
+        # Primero todo lo que no es CSS, así al reescribir los CSS ya se
+        # conoce el hash de las imágenes y fuentes que usan
+        archivos.sort(key=lambda nombre: nombre.endswith('.css'))
+        for nombre in archivos:
+            with open(os.path.join(self.carpeta, nombre), 'rb') as f:
+                contenido = f.read()
+
+            mimetype = mimetypes.guess_type(nombre)[0] or 'application/octet-stream'
+            if mimetype == 'text/css':
+                contenido = self.reescribir_css(nombre, contenido.decode('utf-8')).encode('utf-8')
+                mimetype = 'text/css; charset=utf-8'
+
+            self.recursos[nombre] = Recurso(contenido, mimetype, self.max_age, self.nivel_gzip)
+
+    def reescribir_css(self, nombre, texto):
+        carpeta = posixpath.dirname(nombre)
+
+        def reemplazar(match):
+            comilla, ruta, _, fragmento = match.groups()
+            recurso = self.recursos.get(posixpath.normpath(posixpath.join(carpeta, ruta)))
+            if recurso is None:
+                # URL externa o archivo que no existe: queda igual
+                return match.group(0)
+            return 'url({0}{1}?v={2}{3}{0})'.format(comilla, ruta, recurso.hash, fragmento or '')
+
+        return URL_CSS.sub(reemplazar, texto)
+
+    def version(self, nombre):
+        recurso = self.recursos.get(nombre)
+        return recurso.hash if recurso is not None else None
+
+    def servir(self, filename):
+        # Reemplaza a la vista static de Flask
+        recurso = self.recursos.get(filename)
+        if recurso is None:
+            abort(404)
+        return recurso.respuesta(inmutable=request.args.get('v') == recurso.hash)
+
+    def pagina(self, template):
+        # La página se arma con el primer pedido (url_for necesita el pedido)
+        # y después se sirve siempre desde memoria
+        clave = (template, request.script_root)
+        recurso = self.paginas.get(clave)
+        if recurso is None:
+            with self.lock:
+                recurso = self.paginas.get(clave)
+                if recurso is None:
+                    html = render_template(template).encode('utf-8')
+                    recurso = Recurso(html, 'text/html; charset=utf-8', self.max_age, self.nivel_gzip)
+                    self.paginas[clave] = recurso
+        return recurso.respuesta()
+
+    def estadisticas(self):
+        total = sum(len(r.variantes['identity']) for r in self.recursos.values())
+        comprimidos = sum(min(len(v) for v in r.variantes.values()) for r in self.recursos.values())
+        return {
+            "archivos": len(self.recursos),
+            "bytes": total,
+            "bytes_comprimidos": comprimidos,
+            "paginas": len(self.paginas),
+            "brotli": brotli is not None,
+        }
+
+
+def crear(carpeta, params=None):
+    # Carga los estáticos con los parámetros de la sección [estaticos] del config.ini
+    params = params or {}
+    return Estaticos(carpeta,
+                     max_age=int(params.get('max_age', MAX_AGE)),
+                     nivel_gzip=int(params.get('nivel_gzip', NIVEL_GZIP)))
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+'''
+Canal de eventos en vivo
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Los tableros de los supervisores muestran los permisos nuevos y los
+ingresos de los puestos de control a medida que se guardan. En lugar de
+que cada tablero consulte la base, un solo hilo por proceso (Difusor) lee
+cada intervalo segundos los cambios nuevos (tabla cambios, ver
+empresa_valida.eventos_desde) y los reparte a todas las suscripciones
+abiertas (/eventos y /eventos/nuevos de app.py, /api/eventos de api_async.py).
+
+Cada evento se identifica con el número del cambio. Un tablero que se
+reconecta manda el último que recibió (Last-Event-ID) y recibe lo que se
+perdió: de los últimos eventos que el difusor tiene en memoria (buffer) o,
+si son más viejos, de la base. Una suscripción que acumula más de
+max_pendientes eventos sin leer (un cliente lento) se cierra: el cliente se
+reconecta desde su último evento, sin frenar a los demás.
+
+Los parámetros se leen de la sección [eventos] del config.ini: intervalo,
+buffer, max_pendientes, max_suscripciones, latido y duracion.
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+from collections import deque
+
+# Valores por defecto si no están en la sección [eventos] del config.ini
+INTERVALO = 0.5
+BUFFER = 10000
+MAX_PENDIENTES = 1000
+MAX_SUSCRIPCIONES = 500
+LATIDO = 15.0
+DURACION = 300.0
+
+# Cambios que se recorren por lectura de la base
+LOTE = 1000
+
+# Reconexión que se le pide al navegador (EventSource), en milisegundos
+REINTENTO_MS = 3000
+
+# Marca de fin de una suscripción (cerrada por lenta o al terminar el proceso)
+FIN = None
+
+logger = logging.getLogger('permisos.eventos')
+
+
+class SinLugar(Exception):
+    # Se alcanzó max_suscripciones en este proceso
+    pass
+
+
+class Suscripcion:
+
+    # Eventos pendientes de un cliente. El difusor llama a entregar() con su
+    # lock tomado; el pedido del cliente lee con siguiente().
+
+    def __init__(self, difusor, desde, tablas, maximo):
+        self.difusor = difusor
+        self.ultimo = desde
+        self.tablas = tablas
+        self.maximo = maximo
+        self.cola = queue.Queue()
+        # Puestos los cuenta el difusor y tomados el cliente: cada contador
+        # tiene un solo hilo que lo modifica
+        self.puestos = 0
+        self.tomados = 0
+        self.terminada = False
+
+    def poner(self, elemento):
+        self.cola.put(elemento)
+
+    def entregar(self, eventos):
+        # Retorna False si la suscripción quedó cerrada
+        if self.terminada:
+            return False
+        for evento in eventos:
+            # Los que ya recibió (al reconectarse a otro worker) se saltean
+            if evento['id'] <= self.ultimo or (self.tablas and evento['tabla'] not in self.tablas):
+                continue
+            if self.puestos - self.tomados >= self.maximo:
+                self.terminar()
+                return False
+            self.ultimo = evento['id']
+            self.puestos += 1
+            self.poner(evento)
+        return True
+
+    def terminar(self):
+        if not self.terminada:
+            self.terminada = True
+            self.poner(FIN)
+
+    def siguiente(self, timeout):
+        # Próximo evento, FIN si la suscripción terminó o el string vacío si
+        # pasaron timeout segundos sin eventos (para mandar un latido)
+        try:
+            evento = self.cola.get(timeout=timeout)
+        except queue.Empty:
+            return ''
+        if evento is not FIN:
+            self.tomados += 1
+        return evento
+
+    def cancelar(self):
+        self.difusor.cancelar(self)
+
+
+class Difusor:
+
+    def __init__(self, leer, ultimo_cambio, intervalo=INTERVALO, buffer=BUFFER, max_pendientes=MAX_PENDIENTES,
+                 max_suscripciones=MAX_SUSCRIPCIONES):
+        # leer(desde, limite) retorna (hasta, eventos, hay_mas), ver
+        # empresa_valida.eventos_desde; ultimo_cambio() el número del último cambio
+        self.leer = leer
+        self.ultimo_cambio = ultimo_cambio
+        self.intervalo = intervalo
+        self.max_pendientes = max_pendientes
+        self.max_suscripciones = max_suscripciones
+        # Últimos eventos leídos: están todos los posteriores al cambio cubierto
+        self.buffer = deque(maxlen=buffer)
+        self.cubierto = 0
+        self.ultimo = 0
+        self.suscripciones = set()
+        self.lock = threading.Lock()
+        self.detenido = threading.Event()
+        self.hilo = None
+        self.pid = None
+        self.lecturas = 0
+        self.entregados = 0
+        self.cerradas_por_lentas = 0
+        self.errores = 0
+
+    def activo(self):
+        return self.hilo is not None and self.pid == os.getpid() and self.hilo.is_alive()
+
+    def iniciar(self, ultimo=None):
+        # Con el lock tomado. El hilo se crea con la primera suscripción (y
+        # de nuevo en cada worker creado con fork); sin suscripciones termina.
+        # ultimo es el último cambio, leído antes de tomar el lock: el buffer
+        # anterior ya no está al día y se descarta. Sin ultimo (el hilo
+        # terminó hace un momento) se sigue desde el último cambio leído.
+        if self.activo():
+            return
+        if ultimo is not None:
+            self.ultimo = ultimo
+            self.cubierto = ultimo
+            self.buffer.clear()
+        self.suscripciones = set()
+        self.pid = os.getpid()
+        self.detenido.clear()
+        self.hilo = threading.Thread(target=self.ejecutar, name='difusor-eventos', daemon=True)
+        self.hilo.start()
+
+    def suscribir(self, desde=None, tablas=None, clase=Suscripcion, **opciones):
+
+        # Abre una suscripción a los eventos posteriores al cambio desde
+        # (None: solo los nuevos). Los anteriores que el cliente se perdió
+        # se le entregan primero. La base se lee siempre sin el lock tomado:
+        # una base lenta no demora las entregas a las demás suscripciones.
+        ultimo = None if self.activo() else self.ultimo_cambio()
+        with self.lock:
+            if len(self.suscripciones) >= self.max_suscripciones:
+                raise SinLugar('se alcanzó el máximo de {} suscripciones'.format(self.max_suscripciones))
+            self.iniciar(ultimo)
+            if desde is None:
+                desde = self.ultimo
+            suscripcion = clase(self, desde, tablas, self.max_pendientes, **opciones)
+            if desde >= self.cubierto:
+                suscripcion.entregar(self.buffer)
+                self.suscripciones.add(suscripcion)
+                return suscripcion
+
+        # Más viejos que el buffer: se leen de la base, fuera del lock para
+        # no demorar a los demás
+        hasta, anteriores, hay_mas = self.leer(desde, self.max_pendientes)
+        with self.lock:
+            # El hilo pudo terminar mientras tanto (si no quedaban otras suscripciones)
+            self.iniciar()
+            suscripcion.entregar(anteriores)
+            if hay_mas or hasta < self.cubierto:
+                # Faltan más de los que se pueden dejar pendientes: el cliente
+                # los recibe en la próxima conexión, desde el último entregado
+                suscripcion.terminar()
+                return suscripcion
+            suscripcion.entregar(self.buffer)
+            self.suscripciones.add(suscripcion)
+        return suscripcion
+
+    def cancelar(self, suscripcion):
+        with self.lock:
+            self.suscripciones.discard(suscripcion)
+
+    def ejecutar(self):
+        while not self.detenido.is_set():
+            with self.lock:
+                if not self.suscripciones:
+                    self.hilo = None
+                    return
+                desde = self.ultimo
+
+            try:
+                hasta, nuevos, hay_mas = self.leer(desde, LOTE)
+                self.lecturas += 1
+            except Exception:
+                logger.exception('No se pudieron leer los cambios desde %s', desde)
+                self.errores += 1
+                self.detenido.wait(self.intervalo)
+                continue
+
+            with self.lock:
+                self.ultimo = hasta
+                for evento in nuevos:
+                    if len(self.buffer) == self.buffer.maxlen:
+                        self.cubierto = self.buffer[0]['id']
+                    self.buffer.append(evento)
+                if nuevos:
+                    for suscripcion in list(self.suscripciones):
+                        if not suscripcion.entregar(nuevos):
+                            self.suscripciones.discard(suscripcion)
+                            self.cerradas_por_lentas += 1
+                    self.entregados += len(nuevos)
+
+            # Si quedaron cambios sin leer se sigue enseguida
+            if not hay_mas:
+                self.detenido.wait(self.intervalo)
+
+    def detener(self, timeout=5):
+        # Cierra las suscripciones (los clientes se reconectan a otro
+        # proceso) y termina el hilo
+        self.detenido.set()
+        with self.lock:
+            for suscripcion in self.suscripciones:
+                suscripcion.terminar()
+            self.suscripciones = set()
+            hilo = self.hilo
+        if hilo is not None and self.pid == os.getpid():
+            hilo.join(timeout)
+        self.hilo = None
+
+    def estadisticas(self):
+        return {
+            "suscripciones": len(self.suscripciones),
+            "ultimo": self.ultimo,
+            "buffer": len(self.buffer),
+            "cubierto": self.cubierto,
+            "lecturas": self.lecturas,
+            "entregados": self.entregados,
+            "cerradas_por_lentas": self.cerradas_por_lentas,
+            "errores": self.errores,
+            "intervalo": self.intervalo,
+        }
+
+
+def leer_desde(valor):
+    # Último evento recibido (Last-Event-ID o ?desde=), None si no vino
+    # o no es un número
+    valor = str(valor or '').strip()
+    if not (valor.isascii() and valor.isdigit()) or int(valor) >= 2 ** 63:
+        return None
+    return int(valor)
+
+
+def leer_tablas(valor, disponibles):
+    # ?tabla=validacion,ingresado -> conjunto de tablas, None para todas
+    if not valor:
+        return None
+    tablas = {tabla.strip().lower() for tabla in valor.split(',') if tabla.strip()}
+    if not tablas <= set(disponibles):
+        raise ValueError('tablas disponibles: {}'.format(', '.join(disponibles)))
+    return tablas
+
+
+def formato_sse(evento):
+    # Un evento en el formato text/event-stream: el tipo es la tabla
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        evento['id'], evento['tabla'], json.dumps(evento, ensure_ascii=False, separators=(',', ':')))
+
+
+def crear(leer, ultimo_cambio, params=None):
+    # Crea un difusor con los parámetros de la sección [eventos] del config.ini.
+    # Al terminar el programa se cierran las suscripciones.
+    params = params or {}
+    difusor = Difusor(leer, ultimo_cambio,
+                      intervalo=float(params.get('intervalo', INTERVALO)),
+                      buffer=int(params.get('buffer', BUFFER)),
+                      max_pendientes=int(params.get('max_pendientes', MAX_PENDIENTES)),
+                      max_suscripciones=int(params.get('max_suscripciones', MAX_SUSCRIPCIONES)))
+    atexit.register(difusor.detener)
+    return difusor
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+'''
+Gráficos de la app
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Genera el gráfico de barras de cantidad de personas por riesgo en
+distintos formatos: PNG (matplotlib), SVG armado a mano o serie JSON
+para dibujar del lado del cliente. Matplotlib solo se importa la
+primera vez que se pide un PNG.
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import io
+import json
+import math
+from xml.sax.saxutils import escape
+
+TITULO = '"Cantidad de personas por riesgo"'
+ETIQUETA_X = 'Riesgos'
+ETIQUETA_Y = 'N° personas'
+LEYENDA = 'N° de riesgos'
+
+# Tipos de contenido por formato
+MIMETYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'json': 'application/json',
+}
+
+
+def png(riesgos, cantidad_personas):
+
+    # Import diferido: los workers que nunca dibujan no cargan matplotlib
+    import matplotlib
+    matplotlib.use('Agg')   # Para multi-thread, non-interactive backend (avoid run in main loop)
+    import matplotlib.pyplot as plt
+    # Para convertir matplotlib a imagen y luego a datos binarios
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+    from matplotlib.ticker import MaxNLocator
+
+    fig = plt.figure(figsize=(16, 9))
+    fig.suptitle(TITULO, fontsize=18)
+    ax = fig.add_subplot()
+
+    ax.bar(riesgos, cantidad_personas,  label=LEYENDA, color='darkgreen')
+    ax.set_facecolor('mintcream')
+    ax.set_xlabel(ETIQUETA_X, fontsize=15)
+    ax.set_ylabel(ETIQUETA_Y, fontsize=15)
+    ax.yaxis.set_major_locator(MaxNLocator(integer=True)) #para redondear los valores en el eje y
+    ax.legend()
+    ax.get_xaxis().set_visible(True)
+
+    # Convertir ese grafico en una imagen para enviar por HTTP
+    # y mostrar en el HTML
+    output = io.BytesIO()
+    FigureCanvas(fig).print_png(output)
+    plt.close(fig)  # Cerramos la imagen para que no consuma memoria del sistema
+    return output.getvalue()
+
+
+def marcas_eje(maximo, cantidad=8):
+
+    # Marcas enteras "redondas" para el eje y (1, 2, 5, 10, 20, 50...)
+    if maximo <= 0:
+        return [0, 1]
+    paso_crudo = max(maximo / cantidad, 1)
+    potencia = 10 ** math.floor(math.log10(paso_crudo))
+    for multiplo in (1, 2, 5, 10):
+        paso = multiplo * potencia
+        if paso >= paso_crudo:
+            break
+    tope = int(math.ceil(maximo / paso) * paso)
+    return list(range(0, tope + 1, int(paso)))
+
+
+def svg(riesgos, cantidad_personas, ancho=1600, alto=900):
+
+    # Mismo gráfico que png() pero como texto SVG, sin matplotlib
+    izquierda, derecha, arriba, abajo = 120, 40, 90, 110
+    area_ancho = ancho - izquierda - derecha
+    area_alto = alto - arriba - abajo
+
+    marcas = marcas_eje(max(cantidad_personas, default=0))
+    tope = marcas[-1]
+
+    partes = [
+        '<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" viewBox="0 0 {0} {1}" '
+        'font-family="sans-serif">'.format(ancho, alto),
+        '<rect width="100%" height="100%" fill="white"/>',
+        '<text x="{}" y="50" font-size="36" text-anchor="middle">{}</text>'.format(ancho / 2, escape(TITULO)),
+        '<rect x="{}" y="{}" width="{}" height="{}" fill="mintcream" stroke="black"/>'.format(
+            izquierda, arriba, area_ancho, area_alto),
+    ]
+
+    # Eje y con marcas enteras
+    for marca in marcas:
+        y = arriba + area_alto - area_alto * marca / tope
+        partes.append('<line x1="{0}" y1="{1:.1f}" x2="{2}" y2="{1:.1f}" stroke="black"/>'.format(
+            izquierda - 8, y, izquierda))
+        partes.append('<text x="{}" y="{:.1f}" font-size="20" text-anchor="end" dominant-baseline="middle">{}</text>'.format(
+            izquierda - 12, y, marca))
+
+    # Barras, una por riesgo
+    if riesgos:
+        ranura = area_ancho / len(riesgos)
+        ancho_barra = ranura * 0.8
+        for numero, (riesgo, cantidad) in enumerate(zip(riesgos, cantidad_personas)):
+            x = izquierda + ranura * numero + (ranura - ancho_barra) / 2
+            alto_barra = area_alto * cantidad / tope
+            partes.append('<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" height="{:.1f}" fill="darkgreen">'
+                          '<title>{}: {}</title></rect>'.format(
+                              x, arriba + area_alto - alto_barra, ancho_barra, alto_barra, escape(str(riesgo)), cantidad))
+            partes.append('<text x="{:.1f}" y="{}" font-size="20" text-anchor="middle">{}</text>'.format(
+                x + ancho_barra / 2, arriba + area_alto + 30, escape(str(riesgo))))
+
+    partes.append('<text x="{}" y="{}" font-size="30" text-anchor="middle">{}</text>'.format(
+        izquierda + area_ancho / 2, alto - 30, escape(ETIQUETA_X)))
+    partes.append('<text x="40" y="{0}" font-size="30" text-anchor="middle" transform="rotate(-90 40 {0})">{1}</text>'.format(
+        arriba + area_alto / 2, escape(ETIQUETA_Y)))
+
+    # Leyenda
+    partes.append('<rect x="{}" y="{}" width="30" height="20" fill="darkgreen"/>'.format(ancho - derecha - 260, arriba + 20))
+    partes.append('<text x="{}" y="{}" font-size="22">{}</text>'.format(ancho - derecha - 220, arriba + 38, escape(LEYENDA)))
+
+    partes.append('</svg>')
+    return '\n'.join(partes).encode('utf-8')
+
+
+def serie(riesgos, cantidad_personas):
+
+    # Datos del gráfico para dibujarlo en el navegador
+    return {
+        "titulo": TITULO,
+        "eje_x": ETIQUETA_X,
+        "eje_y": ETIQUETA_Y,
+        "riesgos": list(riesgos),
+        "cantidad_personas": list(cantidad_personas),
+    }
+
+
+def generar(formato, riesgos, cantidad_personas):
+
+    # Retorna el gráfico en el formato pedido, listo para enviar por HTTP
+    if formato == 'png':
+        return png(riesgos, cantidad_personas)
+    if formato == 'svg':
+        return svg(riesgos, cantidad_personas)
+    if formato == 'json':
+        return json.dumps(serie(riesgos, cantidad_personas), ensure_ascii=False).encode('utf-8')
+    raise ValueError('Formato de gráfico desconocido: {}'.format(formato))
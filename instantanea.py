@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+'''
+Instantánea de permisos para los puestos de control
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Los puestos de control sin conexión estable verifican los códigos con una
+copia local de los permisos. La copia es un archivo binario que se busca
+tal cual está, sin convertirlo: los códigos ordenados como enteros de 8
+bytes (búsqueda binaria) y, en la misma posición, un registro de tamaño
+fijo con los datos del permiso.
+
+Formato (little-endian):
+    encabezado   32 bytes: 'PERM', formato, tamaño de registro, versión,
+                 cantidad, bytes de nombres, bytes de tablas
+    códigos      cantidad x int64, ordenados
+    registros    cantidad x 40 bytes: dni, fecha del permiso y vencimiento
+                 (AAAAMMDDhhmmss, 0 si no vence), posición y largo del
+                 nombre, edad, índices de empresa, actividad y riesgo
+    nombres      texto UTF-8 de todos los nombres, uno detrás de otro
+    tablas       JSON con las listas de empresas, actividades y riesgos
+
+La versión es el número del último cambio de validacion (tabla cambios):
+con ella el puesto pide solo lo que cambió después (/sincronizacion/delta)
+y lo aplica sobre su copia con Lector.aplicar().
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import bisect
+import json
+import struct
+import sys
+from array import array
+from datetime import datetime
+
+MAGICO = b'PERM'
+FORMATO = 2
+
+# Nivel de gzip al servirla: los niveles más altos casi no achican este archivo
+NIVEL_GZIP = 6
+
+ENCABEZADO = struct.Struct('<4sHHQIII4x')
+REGISTRO = struct.Struct('<qqqIHHHHHxx')
+
+TABLAS = ('empresa', 'actividad', 'riesgo')
+COLUMNAS = ('codigo', 'empresa', 'actividad', 'nombre', 'edad', 'dni', 'fecha_permiso', 'riesgo', 'vence')
+
+
+def fecha_entero(fecha_permiso):
+    # '2020-11-17 10:30:00.123456' -> 20201117103000 (None -> 0)
+    if fecha_permiso is None:
+        return 0
+    f = str(fecha_permiso)
+    digitos = f[0:4] + f[5:7] + f[8:10] + f[11:13] + f[14:16] + f[17:19]
+    return int(digitos.ljust(14, '0')) if digitos.isascii() and digitos.isdigit() else 0
+
+
+def fecha_texto(entero):
+    # 20201117103000 -> '2020-11-17 10:30:00' (0 -> None)
+    if entero == 0:
+        return None
+    t = '{:014d}'.format(entero)
+    return '{}-{}-{} {}:{}:{}'.format(t[0:4], t[4:6], t[6:8], t[8:10], t[10:12], t[12:14])
+
+
+def armar(version, filas):
+
+    # Arma el archivo a partir de las filas de validacion ordenadas por
+    # código (empresa_valida.instantanea_permisos)
+    tablas = {tabla: [] for tabla in TABLAS}
+    indices = {tabla: {} for tabla in TABLAS}
+
+    def indice(tabla, valor):
+        posicion = indices[tabla].get(valor)
+        if posicion is None:
+            posicion = len(tablas[tabla])
+            if posicion > 0xFFFF:
+                raise ValueError('demasiados valores distintos de {}'.format(tabla))
+            indices[tabla][valor] = posicion
+            tablas[tabla].append(valor)
+        return posicion
+
+    codigos = array('q')
+    registros = []
+    nombres = []
+    inicio_nombre = 0
+    empaquetar = REGISTRO.pack
+    for codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, vence in filas:
+        codigos.append(codigo)
+        nombre = str(nombre).encode('utf-8')[:0xFFFF]
+        registros.append(empaquetar(int(dni), fecha_entero(fecha_permiso), fecha_entero(vence),
+                                    inicio_nombre, len(nombre), int(edad),
+                                    indice('empresa', empresa), indice('actividad', actividad),
+                                    indice('riesgo', riesgo)))
+        nombres.append(nombre)
+        inicio_nombre += len(nombre)
+
+    if sys.byteorder == 'big':
+        codigos.byteswap()
+
+    tablas_json = json.dumps(tablas, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    encabezado = ENCABEZADO.pack(MAGICO, FORMATO, REGISTRO.size, version, len(filas),
+                                 inicio_nombre, len(tablas_json))
+    return b''.join([encabezado, codigos.tobytes(), b''.join(registros), b''.join(nombres), tablas_json])
+
+
+class Lector:
+
+    # Búsqueda sobre una instantánea descargada, más los cambios aplicados
+    # después con aplicar(). Es lo que usa el puesto de control.
+
+    def __init__(self, contenido):
+        self.contenido = memoryview(contenido)
+        (magico, formato, tamanio, self.version, self.cantidad,
+         bytes_nombres, bytes_tablas) = ENCABEZADO.unpack_from(self.contenido)
+        if magico != MAGICO or formato != FORMATO or tamanio != REGISTRO.size:
+            raise ValueError('no es una instantánea de permisos de este formato')
+
+        inicio = ENCABEZADO.size
+        fin_codigos = inicio + 8 * self.cantidad
+        if sys.byteorder == 'little':
+            self.codigos = self.contenido[inicio:fin_codigos].cast('q')
+        else:
+            self.codigos = array('q', self.contenido[inicio:fin_codigos])
+            self.codigos.byteswap()
+        self.inicio_registros = fin_codigos
+        self.inicio_nombres = fin_codigos + REGISTRO.size * self.cantidad
+        inicio_tablas = self.inicio_nombres + bytes_nombres
+        self.tablas = json.loads(bytes(self.contenido[inicio_tablas:inicio_tablas + bytes_tablas]).decode('utf-8'))
+
+        # Cambios posteriores a la instantánea: codigo -> fila, o None si se dio de baja
+        self.cambios = {}
+
+    def buscar(self, codigo):
+        # Retorna el permiso como dict, o None si no existe
+        codigo = int(codigo)
+        if codigo in self.cambios:
+            fila = self.cambios[codigo]
+            return dict(zip(COLUMNAS, fila)) if fila is not None else None
+
+        i = bisect.bisect_left(self.codigos, codigo)
+        if i == self.cantidad or self.codigos[i] != codigo:
+            return None
+
+        (dni, fecha, vence, inicio_nombre, largo_nombre, edad,
+         empresa, actividad, riesgo) = REGISTRO.unpack_from(self.contenido, self.inicio_registros + i * REGISTRO.size)
+        inicio_nombre += self.inicio_nombres
+        nombre = bytes(self.contenido[inicio_nombre:inicio_nombre + largo_nombre]).decode('utf-8')
+        return {"codigo": codigo, "empresa": self.tablas['empresa'][empresa],
+                "actividad": self.tablas['actividad'][actividad], "nombre": nombre,
+                "edad": edad, "dni": dni, "fecha_permiso": fecha_texto(fecha),
+                "riesgo": self.tablas['riesgo'][riesgo], "vence": fecha_texto(vence)}
+
+    def vigente(self, codigo):
+        # True si el permiso existe y no venció
+        permiso = self.buscar(codigo)
+        if permiso is None:
+            return False
+        return permiso['vence'] is None or permiso['vence'] > datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def aplicar(self, delta):
+        # Aplica la respuesta de /sincronizacion/delta?desde=<self.version>
+        if delta['desde'] != self.version:
+            raise ValueError('el delta no corresponde a la versión de la copia')
+        for permiso in delta['permisos']:
+            self.cambios[int(permiso['codigo'])] = tuple(permiso[columna] for columna in COLUMNAS)
+        for codigo in delta['bajas']:
+            self.cambios[int(codigo)] = None
+        self.version = delta['version']
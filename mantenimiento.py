@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+'''
+Mantenimiento de la base de datos
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Tarea programada que mantiene chicas las tablas que usan los puestos de
+control, para que las consultas y los backups no se vuelvan más lentos
+con el tiempo:
+    - mueve los ingresos con más de retencion_ingresado_dias y los permisos
+      vencidos hace más de gracia_dias a bases de archivo por mes
+      (<carpeta>/permisos_AAAA-MM.db, con las mismas columnas)
+    - borra las sesiones vencidas y las claves de idempotencia viejas
+    - depura el registro de cambios: deja solo el último cambio de cada
+      registro y borra las bajas con más de retencion_cambios_dias
+    - libera el espacio de lo borrado (incremental_vacuum)
+
+incremental_vacuum necesita auto_vacuum=INCREMENTAL, que se activa una sola
+vez con un VACUUM completo. Ese VACUUM bloquea toda la base mientras dura,
+así que nunca se hace solo: se pide con --vacuum-completo, con los puestos
+de control detenidos. Hasta entonces las páginas libres se reutilizan
+pero el archivo no se achica.
+
+Un permiso vencido que todavía tiene ingresos sin archivar queda en
+validacion hasta que se archiven (ingresado tiene clave foránea a
+validacion). Las filas se mueven en lotes de una transacción cada uno,
+así los puestos de control nunca esperan mucho por la base.
+
+Los parámetros se leen de la sección [mantenimiento] del config.ini.
+
+Uso (por ejemplo desde cron, fuera del horario pico):
+    python mantenimiento.py
+    python mantenimiento.py --intervalo 86400
+    python mantenimiento.py --vacuum-completo   (una vez, fuera de servicio)
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import empresa_valida
+from config import config
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+config_path_name = os.path.join(script_path, 'config.ini')
+
+# Valores por defecto si no están en la sección [mantenimiento] del config.ini
+CARPETA = 'archivo'
+GRACIA_DIAS = 30
+RETENCION_INGRESADO_DIAS = 90
+RETENCION_CAMBIOS_DIAS = 30
+LOTE = 5000
+
+# Tablas de las bases de archivo (sin claves foráneas: cada tabla se
+# archiva por su cuenta). La clave incluye la fecha: el mismo permiso puede
+# archivarse más de una vez en el mes (un nuevo ingreso después de archivar
+# el anterior, o un permiso renovado que vuelve a vencer) y cada fila se guarda.
+ESQUEMA_ARCHIVO = {
+    'validacion': """CREATE TABLE IF NOT EXISTS archivo.validacion (
+        [codigo] INTEGER NOT NULL, [empresa] TEXT NOT NULL, [actividad] TEXT NOT NULL,
+        [nombre] TEXT NOT NULL, [edad] INTEGER NOT NULL, [dni] INTEGER NOT NULL,
+        [fecha_permiso] TEXT NOT NULL, [riesgo] TEXT NOT NULL, [vence] TEXT NOT NULL,
+        PRIMARY KEY (codigo, vence)) WITHOUT ROWID;""",
+    'ingresado': """CREATE TABLE IF NOT EXISTS archivo.ingresado (
+        [codigo] INTEGER NOT NULL, [empresa] TEXT NOT NULL, [actividad] TEXT NOT NULL,
+        [nombre] TEXT NOT NULL, [edad] INTEGER NOT NULL, [dni] INTEGER NOT NULL,
+        [fecha_permiso] TEXT NOT NULL, [riesgo] TEXT NOT NULL, [fecha_ingreso] TEXT NOT NULL,
+        PRIMARY KEY (codigo, fecha_ingreso)) WITHOUT ROWID;""",
+}
+
+COLUMNAS = {
+    'validacion': 'codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, vence',
+    'ingresado': 'codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo, fecha_ingreso',
+}
+
+# Parámetros de la sección [mantenimiento], se cargan con configurar()
+params = {}
+
+
+def configurar(config_path=config_path_name):
+    global params
+    params = config('mantenimiento', config_path)
+
+
+def fecha_limite(dias):
+    # Fecha de hace dias días, en el mismo formato que fecha_permiso
+    return (datetime.now() - timedelta(days=float(dias))).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def esquema_archivo(c, tabla):
+
+    # Crea la tabla en la base de archivo. Las bases de archivo anteriores
+    # tenían solo el código como clave: se pasan a la clave con la fecha.
+    c.execute("PRAGMA archivo.table_info({});".format(tabla))
+    claves = [fila[1] for fila in c.fetchall() if fila[5] > 0]
+    if claves == ['codigo']:
+        c.execute("ALTER TABLE archivo.{0} RENAME TO {0}_anterior;".format(tabla))
+        c.execute(ESQUEMA_ARCHIVO[tabla])
+        c.execute("INSERT INTO archivo.{0} ({1}) SELECT {1} FROM archivo.{0}_anterior;".format(
+            tabla, COLUMNAS[tabla]))
+        c.execute("DROP TABLE archivo.{}_anterior;".format(tabla))
+    else:
+        c.execute(ESQUEMA_ARCHIVO[tabla])
+
+
+def archivar(tabla, columna, condicion, valores, carpeta, lote):
+
+    # Mueve las filas de la tabla que cumplen la condición a la base de
+    # archivo del mes de columna (fecha_ingreso o vence). Retorna
+    # {mes: filas movidas}.
+    with empresa_valida.conectar(empresa_valida.db['database']) as conn:
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT substr({0}, 1, 7) FROM {1} WHERE {2};".format(columna, tabla, condicion),
+                  valores)
+        meses = sorted(fila[0] for fila in c.fetchall())
+
+    movidas = {}
+    for mes in meses:
+        archivo = os.path.join(carpeta, 'permisos_{}.db'.format(mes))
+        movidas[mes] = 0
+
+        with empresa_valida.conectar(empresa_valida.db['database']) as conn:
+            c = conn.cursor()
+            # ATTACH va fuera de la transacción
+            c.execute("ATTACH DATABASE ? AS archivo;", (archivo,))
+            try:
+                c.execute("BEGIN IMMEDIATE")
+                esquema_archivo(c, tabla)
+                conn.commit()
+
+                while True:
+                    # Cada lote es una transacción: se copia al archivo y se
+                    # borra. Si el proceso se corta entre las dos bases, al
+                    # repetir las filas ya copiadas se saltean (INSERT OR
+                    # IGNORE sobre código y fecha) y se borran.
+                    c.execute("BEGIN IMMEDIATE")
+                    c.execute("SELECT codigo FROM {0} WHERE {1} AND substr({2}, 1, 7) = ? LIMIT ?;".format(
+                        tabla, condicion, columna), list(valores) + [mes, lote])
+                    codigos = json.dumps([fila[0] for fila in c.fetchall()])
+                    if codigos == '[]':
+                        conn.commit()
+                        break
+
+                    c.execute("""INSERT OR IGNORE INTO archivo.{0} ({1})
+                                SELECT {1} FROM main.{0}
+                                WHERE codigo IN (SELECT value FROM json_each(?));""".format(tabla, COLUMNAS[tabla]),
+                              (codigos,))
+                    c.execute("DELETE FROM main.{0} WHERE codigo IN (SELECT value FROM json_each(?));".format(tabla),
+                              (codigos,))
+                    movidas[mes] += c.rowcount
+                    conn.commit()
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                c.execute("DETACH DATABASE archivo;")
+
+    return movidas
+
+
+def depurar(retencion_cambios_dias):
+
+    # Borra sesiones vencidas, claves de idempotencia viejas y depura el
+    # registro de cambios. Retorna la cantidad de filas borradas de cada tabla.
+    limite = fecha_limite(retencion_cambios_dias)
+    borradas = {}
+
+    with empresa_valida.conectar(empresa_valida.db['database']) as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+
+        c.execute("DELETE FROM sesion WHERE vence < ?;", (time.time(),))
+        borradas['sesion'] = c.rowcount
+
+        c.execute("DELETE FROM idempotencia WHERE fecha < ?;", (time.time() - empresa_valida.idempotencia_ttl,))
+        borradas['idempotencia'] = c.rowcount
+
+        # De cada registro alcanza con su último cambio: la exportación de
+        # analitica.py y /sincronizacion/delta solo usan qué códigos cambiaron
+        c.execute("""DELETE FROM cambios
+                    WHERE fecha < ? AND id NOT IN (SELECT MAX(id) FROM cambios GROUP BY tabla, codigo);""",
+                  (limite,))
+        borradas['cambios'] = c.rowcount
+
+        # Las bajas viejas se borran; una copia de los puestos de control
+        # anterior a la última baja borrada ya no se puede actualizar con
+        # cambios (cambios_permisos retorna None)
+        c.execute("""SELECT MAX(id) FROM cambios
+                    WHERE operacion = 'baja' AND tabla = 'validacion' AND fecha < ?;""", (limite,))
+        hasta = c.fetchone()[0]
+        c.execute("DELETE FROM cambios WHERE operacion = 'baja' AND fecha < ?;", (limite,))
+        borradas['cambios'] += c.rowcount
+        if hasta is not None:
+            c.execute("""INSERT INTO mantenimiento (clave, valor) VALUES ('cambios_depurados_hasta', ?)
+                        ON CONFLICT (clave) DO UPDATE SET valor = MAX(valor, excluded.valor);""", (hasta,))
+
+        conn.commit()
+
+    return borradas
+
+
+def liberar_espacio(paginas=0, vacuum_completo=False):
+
+    # Devuelve al sistema las páginas libres que dejaron los borrados, con
+    # incremental_vacuum si la base tiene auto_vacuum=INCREMENTAL. Con
+    # vacuum_completo se activa auto_vacuum=INCREMENTAL con un VACUUM
+    # completo (bloquea la base mientras dura). Retorna las páginas libres
+    # que había.
+    with empresa_valida.conectar(empresa_valida.db['database']) as conn:
+        c = conn.cursor()
+
+        # Compactar el índice de búsqueda después de muchos borrados
+        c.execute("INSERT INTO busqueda (busqueda) VALUES ('optimize');")
+        conn.commit()
+
+        c.execute("PRAGMA freelist_count;")
+        libres = c.fetchone()[0]
+
+        c.execute("PRAGMA auto_vacuum;")
+        if c.fetchone()[0] != 2:
+            if vacuum_completo:
+                c.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+                c.execute("VACUUM;")
+        elif paginas > 0:
+            c.execute("PRAGMA incremental_vacuum({});".format(int(paginas))).fetchall()
+        else:
+            c.execute("PRAGMA incremental_vacuum;").fetchall()
+
+        c.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+        c.execute("PRAGMA optimize;")
+
+    return libres
+
+
+def ejecutar(vacuum_completo=False):
+
+    # Una pasada completa de mantenimiento. Retorna el reporte de lo que hizo.
+    inicio = time.perf_counter()
+    carpeta = params.get('carpeta', CARPETA)
+    if not os.path.isabs(carpeta):
+        carpeta = os.path.join(os.path.dirname(os.path.abspath(empresa_valida.db['database'])), carpeta)
+    os.makedirs(carpeta, exist_ok=True)
+    lote = int(params.get('lote', LOTE))
+
+    # Primero los ingresos viejos, así después se pueden archivar sus permisos vencidos
+    ingresado = archivar('ingresado', 'fecha_ingreso', 'fecha_ingreso < ?',
+                         [fecha_limite(params.get('retencion_ingresado_dias', RETENCION_INGRESADO_DIAS))],
+                         carpeta, lote)
+    validacion = archivar('validacion', 'vence',
+                          'vence < ? AND NOT EXISTS (SELECT 1 FROM ingresado WHERE ingresado.codigo = validacion.codigo)',
+                          [fecha_limite(params.get('gracia_dias', GRACIA_DIAS))],
+                          carpeta, lote)
+    borradas = depurar(params.get('retencion_cambios_dias', RETENCION_CAMBIOS_DIAS))
+    paginas_libres = liberar_espacio(int(params.get('paginas_vacuum', 0)), vacuum_completo=vacuum_completo)
+
+    reporte = {
+        "fecha": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
+        "archivados": {"ingresado": ingresado, "validacion": validacion},
+        "borrados": borradas,
+        "paginas_libres": paginas_libres,
+        "segundos": round(time.perf_counter() - inicio, 3),
+    }
+
+    with empresa_valida.conectar(empresa_valida.db['database']) as conn:
+        conn.execute("INSERT OR REPLACE INTO mantenimiento (clave, valor) VALUES ('ultima_ejecucion', ?);",
+                     (json.dumps(reporte),))
+        conn.commit()
+
+    return reporte
+
+
+configurar()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Archivo de permisos vencidos e ingresos viejos')
+    parser.add_argument('--intervalo', type=float, default=0,
+                        help='repetir cada tantos segundos (por defecto una sola vez)')
+    parser.add_argument('--vacuum-completo', action='store_true',
+                        help='activar incremental_vacuum con un VACUUM completo (bloquea la base)')
+    args = parser.parse_args()
+
+    empresa_valida.migrar()
+    vacuum_completo = args.vacuum_completo
+    while True:
+        print(json.dumps(ejecutar(vacuum_completo=vacuum_completo), indent=2, ensure_ascii=False))
+        vacuum_completo = False
+        if args.intervalo <= 0:
+            break
+        time.sleep(args.intervalo)
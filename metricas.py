@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+'''
+Métricas de la app
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Histogramas de latencia y contadores en memoria, para saber en qué se
+va el tiempo de cada pedido: esperar una conexión, las consultas de
+empresa_valida o el armado del HTML. Se publican en formato texto de
+Prometheus en /metrics y cada pedido deja una línea de log en JSON.
+Registrar una medición cuesta un time.perf_counter() y un lock.
+
+Los valores son de cada proceso: con gunicorn cada worker tiene los suyos
+y /metrics responde con los del worker que atendió el pedido. Por eso
+todas las series llevan la etiqueta worker (el pid del proceso): para
+Prometheus cada worker es una serie distinta, que no parece reiniciarse
+cuando otro worker responde, y los totales se obtienen sumando por
+worker (por ejemplo sum without (worker) (rate(http_pedidos_total[5m]))).
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+# Límites de los buckets en segundos (de 0.1 ms a 10 s)
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger('permisos.tiempos')
+
+lock = threading.Lock()
+histogramas = {}
+contadores = {}
+ayudas = {}
+
+# Tiempos acumulados del pedido en curso (uno por hilo)
+pedido = threading.local()
+
+
+class Histograma:
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.suma = 0.0
+        self.cantidad = 0
+
+    def observar(self, segundos):
+        for i, limite in enumerate(BUCKETS):
+            if segundos <= limite:
+                self.buckets[i] += 1
+                break
+        self.suma += segundos
+        self.cantidad += 1
+
+
+def describir(nombre, ayuda):
+    ayudas[nombre] = ayuda
+
+
+def observar(nombre, segundos, **etiquetas):
+    clave = (nombre, tuple(sorted(etiquetas.items())))
+    with lock:
+        histograma = histogramas.get(clave)
+        if histograma is None:
+            histograma = histogramas[clave] = Histograma()
+        histograma.observar(segundos)
+
+
+def contar(nombre, cantidad=1, **etiquetas):
+    clave = (nombre, tuple(sorted(etiquetas.items())))
+    with lock:
+        contadores[clave] = contadores.get(clave, 0) + cantidad
+
+
+def iniciar_pedido():
+    pedido.sql_segundos = 0.0
+    pedido.sql_consultas = 0
+    pedido.conexion_segundos = 0.0
+    pedido.render_segundos = 0.0
+
+
+def acumular(campo, segundos):
+    # Suma tiempo al pedido en curso, si el hilo está atendiendo uno
+    if hasattr(pedido, campo):
+        setattr(pedido, campo, getattr(pedido, campo) + segundos)
+
+
+def resumen_pedido():
+    return {
+        "sql_ms": round(getattr(pedido, 'sql_segundos', 0.0) * 1000, 3),
+        "sql_consultas": getattr(pedido, 'sql_consultas', 0),
+        "conexion_ms": round(getattr(pedido, 'conexion_segundos', 0.0) * 1000, 3),
+        "render_ms": round(getattr(pedido, 'render_segundos', 0.0) * 1000, 3),
+    }
+
+
+def medir_funcion(funcion):
+
+    # Decorador para las funciones de empresa_valida: registra la duración
+    # de cada llamada y la suma al tiempo SQL del pedido en curso
+    nombre = funcion.__name__
+
+    @functools.wraps(funcion)
+    def envoltura(*args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return funcion(*args, **kwargs)
+        finally:
+            segundos = time.perf_counter() - inicio
+            observar('empresa_valida_funcion_segundos', segundos, funcion=nombre)
+            if hasattr(pedido, 'sql_segundos'):
+                pedido.sql_segundos += segundos
+                pedido.sql_consultas += 1
+
+    return envoltura
+
+
+def log_pedido(datos):
+    # Una línea JSON por pedido, fácil de filtrar y agregar
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(datos, ensure_ascii=False))
+
+
+def escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def formato_etiquetas(etiquetas, extra=None):
+    pares = list(etiquetas) + (list(extra) if extra else [])
+    if not pares:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, escapar(v)) for k, v in pares) + '}'
+
+
+def prometheus(medidas=None):
+
+    # Texto en formato de exposición de Prometheus. medidas son valores
+    # instantáneos (gauges) calculados al momento: {(nombre, etiquetas): valor}
+    with lock:
+        copia_histogramas = [(clave, list(h.buckets), h.suma, h.cantidad) for clave, h in histogramas.items()]
+        copia_contadores = list(contadores.items())
+
+    lineas = []
+    vistos = set()
+    # El pid se toma al responder: es el del worker, no el del proceso principal
+    worker = [('worker', os.getpid())]
+
+    def encabezado(nombre, tipo):
+        if nombre not in vistos:
+            vistos.add(nombre)
+            if nombre in ayudas:
+                lineas.append('# HELP {} {}'.format(nombre, ayudas[nombre]))
+            lineas.append('# TYPE {} {}'.format(nombre, tipo))
+
+    for (nombre, etiquetas), buckets, suma, cantidad in sorted(copia_histogramas):
+        encabezado(nombre, 'histogram')
+        acumulado = 0
+        for limite, valor in zip(BUCKETS, buckets):
+            acumulado += valor
+            lineas.append('{}_bucket{} {}'.format(nombre, formato_etiquetas(etiquetas, worker + [('le', limite)]),
+                                                  acumulado))
+        lineas.append('{}_bucket{} {}'.format(nombre, formato_etiquetas(etiquetas, worker + [('le', '+Inf')]),
+                                              cantidad))
+        lineas.append('{}_sum{} {}'.format(nombre, formato_etiquetas(etiquetas, worker), suma))
+        lineas.append('{}_count{} {}'.format(nombre, formato_etiquetas(etiquetas, worker), cantidad))
+
+    for (nombre, etiquetas), valor in sorted(copia_contadores):
+        encabezado(nombre, 'counter')
+        lineas.append('{}{} {}'.format(nombre, formato_etiquetas(etiquetas, worker), valor))
+
+    for (nombre, etiquetas), valor in sorted((medidas or {}).items()):
+        encabezado(nombre, 'gauge')
+        lineas.append('{}{} {}'.format(nombre, formato_etiquetas(etiquetas, worker), valor))
+
+    return '\n'.join(lineas) + '\n'
+
+
+describir('http_pedido_segundos', 'Duración de los pedidos HTTP por endpoint')
+describir('http_pedidos_total', 'Pedidos HTTP atendidos por endpoint y estado')
+describir('http_errores_total', 'Excepciones capturadas en los endpoints')
+describir('empresa_valida_funcion_segundos', 'Duración de las funciones de empresa_valida')
+describir('sqlite_espera_conexion_segundos', 'Tiempo para obtener una conexión del pool')
+describir('sqlite_conexiones_abiertas_total', 'Conexiones SQLite abiertas desde el inicio')
+describir('template_render_segundos', 'Tiempo de armado de cada template')
+describir('escritura_filas_descartadas_total', 'Filas de la escritura diferida que no se pudieron guardar')
@@ -1,6 +1,7 @@
-DROP TABLE IF EXISTS  validacion;
+-- Esquema inicial de la tabla ingresado (el que creaba esquema()).
+-- Las bases que ya tenían la tabla quedan igual.
 
-CREATE TABLE validacion (
+CREATE TABLE IF NOT EXISTS ingresado (
     [codigo] INTEGER PRIMARY KEY,
     [empresa] STRING  NOT NULL,
     [actividad] STRING NOT NULL,
@@ -9,5 +10,4 @@ CREATE TABLE validacion (
     [dni] INTEGER  NOT NULL,
     [fecha_permiso] INTEGER NOT NULL, 
     [riesgo] STRING NOT NULL
-    
-); 
\ No newline at end of file
+);
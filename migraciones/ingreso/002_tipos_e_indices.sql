@@ -0,0 +1,29 @@
+-- Mismo cambio que en validacion: columnas TEXT y fecha_permiso como
+-- timestamp ISO-8601, más índices para buscar por DNI y por fecha.
+
+CREATE TABLE ingresado_nueva (
+    [codigo] INTEGER PRIMARY KEY,
+    [empresa] TEXT NOT NULL,
+    [actividad] TEXT NOT NULL,
+    [nombre] TEXT NOT NULL,
+    [edad] INTEGER NOT NULL,
+    [dni] INTEGER NOT NULL,
+    [fecha_permiso] TEXT NOT NULL,
+    [riesgo] TEXT NOT NULL
+);
+
+INSERT INTO ingresado_nueva (codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo)
+SELECT codigo, empresa, actividad, nombre, edad, dni,
+       CASE WHEN typeof(fecha_permiso) IN ('integer', 'real')
+            THEN datetime(fecha_permiso, 'unixepoch') || '.000000'
+            ELSE fecha_permiso
+       END,
+       riesgo
+FROM ingresado;
+
+DROP TABLE ingresado;
+
+ALTER TABLE ingresado_nueva RENAME TO ingresado;
+
+CREATE INDEX ingresado_dni ON ingresado (dni);
+CREATE INDEX ingresado_fecha_permiso ON ingresado (fecha_permiso);
@@ -0,0 +1,8 @@
+-- Esquema inicial de la tabla usuario (el que creaba esquema_usuario()).
+-- Las bases que ya tenían la tabla quedan igual.
+
+CREATE TABLE IF NOT EXISTS usuario (
+    [Clave] INTEGER PRIMARY KEY,
+    [Correo] STRING  NOT NULL,
+    [Nombre] STRING  NOT NULL
+);
@@ -0,0 +1,38 @@
+-- La tabla usuario guardaba la clave en texto plano y como clave primaria
+-- (dos usuarios no podían tener la misma clave) y nunca se leía. Se
+-- reconstruye con un id, el nombre único e indexado para el login, y la
+-- clave como hash PBKDF2 con su sal y cantidad de iteraciones.
+--
+-- Los usuarios existentes pasan con iteraciones = 0 y la clave anterior en
+-- hash: en su primer login se verifica la clave y se guarda el hash PBKDF2.
+-- Si había nombres repetidos se conserva el primero.
+
+CREATE TABLE usuario_nuevo (
+    [id] INTEGER PRIMARY KEY,
+    [nombre] TEXT NOT NULL,
+    [correo] TEXT NOT NULL,
+    [sal] BLOB NOT NULL,
+    [hash] BLOB NOT NULL,
+    [iteraciones] INTEGER NOT NULL
+);
+
+CREATE UNIQUE INDEX usuario_nombre ON usuario_nuevo (nombre);
+
+INSERT OR IGNORE INTO usuario_nuevo (nombre, correo, sal, hash, iteraciones)
+SELECT Nombre, Correo, X'', CAST(CAST(Clave AS TEXT) AS BLOB), 0
+FROM usuario
+ORDER BY Clave;
+
+DROP TABLE usuario;
+
+ALTER TABLE usuario_nuevo RENAME TO usuario;
+
+-- Sesiones iniciadas, para que cualquier worker pueda validarlas. Se guarda
+-- el hash del token (el token solo lo tiene la cookie del navegador).
+CREATE TABLE sesion (
+    [token] TEXT PRIMARY KEY,
+    [usuario_id] INTEGER NOT NULL REFERENCES usuario (id) ON DELETE CASCADE,
+    [vence] REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX sesion_vence ON sesion (vence);
@@ -0,0 +1,14 @@
+-- Esquema inicial de la tabla validacion (el que creaba schema.sql).
+-- Las bases que ya tenían la tabla quedan igual.
+
+CREATE TABLE IF NOT EXISTS validacion (
+    [codigo] INTEGER PRIMARY KEY,
+    [empresa] STRING  NOT NULL,
+    [actividad] STRING NOT NULL,
+    [nombre] STRING NOT NULL,
+    [edad] INTEGER NOT NULL,
+    [dni] INTEGER  NOT NULL,
+    [fecha_permiso] INTEGER NOT NULL, 
+    [riesgo] STRING NOT NULL
+    
+);
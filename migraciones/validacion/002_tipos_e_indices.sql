@@ -0,0 +1,33 @@
+-- Las columnas declaradas STRING tienen afinidad NUMERIC en SQLite y
+-- fecha_permiso guardaba texto en una columna INTEGER. Se reconstruye la
+-- tabla con columnas TEXT y fecha_permiso como timestamp ISO-8601
+-- ('YYYY-MM-DD HH:MM:SS.ffffff'), que se ordena y compara como fecha.
+
+CREATE TABLE validacion_nueva (
+    [codigo] INTEGER PRIMARY KEY,
+    [empresa] TEXT NOT NULL,
+    [actividad] TEXT NOT NULL,
+    [nombre] TEXT NOT NULL,
+    [edad] INTEGER NOT NULL,
+    [dni] INTEGER NOT NULL,
+    [fecha_permiso] TEXT NOT NULL,
+    [riesgo] TEXT NOT NULL
+);
+
+INSERT INTO validacion_nueva (codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo)
+SELECT codigo, empresa, actividad, nombre, edad, dni,
+       CASE WHEN typeof(fecha_permiso) IN ('integer', 'real')
+            THEN datetime(fecha_permiso, 'unixepoch') || '.000000'
+            ELSE fecha_permiso
+       END,
+       riesgo
+FROM validacion;
+
+DROP TABLE validacion;
+
+ALTER TABLE validacion_nueva RENAME TO validacion;
+
+-- Búsqueda por DNI en los puestos de control, reportes por riesgo y por fecha
+CREATE INDEX validacion_dni ON validacion (dni);
+CREATE INDEX validacion_riesgo ON validacion (riesgo);
+CREATE INDEX validacion_fecha_permiso ON validacion (fecha_permiso);
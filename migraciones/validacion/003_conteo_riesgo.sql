@@ -0,0 +1,38 @@
+-- Cantidad de personas por riesgo, mantenida por triggers en cada
+-- INSERT/UPDATE/DELETE de validacion. Así grafico() lee unas pocas filas
+-- en lugar de recorrer toda la tabla con un GROUP BY.
+
+DROP TABLE IF EXISTS riesgo_conteo;
+
+CREATE TABLE riesgo_conteo (
+    [riesgo] TEXT PRIMARY KEY,
+    [cantidad] INTEGER NOT NULL
+);
+
+INSERT INTO riesgo_conteo (riesgo, cantidad)
+SELECT riesgo, COUNT(dni) FROM validacion GROUP BY riesgo;
+
+DROP TRIGGER IF EXISTS validacion_conteo_insert;
+DROP TRIGGER IF EXISTS validacion_conteo_delete;
+DROP TRIGGER IF EXISTS validacion_conteo_update;
+
+CREATE TRIGGER validacion_conteo_insert AFTER INSERT ON validacion
+BEGIN
+    INSERT INTO riesgo_conteo (riesgo, cantidad) VALUES (NEW.riesgo, 1)
+    ON CONFLICT(riesgo) DO UPDATE SET cantidad = cantidad + 1;
+END;
+
+CREATE TRIGGER validacion_conteo_delete AFTER DELETE ON validacion
+BEGIN
+    UPDATE riesgo_conteo SET cantidad = cantidad - 1 WHERE riesgo = OLD.riesgo;
+    DELETE FROM riesgo_conteo WHERE riesgo = OLD.riesgo AND cantidad <= 0;
+END;
+
+CREATE TRIGGER validacion_conteo_update AFTER UPDATE OF riesgo ON validacion
+WHEN OLD.riesgo IS NOT NEW.riesgo
+BEGIN
+    UPDATE riesgo_conteo SET cantidad = cantidad - 1 WHERE riesgo = OLD.riesgo;
+    DELETE FROM riesgo_conteo WHERE riesgo = OLD.riesgo AND cantidad <= 0;
+    INSERT INTO riesgo_conteo (riesgo, cantidad) VALUES (NEW.riesgo, 1)
+    ON CONFLICT(riesgo) DO UPDATE SET cantidad = cantidad + 1;
+END;
@@ -0,0 +1,45 @@
+-- Las tablas de ingreso.db y usuarios.db pasan a la misma base que
+-- validacion: un /consulta usa una sola conexión y un solo commit, e
+-- ingresado puede referenciar a validacion con una clave foránea real.
+-- Los datos de los archivos anteriores los copia empresa_valida.migrar()
+-- (ATTACH no se puede usar dentro de la transacción de las migraciones).
+
+CREATE TABLE ingresado (
+    [codigo] INTEGER PRIMARY KEY REFERENCES validacion (codigo),
+    [empresa] TEXT NOT NULL,
+    [actividad] TEXT NOT NULL,
+    [nombre] TEXT NOT NULL,
+    [edad] INTEGER NOT NULL,
+    [dni] INTEGER NOT NULL,
+    [fecha_permiso] TEXT NOT NULL,
+    [riesgo] TEXT NOT NULL
+);
+
+CREATE INDEX ingresado_dni ON ingresado (dni);
+CREATE INDEX ingresado_fecha_permiso ON ingresado (fecha_permiso);
+
+CREATE TABLE usuario (
+    [id] INTEGER PRIMARY KEY,
+    [nombre] TEXT NOT NULL,
+    [correo] TEXT NOT NULL,
+    [sal] BLOB NOT NULL,
+    [hash] BLOB NOT NULL,
+    [iteraciones] INTEGER NOT NULL
+);
+
+CREATE UNIQUE INDEX usuario_nombre ON usuario (nombre);
+
+CREATE TABLE sesion (
+    [token] TEXT PRIMARY KEY,
+    [usuario_id] INTEGER NOT NULL REFERENCES usuario (id) ON DELETE CASCADE,
+    [vence] REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX sesion_vence ON sesion (vence);
+
+-- Archivos anteriores ya copiados, para no volver a copiarlos
+CREATE TABLE base_importada (
+    [archivo] TEXT PRIMARY KEY,
+    [fecha] TEXT NOT NULL,
+    [filas] INTEGER NOT NULL
+);
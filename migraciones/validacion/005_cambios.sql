@@ -0,0 +1,52 @@
+-- Registro de cambios de validacion e ingresado, con un id creciente en el
+-- orden en que se confirman las transacciones. Permite exportar solo lo
+-- que cambió desde la última exportación (ver analitica.py).
+--
+-- ingresado no guardaba cuándo se registró el ingreso: se agrega
+-- fecha_ingreso. Para los ingresos anteriores se usa la fecha del permiso.
+
+ALTER TABLE ingresado ADD COLUMN fecha_ingreso TEXT;
+
+UPDATE ingresado SET fecha_ingreso = fecha_permiso;
+
+CREATE TABLE cambios (
+    [id] INTEGER PRIMARY KEY AUTOINCREMENT,
+    [tabla] TEXT NOT NULL,
+    [codigo] INTEGER NOT NULL,
+    [operacion] TEXT NOT NULL,
+    [fecha] TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))
+);
+
+CREATE TRIGGER cambios_validacion_alta AFTER INSERT ON validacion
+BEGIN
+    INSERT INTO cambios (tabla, codigo, operacion) VALUES ('validacion', NEW.codigo, 'alta');
+END;
+
+CREATE TRIGGER cambios_validacion_modificacion AFTER UPDATE ON validacion
+BEGIN
+    INSERT INTO cambios (tabla, codigo, operacion) VALUES ('validacion', NEW.codigo, 'modificacion');
+END;
+
+CREATE TRIGGER cambios_validacion_baja AFTER DELETE ON validacion
+BEGIN
+    INSERT INTO cambios (tabla, codigo, operacion) VALUES ('validacion', OLD.codigo, 'baja');
+END;
+
+CREATE TRIGGER cambios_ingresado_alta AFTER INSERT ON ingresado
+BEGIN
+    INSERT INTO cambios (tabla, codigo, operacion) VALUES ('ingresado', NEW.codigo, 'alta');
+END;
+
+CREATE TRIGGER cambios_ingresado_modificacion AFTER UPDATE ON ingresado
+BEGIN
+    INSERT INTO cambios (tabla, codigo, operacion) VALUES ('ingresado', NEW.codigo, 'modificacion');
+END;
+
+CREATE TRIGGER cambios_ingresado_baja AFTER DELETE ON ingresado
+BEGIN
+    INSERT INTO cambios (tabla, codigo, operacion) VALUES ('ingresado', OLD.codigo, 'baja');
+END;
+
+-- Los registros existentes cuentan como altas, así la primera exportación los incluye
+INSERT INTO cambios (tabla, codigo, operacion) SELECT 'validacion', codigo, 'alta' FROM validacion ORDER BY codigo;
+INSERT INTO cambios (tabla, codigo, operacion) SELECT 'ingresado', codigo, 'alta' FROM ingresado ORDER BY codigo;
@@ -0,0 +1,13 @@
+-- Claves de idempotencia de /procesar. Un cliente que reintenta el mismo
+-- registro (por ejemplo, después de un corte de red) manda la misma clave
+-- y recibe el resultado del primer intento, sin volver a escribir.
+-- Las claves se borran después de idempotencia_ttl segundos ([escritura]).
+
+CREATE TABLE idempotencia (
+    [clave] TEXT PRIMARY KEY,
+    [codigo] INTEGER NOT NULL,
+    [resultado] TEXT NOT NULL,
+    [fecha] REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX idempotencia_fecha ON idempotencia (fecha);
@@ -0,0 +1,6 @@
+-- Índice para leer los cambios de una sola tabla: la versión de los
+-- permisos (último cambio de validacion) y los cambios desde una versión,
+-- que usan la sincronización de los puestos de control y analitica.py.
+-- Sin el índice, cada consulta recorre toda la tabla cambios.
+
+CREATE INDEX cambios_tabla_id ON cambios (tabla, id);
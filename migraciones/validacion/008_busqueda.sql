@@ -0,0 +1,40 @@
+-- Índice de texto completo (FTS5) de nombre, empresa y actividad para
+-- buscar permisos sin el código (ver empresa_valida.buscar). El índice no
+-- guarda una copia de los textos (content=validacion) y lo mantienen los
+-- triggers en cada INSERT/UPDATE/DELETE de validacion. Las mayúsculas y
+-- los acentos no cuentan: 'Pérez' encuentra 'PEREZ'. prefix='2 3' agrega
+-- índices de prefijos para que las búsquedas 'ma*' no recorran el vocabulario.
+
+CREATE VIRTUAL TABLE busqueda USING fts5 (
+    nombre, empresa, actividad,
+    content = 'validacion',
+    content_rowid = 'codigo',
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+);
+
+-- Vocabulario del índice (un término por fila), para corregir errores de tipeo
+CREATE VIRTUAL TABLE busqueda_vocabulario USING fts5vocab (busqueda, row);
+
+CREATE TRIGGER busqueda_alta AFTER INSERT ON validacion
+BEGIN
+    INSERT INTO busqueda (rowid, nombre, empresa, actividad)
+    VALUES (NEW.codigo, NEW.nombre, NEW.empresa, NEW.actividad);
+END;
+
+CREATE TRIGGER busqueda_baja AFTER DELETE ON validacion
+BEGIN
+    INSERT INTO busqueda (busqueda, rowid, nombre, empresa, actividad)
+    VALUES ('delete', OLD.codigo, OLD.nombre, OLD.empresa, OLD.actividad);
+END;
+
+CREATE TRIGGER busqueda_modificacion AFTER UPDATE OF codigo, nombre, empresa, actividad ON validacion
+BEGIN
+    INSERT INTO busqueda (busqueda, rowid, nombre, empresa, actividad)
+    VALUES ('delete', OLD.codigo, OLD.nombre, OLD.empresa, OLD.actividad);
+    INSERT INTO busqueda (rowid, nombre, empresa, actividad)
+    VALUES (NEW.codigo, NEW.nombre, NEW.empresa, NEW.actividad);
+END;
+
+-- Los permisos existentes
+INSERT INTO busqueda (busqueda) VALUES ('rebuild');
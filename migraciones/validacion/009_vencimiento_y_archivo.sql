@@ -0,0 +1,22 @@
+-- Vencimiento de los permisos: un permiso vale desde fecha_permiso hasta
+-- vence. Los nuevos vencen vigencia_dias después de su fecha (sección
+-- [permisos] del config.ini); los anteriores quedan sin vencimiento (NULL).
+-- /consulta no registra el ingreso de un permiso vencido.
+--
+-- mantenimiento.py mueve los permisos vencidos y los ingresos viejos a
+-- bases de archivo por mes; los índices por vence y fecha_ingreso le
+-- permiten encontrarlos sin recorrer las tablas.
+
+ALTER TABLE validacion ADD COLUMN vence TEXT;
+
+CREATE INDEX validacion_vence ON validacion (vence) WHERE vence IS NOT NULL;
+
+CREATE INDEX ingresado_fecha_ingreso ON ingresado (fecha_ingreso);
+
+-- Estado del mantenimiento: última ejecución y hasta qué cambio se borró
+-- el registro de cambios (una copia más vieja no se puede actualizar con
+-- /sincronizacion/delta)
+CREATE TABLE mantenimiento (
+    [clave] TEXT PRIMARY KEY,
+    [valor]
+) WITHOUT ROWID;
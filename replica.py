@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+'''
+Réplicas de lectura de la base de datos
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Las lecturas (/consulta, /validaciones_empresa, /grafico_riesgo, /buscar)
+compiten con las escrituras por la misma base. En modo réplica un solo
+proceso (python replica.py, junto a la base principal) copia la base cada
+intervalo segundos con la API de backup de SQLite a un archivo nuevo
+(<carpeta>/replica_<número>.db) y publica cuál es el último en
+<carpeta>/actual.json. Los workers leen de ese archivo, que nunca cambia:
+lo abren de solo lectura, sin locks y con mmap, así las altas masivas
+no frenan las consultas de los puestos de control.
+
+Si la base no cambió desde la última copia (mismo número de cambio, ver
+empresa_valida.version_datos) no se copia de nuevo: solo se actualiza la
+fecha en actual.json, la réplica sigue al día.
+
+Si la última réplica tiene más de max_atraso segundos (por ejemplo, el
+proceso que las copia se detuvo) los workers vuelven a leer de la base
+principal hasta que haya una réplica nueva.
+
+Los parámetros se leen de la sección [replica] del config.ini: activa,
+carpeta, intervalo, max_atraso, mmap_size y conservar.
+
+Uso:
+    python replica.py               (copia cada intervalo segundos)
+    python replica.py --una-vez
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import argparse
+import glob
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Valores por defecto si no están en la sección [replica] del config.ini
+CARPETA = 'replicas'
+INTERVALO = 5.0
+MAX_ATRASO = 30.0
+MMAP_SIZE = 268435456
+CONSERVAR = 3
+
+# Cada cuánto un worker vuelve a mirar actual.json
+REVISAR = 1.0
+
+ARCHIVO = re.compile(r'^replica_(\d+)\.db$')
+
+
+def carpeta_replicas(params, database):
+    # La carpeta es relativa a la base principal
+    carpeta = params.get('carpeta', CARPETA)
+    if not os.path.isabs(carpeta):
+        carpeta = os.path.join(os.path.dirname(os.path.abspath(database)), carpeta)
+    return carpeta
+
+
+def publicar(database, carpeta, conservar=CONSERVAR):
+
+    # Copia la base principal a una réplica nueva y la publica en actual.json.
+    # El backup se hace en un solo paso desde una transacción de lectura: la
+    # copia es consistente y, con WAL, no bloquea a los que escriben.
+    os.makedirs(carpeta, exist_ok=True)
+    numeros = [int(m.group(1)) for m in (ARCHIVO.match(os.path.basename(x))
+                                         for x in glob.glob(os.path.join(carpeta, 'replica_*.db'))) if m]
+    numero = max(numeros, default=0) + 1
+    destino = os.path.join(carpeta, 'replica_{}.db'.format(numero))
+    temporal = destino + '.tmp'
+
+    inicio = time.perf_counter()
+    # Lo escrito después de este momento puede no estar en la copia
+    inicio_copia = time.time()
+    origen = sqlite3.connect(database)
+    copia = sqlite3.connect(temporal)
+    try:
+        origen.backup(copia)
+        # La réplica se abre de solo lectura: sin WAL (necesitaría escribir el -shm)
+        copia.execute("PRAGMA journal_mode = DELETE")
+        version = copia.execute("SELECT COALESCE(MAX(id), 0) FROM cambios;").fetchone()[0]
+    finally:
+        copia.close()
+        origen.close()
+    os.replace(temporal, destino)
+
+    actual = {"archivo": os.path.basename(destino), "fecha": time.time(), "inicio": inicio_copia,
+              "version": version, "segundos": round(time.perf_counter() - inicio, 3)}
+    escribir_actual(carpeta, actual)
+
+    # Las réplicas viejas se borran; un worker que todavía lee una las deja
+    # de usar al terminar ese pedido (en Windows se borran en otra pasada)
+    anteriores = sorted(numeros)
+    for anterior in anteriores[:max(len(anteriores) - (conservar - 1), 0)]:
+        try:
+            os.remove(os.path.join(carpeta, 'replica_{}.db'.format(anterior)))
+        except OSError:
+            pass
+
+    return actual
+
+
+def escribir_actual(carpeta, actual):
+    temporal = os.path.join(carpeta, 'actual.json.tmp')
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump(actual, f)
+    os.replace(temporal, os.path.join(carpeta, 'actual.json'))
+
+
+def leer_actual(carpeta):
+    try:
+        with open(os.path.join(carpeta, 'actual.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def renovar(database, carpeta, version_datos, conservar=CONSERVAR):
+
+    # Copia la base solo si cambió desde la última réplica. Si no cambió,
+    # la réplica actual sigue al día: se renueva su fecha en actual.json,
+    # así los workers no la consideran atrasada.
+    inicio = time.time()
+    version = version_datos()
+    actual = leer_actual(carpeta)
+    if (actual is None or actual.get('version') != version
+            or not os.path.exists(os.path.join(carpeta, actual['archivo']))):
+        return publicar(database, carpeta, conservar)
+
+    actual = dict(actual, fecha=time.time(), inicio=inicio, segundos=0.0, sin_cambios=True)
+    escribir_actual(carpeta, actual)
+    return actual
+
+
+class Lector:
+
+    # Del lado de los workers: qué réplica usar, o None para leer de la
+    # base principal (réplica inexistente o más vieja que max_atraso)
+
+    def __init__(self, carpeta, max_atraso=MAX_ATRASO):
+        self.carpeta = carpeta
+        self.max_atraso = max_atraso
+        self.actual = None
+        self.mtime = None
+        self.revisado = 0.0
+        self.lock = threading.Lock()
+
+    def revisar(self):
+        # Relee actual.json solo si cambió (un stat por segundo como mucho)
+        ruta = os.path.join(self.carpeta, 'actual.json')
+        try:
+            mtime = os.stat(ruta).st_mtime_ns
+        except OSError:
+            self.actual = None
+            return
+        if mtime != self.mtime:
+            try:
+                with open(ruta, encoding='utf-8') as f:
+                    self.actual = json.load(f)
+                self.mtime = mtime
+            except (OSError, ValueError):
+                self.actual = None
+
+    def archivo(self, despues_de=0.0):
+        # Réplica a usar, o None si no hay una de menos de max_atraso
+        # segundos o si fue copiada antes de despues_de (un time.time())
+        ahora = time.monotonic()
+        if ahora - self.revisado >= REVISAR:
+            with self.lock:
+                if ahora - self.revisado >= REVISAR:
+                    self.revisar()
+                    self.revisado = ahora
+
+        actual = self.actual
+        if actual is None or time.time() - actual['fecha'] > self.max_atraso:
+            return None
+        if despues_de and actual.get('inicio', 0.0) < despues_de:
+            return None
+        return os.path.join(self.carpeta, actual['archivo'])
+
+    def estado(self):
+        actual = self.actual
+        if actual is None:
+            return {"archivo": None}
+        return dict(actual, atraso=round(time.time() - actual['fecha'], 3),
+                    vigente=time.time() - actual['fecha'] <= self.max_atraso)
+
+
+def crear(params, database):
+    # Lector de réplicas si el modo réplica está activo ([replica] activa=si)
+    if str(params.get('activa', 'no')).lower() not in ('si', 'sí', '1', 'true'):
+        return None
+    return Lector(carpeta_replicas(params, database), max_atraso=float(params.get('max_atraso', MAX_ATRASO)))
+
+
+if __name__ == '__main__':
+    import empresa_valida
+    from config import config
+
+    parser = argparse.ArgumentParser(description='Copia periódica de la base principal para los workers de lectura')
+    parser.add_argument('--una-vez', action='store_true', help='hacer una sola copia y salir')
+    args = parser.parse_args()
+
+    params = config('replica', empresa_valida.config_path_name)
+    database = empresa_valida.db['database']
+    carpeta = carpeta_replicas(params, database)
+    intervalo = float(params.get('intervalo', INTERVALO))
+
+    empresa_valida.migrar()
+    while True:
+        inicio = time.monotonic()
+        print(json.dumps(renovar(database, carpeta, empresa_valida.version_datos,
+                                 int(params.get('conservar', CONSERVAR)))))
+        if args.una_vez:
+            break
+        time.sleep(max(intervalo - (time.monotonic() - inicio), 0))
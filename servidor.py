@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+'''
+Servidor de producción
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Lanza la app con un servidor WSGI de producción en lugar del servidor de
+desarrollo de Flask. Con gunicorn (Linux/macOS) se usan varios procesos
+(workers) con varios threads cada uno: la app se crea una sola vez en el
+proceso principal y los workers la heredan. Al recibir SIGTERM cada worker
+termina los pedidos en curso, escribe lo pendiente y cierra sus conexiones.
+Si gunicorn no está instalado (por ejemplo en Windows) se usa waitress,
+en un solo proceso con varios threads.
+
+Los parámetros se leen de la sección [server] del config.ini:
+host, port, workers (número o "auto"), threads, timeout y graceful_timeout.
+
+Uso:
+    python servidor.py
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import importlib.util
+import os
+import sys
+
+from config import config
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+config_path_name = os.path.join(script_path, 'config.ini')
+
+
+def cantidad_workers(valor):
+    # "auto": dos por núcleo más uno, lo recomendado por gunicorn
+    if str(valor).lower() == 'auto':
+        return (os.cpu_count() or 1) * 2 + 1
+    return int(valor)
+
+
+def cargar_app():
+    import app
+    return app.app
+
+
+def cerrar_worker(server, worker):
+    # Se ejecuta en cada worker al terminar: escribir la cola de ingresados
+    # y cerrar las conexiones del pool
+    import conexion
+    import empresa_valida
+    empresa_valida.escritor_ingreso.detener()
+    conexion.cerrar_todo()
+
+
+def gunicorn(params):
+
+    from gunicorn.app.base import BaseApplication
+
+    class Servidor(BaseApplication):
+
+        def __init__(self, opciones):
+            self.opciones = opciones
+            super().__init__()
+
+        def load_config(self):
+            for clave, valor in self.opciones.items():
+                self.cfg.set(clave, valor)
+
+        def load(self):
+            return cargar_app()
+
+    opciones = {
+        'bind': '{}:{}'.format(params['host'], params['port']),
+        'workers': cantidad_workers(params.get('workers', 'auto')),
+        'threads': int(params.get('threads', 4)),
+        'worker_class': 'gthread',
+        # La app (y las migraciones) se cargan una vez, antes de crear los workers
+        'preload_app': True,
+        'timeout': int(params.get('timeout', 30)),
+        'graceful_timeout': int(params.get('graceful_timeout', 30)),
+        'keepalive': int(params.get('keepalive', 5)),
+        'worker_exit': cerrar_worker,
+    }
+    Servidor(opciones).run()
+
+
+def waitress(params):
+
+    from waitress import serve
+
+    aplicacion = cargar_app()
+    try:
+        serve(aplicacion, host=params['host'], port=int(params['port']),
+              threads=int(params.get('threads', 4)))
+    finally:
+        cerrar_worker(None, None)
+
+
+def main():
+
+    params = config('server', config_path_name)
+
+    if importlib.util.find_spec('gunicorn') is not None:
+        gunicorn(params)
+    elif importlib.util.find_spec('waitress') is not None:
+        print('gunicorn no está disponible, se usa waitress en un solo proceso')
+        waitress(params)
+    else:
+        sys.exit('Falta un servidor WSGI: instalar gunicorn (Linux/macOS) o waitress (Windows)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+'''
+Fixtures de los tests
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Cada test usa una carpeta temporal con bases de datos creadas con el
+esquema original (el de antes de las migraciones, el que creaban
+create_schema() y esquema_usuario()) y un config.ini con los parámetros
+del repositorio, salvo los que hacen lentos o no deterministas los tests:
+pocas iteraciones del hash de claves y el ingreso registrado en la misma
+transacción de /consulta (ingreso = atomico).
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import os
+import sqlite3
+import sys
+import tempfile
+from configparser import ConfigParser
+
+import pytest
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+repo_path = os.path.dirname(script_path)
+sys.path.insert(0, repo_path)
+
+# app.py crea la app por defecto al importarse, con el config.ini del
+# proyecto: la base (validacion.db, relativa al directorio actual) se crea
+# y se migra en una carpeta temporal, no en la del proyecto
+carpeta_importacion = tempfile.TemporaryDirectory(prefix='permisos_tests_')
+directorio = os.getcwd()
+os.chdir(carpeta_importacion.name)
+try:
+    import app as aplicacion
+finally:
+    os.chdir(directorio)
+
+import conexion
+import empresa_valida
+
+# Esquema de validacion.db, ingreso.db y usuarios.db antes de las migraciones
+ESQUEMA_VALIDACION = """
+    CREATE TABLE validacion (
+        [codigo] INTEGER PRIMARY KEY,
+        [empresa] STRING  NOT NULL,
+        [actividad] STRING NOT NULL,
+        [nombre] STRING NOT NULL,
+        [edad] INTEGER NOT NULL,
+        [dni] INTEGER  NOT NULL,
+        [fecha_permiso] INTEGER NOT NULL,
+        [riesgo] STRING NOT NULL
+    );"""
+
+ESQUEMA_INGRESO = ESQUEMA_VALIDACION.replace('validacion', 'ingresado')
+
+ESQUEMA_USUARIO = """
+    CREATE TABLE usuario (
+        [Clave] INTEGER PRIMARY KEY,
+        [Correo] STRING  NOT NULL,
+        [Nombre] STRING  NOT NULL
+    );"""
+
+PERMISOS = [
+    (111, 'DIA', 'CAJERO', 'SILVA JUAN', 25, 34624, '2020-12-18 15:41:42.451615', 'SIN RIESGOS'),
+    (123, 'AMIGOS', 'BARTENDER', 'SILVA FERNANDO', 22, 78645, '2020-12-18 15:57:20.373000', 'SIN RIESGOS'),
+    (222, 'FARMACITY', 'SUPERVISOR', 'SILVA JUAN', 28, 5754754, '2020-12-18 15:50:42.465570', 'SIN RIESGOS'),
+    (333, 'COTO', 'REPOSITOR', 'PEREZ ANA', 67, 1234567, '2020-12-19 10:00:00.000000', 'ALTO'),
+]
+
+# Ingresos de la base ingreso.db anterior: 444 ya no tiene permiso
+INGRESOS = [PERMISOS[0], (444, 'DIA', 'CAJERO', 'GOMEZ LUIS', 30, 99887, '2020-12-18 16:00:00.000000', 'SIN RIESGOS')]
+
+# Usuarios de usuarios.db: la clave era la clave primaria, un número
+USUARIOS = [(123, 'johanarangeldo@gmail.com', 'lola'), ('0457', 'pepe@correo.com', 'pepe')]
+
+
+def crear_base(ruta, esquema, tabla, filas):
+    conn = sqlite3.connect(ruta)
+    conn.execute(esquema)
+    if filas:
+        marcas = ','.join('?' * len(filas[0]))
+        conn.executemany('INSERT INTO {} VALUES ({});'.format(tabla, marcas), filas)
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def config_path(tmp_path, monkeypatch):
+    # Las bases de versiones anteriores se buscan en el directorio actual
+    monkeypatch.chdir(tmp_path)
+    crear_base('validacion.db', ESQUEMA_VALIDACION, 'validacion', PERMISOS)
+    crear_base('ingreso.db', ESQUEMA_INGRESO, 'ingresado', INGRESOS)
+    crear_base('usuarios.db', ESQUEMA_USUARIO, 'usuario', USUARIOS)
+
+    parser = ConfigParser()
+    parser.read(os.path.join(repo_path, 'config.ini'))
+    parser['db']['database'] = str(tmp_path / 'validacion.db')
+    parser['usuarios']['iteraciones'] = '1000'
+    parser['escritura']['ingreso'] = 'atomico'
+    parser['metricas']['log_tiempos'] = 'no'
+    parser['analitica']['carpeta'] = str(tmp_path / 'analitica')
+    ruta = tmp_path / 'config.ini'
+    with open(ruta, 'w', encoding='utf-8') as f:
+        parser.write(f)
+    return str(ruta)
+
+
+@pytest.fixture
+def app(config_path):
+    app = aplicacion.create_app(config_path)
+    app.config['TESTING'] = True
+    yield app
+    app.extensions['eventos'].detener()
+    empresa_valida.escritor_ingreso.detener()
+    conexion.cerrar_todo()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
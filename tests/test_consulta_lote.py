@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+'''
+Tests de /consulta_lote
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Verificación de los códigos de los pasajeros de un vehículo: validación
+de la entrada y resultado código por código.
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import pytest
+
+import empresa_valida
+
+
+def estados(response):
+    return [(fila['codigo'], fila['estado']) for fila in response.get_json()['resultados']]
+
+
+def test_codigos_encontrados_y_no_encontrados(client):
+    response = client.post('/consulta_lote', json={'codigos': [111, '222', 999]})
+    assert response.status_code == 200
+    assert estados(response) == [(111, 'encontrado'), (222, 'encontrado'), (999, 'no_encontrado')]
+
+    reporte = response.get_json()
+    assert (reporte['encontrados'], reporte['no_encontrados'], reporte['invalidos']) == (2, 1, 0)
+    assert reporte['resultados'][0]['permiso']['empresa'] == 'DIA'
+
+
+def test_lista_directa(client):
+    response = client.post('/consulta_lote', json=[123])
+    assert estados(response) == [(123, 'encontrado')]
+
+
+@pytest.mark.parametrize('codigo', ['²', '١٢', 'abc', '', '-1', -1, 1.5, None, True,
+                                    '99999999999999999999', 2 ** 63, [111]])
+def test_codigo_invalido(client, codigo):
+    # Cada código inválido se informa en su fila, sin cortar el pedido
+    response = client.post('/consulta_lote', json={'codigos': ['111', codigo]})
+    assert response.status_code == 200
+    assert estados(response) == [(111, 'encontrado'), (codigo, 'invalido')]
+
+
+def test_codigos_repetidos(client):
+    response = client.post('/consulta_lote', json={'codigos': [111, '111']})
+    assert estados(response) == [(111, 'encontrado'), (111, 'encontrado')]
+
+
+@pytest.mark.parametrize('cuerpo', [{'codigos': 111}, {'otros': []}, 'texto', None])
+def test_se_espera_una_lista(client, cuerpo):
+    response = client.post('/consulta_lote', json=cuerpo)
+    assert response.status_code == 400
+
+
+def test_maximo_de_codigos(client):
+    codigos = list(range(empresa_valida.MAX_CODIGOS_LOTE + 1))
+    response = client.post('/consulta_lote', json={'codigos': codigos})
+    assert response.status_code == 400
+
+
+def test_registra_los_ingresos(client):
+    assert empresa_valida.verifica(222) == []
+    client.post('/consulta_lote', json={'codigos': [222, 999]})
+    assert [fila[0] for fila in empresa_valida.verifica(222)] == [222]
+    assert empresa_valida.verifica(999) == []
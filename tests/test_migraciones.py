@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+Tests de las migraciones
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Las bases con el esquema original (validacion.db, ingreso.db y
+usuarios.db separadas) se llevan a la última versión sin perder datos.
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import glob
+import os
+import sqlite3
+
+import conftest
+import empresa_valida
+
+
+def ultima_version(nombre):
+    archivos = glob.glob(os.path.join(conftest.repo_path, 'migraciones', nombre, '*.sql'))
+    return max(int(os.path.basename(archivo).split('_')[0]) for archivo in archivos)
+
+
+def leer(query):
+    conn = sqlite3.connect(empresa_valida.db['database'])
+    try:
+        return conn.execute(query).fetchall()
+    finally:
+        conn.close()
+
+
+def test_version_del_esquema(app):
+    assert leer('PRAGMA user_version;') == [(ultima_version('validacion'),)]
+    tablas = {fila[0] for fila in leer("SELECT name FROM sqlite_master WHERE type = 'table';")}
+    assert {'validacion', 'ingresado', 'usuario', 'sesion', 'cambios', 'idempotencia'} <= tablas
+
+
+def test_se_conservan_los_permisos(app):
+    filas = leer('SELECT codigo, empresa, actividad, nombre, edad, dni, fecha_permiso, riesgo '
+                 'FROM validacion ORDER BY codigo;')
+    assert filas == conftest.PERMISOS
+
+
+def test_se_copian_los_ingresos(app):
+    # Solo los de permisos que siguen en validacion; fecha_ingreso es la del permiso
+    filas = leer('SELECT codigo, fecha_ingreso FROM ingresado;')
+    assert filas == [(111, conftest.PERMISOS[0][6])]
+
+
+def test_se_copian_los_usuarios(app):
+    filas = leer('SELECT nombre, correo, iteraciones FROM usuario ORDER BY id;')
+    assert filas == [('lola', 'johanarangeldo@gmail.com', 0), ('pepe', 'pepe@correo.com', 0)]
+
+
+def test_migrar_de_nuevo_no_cambia_nada(app):
+    antes = leer('SELECT COUNT(*) FROM validacion UNION ALL SELECT COUNT(*) FROM ingresado '
+                 'UNION ALL SELECT COUNT(*) FROM usuario;')
+    versiones = empresa_valida.migrar()
+    assert versiones['validacion'] == ultima_version('validacion')
+    assert leer('SELECT COUNT(*) FROM validacion UNION ALL SELECT COUNT(*) FROM ingresado '
+                'UNION ALL SELECT COUNT(*) FROM usuario;') == antes
+
+
+def test_login_de_usuarios_anteriores(app):
+    # La clave de pepe era 0457 en una columna INTEGER: quedó guardada como 457
+    assert empresa_valida.login_usuario('lola', '123') is not None
+    assert empresa_valida.login_usuario('pepe', '0457') is not None
+    # Después del primer login vale el hash de la clave tal como se tipeó
+    assert leer("SELECT iteraciones FROM usuario WHERE nombre = 'pepe';") == [(1000,)]
+    assert empresa_valida.login_usuario('pepe', '0457') is not None
+    assert empresa_valida.login_usuario('pepe', '457') is None
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+'''
+Tests de /procesar
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Registro de permisos desde el formulario de empresa.html: los modos para
+un código que ya existe (rechazar, conservar, actualizar) y las claves de
+idempotencia.
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import empresa_valida
+
+
+def formulario(codigo=900, **cambios):
+    datos = {'codigo': str(codigo), 'empresa': 'dia', 'actividad': 'cajero', 'nombre': 'lopez maria',
+             'edad': '30', 'dni': '30111222', 'riesgo': 'sin riesgos'}
+    datos.update(cambios)
+    return datos
+
+
+def test_registro_nuevo(client):
+    response = client.post('/procesar', data=formulario())
+    assert response.status_code == 200
+    assert response.headers['X-Resultado-Registro'] == 'insertado'
+
+    fila = empresa_valida.consulta(900)[0]
+    assert fila[:6] == (900, 'DIA', 'CAJERO', 'LOPEZ MARIA', 30, 30111222)
+
+
+def test_datos_incorrectos(client):
+    for datos in (formulario(codigo='abc'), formulario(codigo='²'), formulario(edad='x'),
+                  formulario(dni='99999999999999999999'), formulario(empresa='123')):
+        response = client.post('/procesar', data=datos)
+        assert 'X-Resultado-Registro' not in response.headers
+    assert empresa_valida.consulta(900) == []
+
+
+def test_duplicado_se_rechaza(client):
+    client.post('/procesar', data=formulario())
+    response = client.post('/procesar', data=formulario(empresa='coto'))
+    assert response.status_code == 409
+    assert response.headers['X-Resultado-Registro'] == 'duplicado'
+    assert empresa_valida.consulta(900)[0][1] == 'DIA'
+
+
+def test_duplicado_se_conserva(client):
+    client.post('/procesar', data=formulario())
+    response = client.post('/procesar', data=formulario(empresa='coto', modo='conservar'))
+    assert response.status_code == 200
+    assert response.headers['X-Resultado-Registro'] == 'conservado'
+    assert empresa_valida.consulta(900)[0][1] == 'DIA'
+
+
+def test_duplicado_se_actualiza(client):
+    client.post('/procesar', data=formulario())
+    assert empresa_valida.consulta(900)[0][1] == 'DIA'
+
+    response = client.post('/procesar', data=formulario(empresa='coto', modo='actualizar'))
+    assert response.status_code == 200
+    assert response.headers['X-Resultado-Registro'] == 'actualizado'
+    # La cache de consulta() se invalida al actualizar
+    assert empresa_valida.consulta(900)[0][1] == 'COTO'
+
+
+def test_modo_desconocido(client):
+    response = client.post('/procesar', data=formulario(modo='borrar'))
+    assert response.status_code == 400
+    assert empresa_valida.consulta(900) == []
+
+
+def test_reintento_con_la_misma_clave(client):
+    headers = {'Idempotency-Key': 'clave-1'}
+    primero = client.post('/procesar', data=formulario(), headers=headers)
+    assert primero.headers['X-Resultado-Registro'] == 'insertado'
+    assert 'Idempotent-Replayed' not in primero.headers
+
+    # El reintento no vuelve a escribir ni responde 409: da el resultado del primero
+    reintento = client.post('/procesar', data=formulario(empresa='coto'), headers=headers)
+    assert reintento.status_code == 200
+    assert reintento.headers['X-Resultado-Registro'] == 'insertado'
+    assert reintento.headers['Idempotent-Replayed'] == 'true'
+    assert empresa_valida.consulta(900)[0][1] == 'DIA'
+
+
+def test_clave_en_el_formulario(client):
+    client.post('/procesar', data=formulario(clave_idempotencia='clave-2'))
+    reintento = client.post('/procesar', data=formulario(clave_idempotencia='clave-2'))
+    assert reintento.headers['Idempotent-Replayed'] == 'true'
+
+
+def test_clave_usada_con_otro_codigo(client):
+    headers = {'Idempotency-Key': 'clave-3'}
+    client.post('/procesar', data=formulario(), headers=headers)
+    response = client.post('/procesar', data=formulario(codigo=901), headers=headers)
+    assert response.status_code == 422
+    assert empresa_valida.consulta(901) == []
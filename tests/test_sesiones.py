@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+'''
+Tests de usuarios y sesiones
+---------------------------
+Autor: Johana Rangel
+Version: 1.0
+
+Descripcion:
+Registro de usuarios, login y logout con las sesiones guardadas en la
+base de datos (la cookie solo lleva el token).
+'''
+
+__author__ = "Johana Rangel"
+__email__ = "johanarang@hotmail.com"
+__version__ = "1.0"
+
+import sqlite3
+
+import credenciales
+import empresa_valida
+
+
+def registrar(client, nombre='ana', clave='2468'):
+    return client.post('/registrar', data={'name': nombre, 'password': clave, 'email': 'ana@correo.com'})
+
+
+def ingresar(client, nombre='ana', clave='2468'):
+    return client.post('/ingresar', data={'name_login': nombre, 'password_login': clave})
+
+
+def sesiones():
+    conn = sqlite3.connect(empresa_valida.db['database'])
+    try:
+        return [fila[0] for fila in conn.execute('SELECT token FROM sesion;')]
+    finally:
+        conn.close()
+
+
+def test_la_clave_se_guarda_con_hash(client):
+    registrar(client)
+    conn = sqlite3.connect(empresa_valida.db['database'])
+    sal, hash_clave = conn.execute("SELECT sal, hash FROM usuario WHERE nombre = 'ana';").fetchone()
+    conn.close()
+    assert hash_clave != b'2468'
+    assert credenciales.verificar_clave('2468', sal, hash_clave, 1000)
+
+
+def test_nombre_repetido(client):
+    registrar(client)
+    response = registrar(client, clave='1357')
+    assert 'Operación fallida' in response.get_data(as_text=True)
+    assert empresa_valida.login_usuario('ana', '2468') is not None
+    assert empresa_valida.login_usuario('ana', '1357') is None
+
+
+def test_login_y_logout(client):
+    registrar(client)
+    assert client.get('/new_registro').status_code == 302
+
+    response = ingresar(client)
+    assert response.status_code == 200
+    with client.session_transaction() as session:
+        token = session['token']
+
+    # En la base está el hash del token, no el token
+    assert sesiones() == [credenciales.hash_token(token)]
+
+    response = client.get('/new_registro')
+    assert response.status_code == 200
+    assert b'ana' in response.data
+
+    client.get('/logout')
+    assert sesiones() == []
+    assert client.get('/new_registro').status_code == 302
+    assert empresa_valida.sesion_usuario(token) is None
+
+
+def test_clave_incorrecta(client):
+    registrar(client)
+    ingresar(client, clave='1111')
+    with client.session_transaction() as session:
+        assert 'token' not in session
+    assert sesiones() == []
+    assert client.get('/new_registro').status_code == 302
+
+
+def test_usuario_inexistente(client):
+    ingresar(client, nombre='nadie')
+    with client.session_transaction() as session:
+        assert 'token' not in session
+